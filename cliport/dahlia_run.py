@@ -1,11 +1,16 @@
 import ast
+import builtins
+import collections
 import copy
+import functools
 import itertools
+import multiprocessing
 import os
 import random
 import re
+import time
 import traceback
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import astunparse
 import google.generativeai as genai
@@ -16,21 +21,28 @@ import pybullet as p
 import shapely
 # imports for LMPs
 import torch
-import base64
 from PIL import Image
-from io import BytesIO
-from openai.error import RateLimitError, APIConnectionError
 from pygments import highlight
 from pygments.formatters import TerminalFormatter
 from pygments.lexers import PythonLexer
-from scipy.spatial import distance
 from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
 #from vllm import LLM, SamplingParams
 
 from cliport import tasks
 from cliport.dataset import RavensDataset
 from cliport.environments.environment import Environment
+from cliport.utils import sim_snapshot
 from cliport.utils import utils
+from cliport.utils import watchdog
+from cliport.utils.fgen_library import STATUS_FAILED, STATUS_OK, FunctionLibrary, text_hash
+from cliport.utils.free_space import FreeSpaceRaster
+from cliport.utils.image_encoding import ImageEncoder
+from cliport.utils.llm_backends import TokenBucket, make_backend
+from cliport.utils.llm_cache import ResponseCache
+from cliport.utils.object_names import ObjectNameIndex, describe
+from cliport.utils.session_history import SessionHistory
+from cliport.utils.spatial_index import SpatialIndex
+from cliport.utils.world_snapshot import WorldSnapshot
 
 
 # llm_from_vllm = LLM(
@@ -53,8 +65,8 @@ class LMP:
     LMP planners tunnel
     '''
     
-    def __init__(self, name, cfg, lmp_fgen, fixed_vars, variable_vars,
-                 offline_model=None, offline_tokenizer=None, use_vllm: bool = False):
+    def __init__(self, name, cfg, lmp_fgen, fixed_vars, variable_vars, backend,
+                 response_cache=None, sandbox=None, watchdog=None):
         self._name = name
         self._cfg = cfg[0]
         self._llm = cfg[1]
@@ -68,24 +80,54 @@ class LMP:
         self._fixed_vars = fixed_vars
         self._variable_vars = variable_vars
 
-        self.exec_hist = ''
-
         self.mem = update_memory()
 
-        self.offline_model = offline_model
-        self.offline_tokenizer = offline_tokenizer
-        self.use_vllm = use_vllm
+        self._backend = backend
+        self._response_cache = response_cache
+        # rolls back rejected candidates, see `_sample_candidates`
+        self._sandbox = sandbox
+        # budget of every call, including the LMPs and functions it calls
+        self._watchdog = watchdog
+
+        self.history = SessionHistory(
+            max_tokens=self._cfg.get('history_max_tokens'),
+            policy=self._cfg.get('history_policy', 'evict'),
+            count_tokens=backend.count_tokens,
+        )
+        self.prompt_tokens = []  # prompt size of every call
+        self._prefix_tokens = (None, 0)
+
+    @property
+    def exec_hist(self):
+        return self.history.text
 
     def clear_exec_hist(self):
-        self.exec_hist = ''
+        self.history.clear()
+
+    def count_prompt_tokens(self, context, use_query):
+        """Size of the prompt `build_prompt` returns. Only the context and query are
+        tokenized, the prefix count is cached and the history keeps its own count."""
+        prefix = self.build_prompt_prefix()
+        if self._prefix_tokens[0] != prefix:
+            self._prefix_tokens = (prefix, self._backend.count_tokens(prefix))
+        n_tokens = self._prefix_tokens[1]
+        if self._cfg['maintain_session']:
+            n_tokens += self._backend.count_tokens('\n') + self.history.tokens
+        if context != '':
+            n_tokens += self._backend.count_tokens(f'\n{context}')
+        return n_tokens + self._backend.count_tokens(f'\n{use_query}')
 
-    def build_prompt(self, query, context=''):
+    def build_prompt_prefix(self):
+        """Few-shot part of the prompt, constant as long as no new functions are added."""
         if len(self._variable_vars) > 0:
             variable_vars_imports_str = (f"from utils import "
                                          f"{', '.join(self._variable_vars.keys())}")
         else:
             variable_vars_imports_str = ''
-        prompt = self._base_prompt.replace('{variable_vars_imports}', variable_vars_imports_str)
+        return self._base_prompt.replace('{variable_vars_imports}', variable_vars_imports_str)
+
+    def build_prompt(self, query, context=''):
+        prompt = self.build_prompt_prefix()
 
         if self._cfg['maintain_session']:
             prompt += f'\n{self.exec_hist}'
@@ -98,148 +140,195 @@ class LMP:
 
         return prompt, use_query
 
-    def __call__(
-            self,
-            query,
-            context='',
-            **kwargs
-    ):
-        if self.use_vllm:
-            from vllm import LLM, SamplingParams
-        prompt, use_query = self.build_prompt(query, context=context)
-        while True:
-            try:
-                if 'gpt3' in self._llm:
-                    code_str = openai.ChatCompletion.create(
-                        messages=[{"role": "system",
-                                   "content": "You are a task planning assistant "
-                                              "who only answers with python code"},
-                                  {"role": "user",
-                                   "content": prompt}],
-                        stop=self._stop_tokens,
-                        temperature=self._cfg['temperature'],
-                        model=self._cfg['engine'](),
-                        max_tokens=self._cfg['max_tokens'](),
-                    )['choices'][0]['message']['content'].strip()
-                    break
-                elif 'gpt4' in self._llm:
-                    code_str = openai.ChatCompletion.create(
-                        messages=[{"role": "system",
-                                   "content": "You are a task planning assistant "
-                                              "who only answers with python code"},
-                                  {"role": "user",
-                                   "content": prompt}],
-                        temperature=self._cfg['temperature'],
-                        model=self._cfg['engine'](),
-                        max_tokens=self._cfg['max_tokens'](),
-                    )['choices'][0]['message']['content'].strip()
-                    break
-                elif 'gemini' in self._llm:
-                    gen_model = genai.GenerativeModel(self._cfg['engine']())
-                    code_str = gen_model.generate_content(prompt)
-                    code_str = code_str.text
-                    break
-                elif 'llama' in self._llm:
-                    prompt += ('\n# Refer to the example tasks, '
-                               'now answer this last task question. '
-                               'Avoid defining new methods as much as possible.')
-                    # llm_model = llama_model[0]
-                    # tokenizer = llama_model[1]
-
-                    llm_model_inputs = self.offline_tokenizer.apply_chat_template(
-                        [
-                            {"role": "system",
-                             "content": "You are a task planning assistant "
-                                        "who only answers with python code"},
-                            {"role": "user",
-                             "content": prompt}
-                        ],
-                        add_generation_prompt=True,
-                        # return_tensors="pt"
-                    )
-                    terminators = [
-                        self.offline_tokenizer.eos_token_id,
-                        self.offline_tokenizer.convert_tokens_to_ids("<|eot_id|>")
-                    ]
-                    if not self.use_vllm:
-                        generated_ids = self.offline_model.generate(
-                            llm_model_inputs,
-                            max_new_tokens=self._cfg['max_tokens'](),
-                            # stop_strings=self._stop_tokens,
-                            top_p=1.0,
-                            top_k=50,
-                            temperature=0.7 + self._cfg['temperature'],
-                            do_sample=True,
-                            eos_token_id=terminators,
-                            # tokenizer=tokenizer,
-                        )
-                        response = generated_ids[0][llm_model_inputs.shape[-1]:]
-                        code_str = self.offline_tokenizer.decode(
-                            response,
-                            skip_special_tokens=True
-                        )
-                        break
-                    else:
-                        # Create a sampling params object.
-                        sampling_params = SamplingParams(
-                            temperature=0.8,
-                            top_p=0.95,
-                            top_k=50,
-                            max_tokens=self._cfg['max_tokens'](),
-                            stop_token_ids=terminators,
-                        )
-                        # Create an LLM.
-
-                        # Generate texts from the prompts.
-                        # The output is a list of RequestOutput objects
-                        # that contain the prompt, generated text, and other information.
-                        outputs = self.offline_model.generate(
-                            prompt_token_ids=llm_model_inputs,
-                            sampling_params=sampling_params
-                        )
-                        # Print the outputs.
-                        assert len(outputs) == 1, "Size of outputs is not 1."
-                        output = outputs[0]
-                        generated_text = output.outputs[0].text
-                        code_str = generated_text
-                        # for output in outputs:
-                        #     prompt = output.prompt
-                        #     generated_text = output.outputs[0].text
-                        #     print(f"Prompt: {prompt!r}, Generated text: {generated_text!r}")
-                        break
-
-            except (RateLimitError, APIConnectionError) as e:
-                print(f'OpenAI API got err {e}')
-                print('Retrying after 10s.')
-                sleep(10)
+    def _request(self, prompt, temperature=None):
+        if 'llama' in self._llm:
+            prompt += ('\n# Refer to the example tasks, '
+                       'now answer this last task question. '
+                       'Avoid defining new methods as much as possible.')
+        return dict(
+            messages=[{"role": "system",
+                       "content": "You are a task planning assistant "
+                                  "who only answers with python code"},
+                      {"role": "user",
+                       "content": prompt}],
+            model=self._cfg['engine'](),
+            temperature=self._cfg['temperature'] if temperature is None else temperature,
+            max_tokens=self._cfg['max_tokens'](),
+            stop=self._stop_tokens,
+            prefix=self.build_prompt_prefix(),
+        )
 
-        res = code_str
+    def _generate(self, prompt, temperature=None):
+        return self._backend.complete(**self._request(prompt, temperature))
+
+    def _cached(self, generate, prompt, temperature, tag=''):
+        # `generate()` through the response cache, `tag` tells apart several samples
+        if self._response_cache is None:
+            return generate()
+        cache_key = self._response_cache.make_key(
+            self._llm, self._cfg['engine'](), temperature, self._cfg['max_tokens'](),
+            self._stop_tokens, prompt + tag)
+        return self._response_cache.get_or_call(cache_key, generate)
 
+    def _to_exec(self, code_str, context, use_query):
+        # generated code, code to execute and text to log for a completion
         if '```' in code_str:
             code_str = extract_code(code_str)
-        
         if self._cfg['include_context'] and context != '' and context not in code_str:
-            to_exec = f'{context}\n{code_str}'
-            to_log = f'{context}\n{use_query}\n{code_str}'
+            return code_str, f'{context}\n{code_str}', f'{context}\n{use_query}\n{code_str}'
+        return code_str, code_str, f'{use_query}\n{code_str}'
+
+    def _exec(self, code_str, to_exec, lvars):
+        new_fs = self._lmp_fgen.create_new_fs_from_code(code_str)
+        self._variable_vars.update(new_fs)
+        exec_safe(to_exec, LayeredVars([self._fixed_vars, self._variable_vars]), lvars)
+
+    def _sample_candidates(self, prompt, context, use_query, lvars):
+        """Request `n_candidates` completions in parallel and execute them as they
+        arrive, each as a dry run from the same scene under a step and time budget. The
+        first that raises nothing and leaves a plausible scene is kept, the others are
+        rolled back. Returns the kept completion, or raises the error of the first
+        candidate if none passes.
+
+        Without a sandbox only the variables are rolled back, not the scene. Of those,
+        plain data is restored to its earlier contents, while other objects are only
+        rebound, so changes a candidate makes to their state are kept (see `_copy_vars`).
+        """
+        global answer
+        n = self._cfg['n_candidates']
+        temperature = self._cfg['candidate_temperature']
+        pool = ThreadPoolExecutor(max_workers=n)
+        futures = {
+            pool.submit(self._cached, functools.partial(self._generate, prompt, temperature),
+                        prompt, temperature, f'\n# candidate {i}'): i
+            for i in range(n)
+        }
+        budget = watchdog.Watchdog(max_actions=self._cfg['candidate_max_steps'],
+                                   max_seconds=self._cfg['candidate_timeout'])
+        first_error = None
+        try:
+            for future in as_completed(futures):
+                i = futures[future]
+                variable_vars, old_lvars = _copy_vars(self._variable_vars), _copy_vars(lvars)
+                snap = self._sandbox.snapshot() if self._sandbox is not None else None
+                try:
+                    res = future.result()
+                    code_str, to_exec, _ = self._to_exec(res, context, use_query)
+                    with budget.turn():
+                        self._exec(code_str, to_exec, lvars)
+                    if self._sandbox is not None and not self._sandbox.check_scene():
+                        raise ValueError('objects left the workspace')
+                    return res
+                except (Exception, watchdog.BudgetExceeded) as e:
+                    answer += f'LMP {self._name} candidate {i} rejected: {e!r}\n'
+                    first_error = first_error or e
+                    self._variable_vars.clear()
+                    self._variable_vars.update(variable_vars)
+                    lvars.clear()
+                    lvars.update(old_lvars)
+                    if snap is not None:
+                        self._sandbox.restore(snap)
+                    if isinstance(e, watchdog.BudgetExceeded) and e.watchdog is not budget:
+                        raise  # the budget of the whole turn is spent
+                finally:
+                    if snap is not None:
+                        self._sandbox.discard(snap)
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+        raise first_error
+
+    def _generate_and_exec(self, prompt, context, lvars):
+        """Stream the completion and execute every complete top-level statement while
+        later tokens are still arriving. Returns the completion text.
+
+        The context is executed first under the condition of `_to_exec`, unless the
+        completion repeats it. That is decided on the text streamed up to the first
+        statement, where a repeated context comes.
+
+        If the rest of the completion fails to parse, the variables, locals and new
+        functions of this call are rolled back and the SyntaxError is raised. Actions
+        already executed in the environment are not undone.
+        """
+        variable_vars, old_lvars = _copy_vars(self._variable_vars), _copy_vars(lvars)
+        statements = StatementStream()
+        chunks = []
+        context_pending = self._cfg['include_context'] and context != ''
+
+        def run_context():
+            nonlocal context_pending
+            if context_pending:
+                context_pending = False
+                if context not in ''.join(chunks):
+                    exec_safe(context, LayeredVars([self._fixed_vars, self._variable_vars]),
+                              lvars)
+
+        def run(stmt):
+            run_context()
+            new_fs = self._lmp_fgen.create_new_fs_from_code(stmt)
+            self._variable_vars.update(new_fs)
+            exec_safe(stmt, LayeredVars([self._fixed_vars, self._variable_vars]), lvars)
+
+        try:
+            for chunk in self._backend.stream(**self._request(prompt)):
+                chunks.append(chunk)
+                for stmt in statements.feed(chunk):
+                    run(stmt)
+            for stmt in statements.close():
+                run(stmt)
+            run_context()  # a completion without statements
+        except SyntaxError:
+            self._variable_vars.clear()
+            self._variable_vars.update(variable_vars)
+            lvars.clear()
+            lvars.update(old_lvars)
+            raise
+        return ''.join(chunks).strip()
+
+    def __call__(self, query, context='', **kwargs):
+        if self._watchdog is None:
+            return self._call(query, context, kwargs)
+        with self._watchdog.turn():
+            return self._call(query, context, kwargs)
+
+    def _call(self, query, context, kwargs):
+        prompt, use_query = self.build_prompt(query, context=context)
+        self.prompt_tokens.append(self.count_prompt_tokens(context, use_query))
+        lvars = kwargs
+
+        # in streaming and candidate mode the code is executed while it is generated,
+        # cached responses are executed as a whole below
+        executed = False
+
+        def generate():
+            nonlocal executed
+            if self._cfg.get('stream', False) and not self._cfg['debug_mode']:
+                executed = True
+                return self._generate_and_exec(prompt, context, lvars)
+            return self._generate(prompt)
+
+        if self._cfg.get('n_candidates', 1) > 1 and not self._cfg['debug_mode']:
+            res = self._sample_candidates(prompt, context, use_query, lvars)
+            executed = True
         else:
-            to_exec = code_str
-            to_log = f'{use_query}\n{to_exec}'
+            res = self._cached(generate, prompt, self._cfg['temperature'])
+
+        code_str, to_exec, to_log = self._to_exec(res, context, use_query)
 
         to_log_pretty = highlight(to_log, PythonLexer(), TerminalFormatter())
         print(f'LMP {self._name} exec:\n\n{to_log_pretty}\n')
         global answer
         answer += f'LLM answer:\n{res}\nLMP {self._name} exec:\n\n{to_log}\n'
 
-        new_fs = self._lmp_fgen.create_new_fs_from_code(code_str)
-        self._variable_vars.update(new_fs)
+        if not executed:
+            new_fs = self._lmp_fgen.create_new_fs_from_code(code_str)
+            self._variable_vars.update(new_fs)
 
-        gvars = merge_dicts([self._fixed_vars, self._variable_vars])
-        lvars = kwargs
+            gvars = LayeredVars([self._fixed_vars, self._variable_vars])
 
-        if not self._cfg['debug_mode']:
-            exec_safe(to_exec, gvars, lvars)
+            if not self._cfg['debug_mode']:
+                exec_safe(to_exec, gvars, lvars)
 
-        self.exec_hist += f'\n{to_exec}'
+        self.history.append(to_exec)
 
         if self._cfg['maintain_session']:
             self._variable_vars.update(lvars)
@@ -259,34 +348,42 @@ class LMPV:
     '''
     Vision-based LMP reporter
     '''
-    def __init__(self, name, cfg):
+    def __init__(self, name, cfg, backend, response_cache=None):
         self._name = name
         self._cfg = cfg[0]
         self._llm = cfg[1]
+        self._backend = backend
+        self._response_cache = response_cache
 
         self._base_prompt = self._cfg['prompt_text']
 
-        self.exec_hist = ''
-
         self.mem = update_memory()
 
+        self.history = SessionHistory(
+            max_tokens=self._cfg.get('history_max_tokens'),
+            policy=self._cfg.get('history_policy', 'evict'),
+            count_tokens=backend.count_tokens,
+        )
+        self.prompt_tokens = []  # prompt size of every call, text only
+        self._base_prompt_tokens = backend.count_tokens(self._base_prompt)
+        self.images = ImageEncoder(max_side=self._cfg.get('image_max_side'),
+                                   n_workers=self._cfg.get('image_workers', 4))
+
+    @property
+    def exec_hist(self):
+        return self.history.text
+
     def clear_exec_hist(self):
-        self.exec_hist = ''
+        self.history.clear()
+        self.images.clear()
+
+    def prefetch_images(self, image_sources):
+        """Start encoding frames of a later call in the background, e.g. the initial
+        observation while the planner runs."""
+        self.images.submit(image_sources)
 
     def encode_image(self, image_sources):
-        images = []
-        for image_source in image_sources:
-            image = Image.fromarray(image_source[0])
-            if image.mode == 'F':
-                if image_source[1] == 'd':
-                    image = image.convert('L')
-                elif image_source[1] == 'c':
-                    image = image.convert('RGB')
-            buffered = BytesIO()
-            image.save(buffered, format='JPEG')
-            img_str = buffered.getvalue()
-            images.append(base64.b64encode(img_str).decode('utf-8'))
-        return images
+        return self.images.encode(image_sources)
 
     def build_prompt(self, query, context=''):
         variable_vars_imports_str = ''
@@ -310,59 +407,40 @@ class LMPV:
             **kwargs
     ):
         prompt, use_query = self.build_prompt(query)
+        n_tokens = self._base_prompt_tokens + self._backend.count_tokens(f'\n{use_query}')
+        if self._cfg['maintain_session']:
+            n_tokens += self._backend.count_tokens('\n') + self.history.tokens
+        self.prompt_tokens.append(n_tokens)
         images = self.encode_image(context)
-        while True:
-            try:
-                if 'gpt4' in self._llm:
-                    code_str = openai.ChatCompletion.create(
-                        messages=[{"role": "system",
-                                   "content": "You are a task completion checking assistant "
-                                              "who compares the final observation with initial observation "
-                                              "and gives the judge in python code format like "
-                                              "'judge = True (or False)'"
-                                              },
-                                  {"role": "user",
-                                   "content": [
-                                       {"type": "text", "text": prompt},
-                                       {
-                                           "type": "image_url",
-                                            "image_url": {
-                                            "url": f"data:image/jpeg;base64,{images[0]}",
-                                            },
-                                        },
-                                        {
-                                           "type": "image_url",
-                                            "image_url": {
-                                            "url": f"data:image/jpeg;base64,{images[1]}",
-                                            },
-                                        },
-                                        {
-                                           "type": "image_url",
-                                            "image_url": {
-                                            "url": f"data:image/jpeg;base64,{images[2]}",
-                                            },
-                                        },
-                                        {
-                                           "type": "image_url",
-                                            "image_url": {
-                                            "url": f"data:image/jpeg;base64,{images[3]}",
-                                            },
-                                        },
-                                    ],
-                                },
-                            ],
-                        temperature=self._cfg['temperature'],
-                        model=self._cfg['engine'](),
-                        max_tokens=self._cfg['max_tokens'](),
-                    )['choices'][0]['message']['content'].strip()
-                    break
-                else:
-                    break
+        messages = [
+            {"role": "system",
+             "content": "You are a task completion checking assistant "
+                        "who compares the final observation with initial observation "
+                        "and gives the judge in python code format like "
+                        "'judge = True (or False)'"
+             },
+            {"role": "user",
+             "content": [{"type": "text", "text": prompt}] + [
+                 {"type": "image_url",
+                  "image_url": {"url": f"data:image/jpeg;base64,{image}"}}
+                 for image in images
+             ]},
+        ]
+
+        def generate():
+            return self._backend.complete(messages, model=self._cfg['engine'](),
+                                          temperature=self._cfg['temperature'],
+                                          max_tokens=self._cfg['max_tokens']())
 
-            except (RateLimitError, APIConnectionError) as e:
-                print(f'OpenAI API got err {e}')
-                print('Retrying after 10s.')
-                sleep(10)
+        if self._response_cache is None:
+            code_str = generate()
+        else:
+            # the frames are keyed by a hash of their encoded payload
+            cache_key = self._response_cache.make_key(
+                self._llm, self._cfg['engine'](), self._cfg['temperature'],
+                self._cfg['max_tokens'](), None,
+                prompt + ''.join(f'\n# image {text_hash(image)}' for image in images))
+            code_str = self._response_cache.get_or_call(cache_key, generate)
 
         res = code_str
 
@@ -382,7 +460,7 @@ class LMPV:
         if not self._cfg['debug_mode']:
             exec_safe(to_exec)
 
-        self.exec_hist += f'\n{to_exec}'
+        self.history.append(to_exec)
 
         if self._cfg['has_return']:
             # print(lvars)
@@ -395,6 +473,22 @@ class LMPV:
                     return False
 
 
+def _copy_vars(variables):
+    """Copy of a variable namespace to roll a dry run back to. Containers of plain data
+    are deep-copied, so a candidate appending to a list is undone; anything else
+    (functions, modules, env wrappers) and data that cannot be copied is kept by reference.
+    """
+    copied = {}
+    for name, value in variables.items():
+        if isinstance(value, (list, dict, set, tuple, bytearray, np.ndarray)):
+            try:
+                value = copy.deepcopy(value)
+            except Exception:
+                pass
+        copied[name] = value
+    return copied
+
+
 class LMPFGen:
     '''
     LMP-Feedback-Generator: the reporter tunnel of dahlia framework
@@ -405,9 +499,9 @@ class LMPFGen:
             cfg,
             fixed_vars,
             variable_vars,
-            offline_model=None,
-            offline_tokenizer=None,
-            use_vllm: bool = False
+            backend,
+            response_cache=None,
+            function_library=None,
     ):
         self._cfg = cfg[0]
         self._llm = cfg[1]
@@ -420,9 +514,66 @@ class LMPFGen:
 
         self.mem = update_memory()
 
-        self.offline_model = offline_model
-        self.offline_tokenizer = offline_tokenizer
-        self.use_vllm = use_vllm
+        self._backend = backend
+        self._response_cache = response_cache
+        self._function_library = function_library
+        self.n_generated = 0  # number of functions the model was asked for
+
+    def _generate(self, prompt):
+        if 'llama' in self._llm:
+            prompt += ('\n# Refer to the example python method implementing tasks, '
+                       'now answer this last method implementing task question.')
+        return self._backend.complete(
+            [{"role": "system",
+              "content": "You are a task planning assistant "
+                         "who only answers with python code"},
+             {"role": "user",
+              "content": prompt}],
+            model=self._cfg['engine'](),
+            temperature=self._cfg['temperature'],
+            max_tokens=self._cfg['max_tokens'](),
+            stop=self._stop_tokens,
+            prefix=self._base_prompt,
+        )
+
+    def _fetch_f_src(self, f_sig, gvars):
+        """Return the model answer for `f_sig`, its function library key and whether it was
+        reused from the library.
+
+        Only touches the library, the response cache and the backend, which are all thread
+        safe, so several signatures can be fetched concurrently.
+        """
+        use_query = f'{self._cfg["query_prefix"]}{f_sig}{self._cfg["query_suffix"]}'
+        prompt = f'{self._base_prompt}\n{use_query}'
+
+        # functions generated by the same model for the same signature, callable API and
+        # fgen prompt in an earlier episode or run are reused instead of asking it again
+        library_key, res = None, None
+        if self._function_library is not None:
+            api_names = ' '.join(sorted(k for k, v in gvars.items() if callable(v)))
+            library_key = self._function_library.make_key(
+                self._llm, self._cfg['engine'](), f_sig, text_hash(api_names),
+                text_hash(self._base_prompt))
+            res = self._function_library.lookup(library_key)
+        reused = res is not None
+
+        if not reused:
+            if self._response_cache is None:
+                res = self._generate(prompt)
+            else:
+                cache_key = self._response_cache.make_key(
+                    self._llm, self._cfg['engine'](), self._cfg['temperature'],
+                    self._cfg['max_tokens'](), self._stop_tokens, prompt)
+                res = self._response_cache.get_or_call(cache_key, lambda: self._generate(prompt))
+        return res, library_key, reused
+
+    def _fetch_f_srcs(self, f_sigs, gvars):
+        """Fetch the answers for all `f_sigs` concurrently, in the order of `f_sigs`."""
+        max_workers = min(self._cfg.get('max_workers', 1), len(f_sigs))
+        if max_workers <= 1:
+            return [self._fetch_f_src(f_sig, gvars) for f_sig in f_sigs]
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            return list(pool.map(lambda f_sig: self._fetch_f_src(f_sig, gvars), f_sigs))
 
     def create_f_from_sig(
             self,
@@ -431,143 +582,28 @@ class LMPFGen:
             other_vars=None,
             fix_bugs=False,
             return_src=False,
+            fetched=None,
     ):
         print(f'Creating function: {f_sig}')
-        if self.use_vllm:
-            from vllm import LLM, SamplingParams
 
         use_query = f'{self._cfg["query_prefix"]}{f_sig}{self._cfg["query_suffix"]}'
-        prompt = f'{self._base_prompt}\n{use_query}'
-        while True:
-            try:
-                if 'gpt3' in self._llm:
-                    f_src = openai.ChatCompletion.create(
-                        messages=[{"role": "system",
-                                   "content": "You are a task planning assistant "
-                                              "who only answers with python code"},
-                                  {"role": "user",
-                                   "content": prompt}],
-                        stop=self._stop_tokens,
-                        temperature=self._cfg['temperature'],
-                        model=self._cfg['engine'](),
-                        max_tokens=self._cfg['max_tokens'](),
-                    )['choices'][0]['message']['content'].strip()
-                    break
-                elif 'gpt4' in self._llm:
-                    f_src = openai.ChatCompletion.create(
-                        messages=[{"role": "system",
-                                   "content": "You are a task planning assistant "
-                                              "who only answers with python code"},
-                                  {"role": "user",
-                                   "content": prompt}],
-                        temperature=self._cfg['temperature'],
-                        model=self._cfg['engine'](),
-                        max_tokens=self._cfg['max_tokens'](),
-                    )['choices'][0]['message']['content'].strip()
-                    break
-                elif 'gemini' in self._llm:
-                    gen_model = genai.GenerativeModel(model)
-                    f_src = gen_model.generate_content(prompt)
-                    f_src = f_src.text
-                    break
-                elif 'llama' in self._llm:
-                    prompt += ('\n# Refer to the example python method implementing tasks, '
-                               'now answer this last method implementing task question.')
-                    device = 'cuda'
-                    torch.backends.cuda.enable_mem_efficient_sdp(False)
-                    torch.backends.cuda.enable_flash_sdp(False)
-                    # bitsandbytesconfig = BitsAndBytesConfig(load_in_8bit=True)
-                    # tokenizer = AutoTokenizer.from_pretrained(
-                    #     self._cfg['engine'](),
-                    #     local_files_only=False,
-                    #     device_map="auto",
-                    #     trust_remote_code=True
-                    # )
-                    tokenizer = self.offline_tokenizer
-                    llm_model_inputs = tokenizer.apply_chat_template(
-                        [
-                            {
-                                "role": "system",
-                                "content": "You are a task planning assistant "
-                                           "who only answers with python code."
-                            },
-                            {
-                                "role": "user",
-                                "content": prompt
-                            }
-                        ],
-                        add_generation_prompt=True,
-                        # return_tensors="pt"
-                    )
-                    terminators = [
-                        tokenizer.eos_token_id,
-                        tokenizer.convert_tokens_to_ids("<|eot_id|>")
-                    ]
-                    llm_model = self.offline_model
-                    if not self.use_vllm:
-                        # llm_model = AutoModelForCausalLM.from_pretrained(
-                        #     self._cfg['engine'](),
-                        #     local_files_only=False,
-                        #     device_map="auto",
-                        #     max_memory=self.mem,
-                        #     trust_remote_code=True,
-                        #     torch_dtype=torch.bfloat16,
-                        #     # quantization_config=bitsandbytesconfig,
-                        #     # rope_scaling={'type':'dynamic', 'factor':2},
-                        # )
-                        generated_ids = llm_model.generate(
-                            llm_model_inputs,
-                            max_new_tokens=self._cfg['max_tokens'](),
-                            # stop_strings=self._stop_tokens,
-                            top_p=1.0,
-                            top_k=50,
-                            temperature=0.7 + self._cfg['temperature'],
-                            do_sample=True,
-                            eos_token_id=terminators,
-                            # tokenizer=tokenizer,
-                        )
-                        response = generated_ids[0][llm_model_inputs.shape[-1]:]
-                        f_src = tokenizer.decode(response, skip_special_tokens=True)
-                        break
-                    else:
-                        # Create a sampling params object.
-                        sampling_params = SamplingParams(
-                            temperature=0.8,
-                            top_p=0.95,
-                            top_k=50,
-                            max_tokens=self._cfg['max_tokens'](),
-                            stop_token_ids=terminators,
-                        )
-
-                        # Generate texts from the prompts.
-                        # The output is a list of RequestOutput objects
-                        # that contain the prompt, generated text, and other information.
-                        outputs = llm_model.generate(
-                            prompt_token_ids=llm_model_inputs,
-                            sampling_params=sampling_params
-                        )
-                        # Print the outputs.
-                        assert len(outputs) == 1, "Size of outputs is not 1."
-                        output = outputs[0]
-                        generated_text = output.outputs[0].text
-                        f_src = generated_text
-                        # for output in outputs:
-                        #     prompt = output.prompt
-                        #     generated_text = output.outputs[0].text
-                        #     print(f"Prompt: {prompt!r}, Generated text: {generated_text!r}")
-                        break
-
-            except (RateLimitError, APIConnectionError) as e:
-                print(f'OpenAI API got err {e}')
-                print('Retrying after 10s.')
-                sleep(10)
-
-        res = f_src
+
+        if other_vars is None:
+            other_vars = {}
+        gvars = LayeredVars([self._fixed_vars, self._variable_vars, other_vars])
+
+        if fetched is None:
+            fetched = self._fetch_f_src(f_sig, gvars)
+        res, library_key, reused = fetched
+        if not reused:
+            self.n_generated += 1
+
+        f_src = res
 
         if '```' in f_src:
             f_src = extract_code(f_src)
 
-        if fix_bugs:
+        if fix_bugs and not reused:
             f_src = openai.Edit.create(
                 model='code-davinci-edit-001',
                 input='# ' + f_src,
@@ -578,19 +614,23 @@ class LMPFGen:
                             'Only small changes. No comments.',
             )['choices'][0]['text'].strip()
 
-        if other_vars is None:
-            other_vars = {}
-        gvars = merge_dicts([self._fixed_vars, self._variable_vars, other_vars])
         lvars = {}
 
-        exec_safe(f_src, gvars, lvars)
-
-        f = lvars[f_name]
+        try:
+            exec_safe(f_src, gvars, lvars)
+            f = lvars[f_name]
+        except Exception:
+            if library_key is not None and not reused:
+                self._function_library.store(library_key, f_name, f_sig, f_src, STATUS_FAILED)
+            raise
+        if library_key is not None and not reused:
+            self._function_library.store(library_key, f_name, f_sig, f_src, STATUS_OK)
 
         to_print = highlight(f'{use_query}\n{f_src}', PythonLexer(), TerminalFormatter())
-        print(f'LMP FGEN created:\n\n{to_print}\n')
+        status = 'reused' if reused else 'created'
+        print(f'LMP FGEN {status}:\n\n{to_print}\n')
         global answer
-        answer += f'LLM answer:\n{res}\nLMP FGEN created:\n\n{use_query}\n{f_src}\n'
+        answer += f'LLM answer:\n{res}\nLMP FGEN {status}:\n\n{use_query}\n{f_src}\n'
 
         if return_src:
             return f, f_src
@@ -600,56 +640,84 @@ class LMPFGen:
         if '```' in code_str:
             code_str = extract_code(code_str)
 
-        fs, f_assigns = {}, {}
-        f_parser = FunctionParser(fs, f_assigns)
-        f_parser.visit(ast.parse(code_str))
-        for f_name, f_assign in f_assigns.items():
-            if f_name in fs:
-                fs[f_name] = f_assign
-
         if other_vars is None:
             other_vars = {}
-
-        new_fs = {}
-        srcs = {}
-        for f_name, f_sig in fs.items():
-            all_vars = merge_dicts([self._fixed_vars, self._variable_vars, new_fs, other_vars])
-            if not var_exists(f_name, all_vars):
-                f, f_src = self.create_f_from_sig(
+        all_vars = LayeredVars([self._fixed_vars, self._variable_vars, other_vars])
+
+        # undefined functions and the undefined functions they call form a dependency graph
+        # that is resolved one depth at a time: all functions of a depth are requested from
+        # the model concurrently, then created in parse order, so the result does not depend
+        # on which request finishes first
+        level = [(f_name, f_sig) for f_name, f_sig in parse_function_calls(code_str).items()
+                 if not var_exists(f_name, all_vars)]
+        roots = [f_name for f_name, _ in level]
+        scheduled = set(roots)
+        fs, srcs, calls = {}, {}, {}
+        while level:
+            level_vars = merge_dicts([fs, other_vars])
+            fetched = self._fetch_f_srcs(
+                [f_sig for _, f_sig in level],
+                merge_dicts([self._fixed_vars, self._variable_vars, level_vars]))
+
+            next_level = []
+            for (f_name, f_sig), f_fetched in zip(level, fetched):
+                fs[f_name], srcs[f_name] = self.create_f_from_sig(
                     f_name,
                     f_sig,
-                    new_fs,
+                    level_vars,
                     fix_bugs=fix_bugs,
-                    return_src=True
-                )
-
-                # recursively define child_fs in the function body if needed
-                f_def_body = astunparse.unparse(ast.parse(f_src).body[0].body)
-                child_fs, child_f_srcs = self.create_new_fs_from_code(
-                    f_def_body, other_vars=all_vars, fix_bugs=fix_bugs, return_src=True
+                    return_src=True,
+                    fetched=f_fetched,
                 )
 
-                if len(child_fs) > 0:
-                    new_fs.update(child_fs)
-                    srcs.update(child_f_srcs)
-
-                    # redefine parent f so newly created child_fs are in scope
-                    gvars = merge_dicts(
-                        [self._fixed_vars, self._variable_vars, new_fs, other_vars]
-                    )
-                    lvars = {}
-
-                    exec_safe(f_src, gvars, lvars)
-
-                    f = lvars[f_name]
-
-                new_fs[f_name], srcs[f_name] = f, f_src
+                f_def_body = astunparse.unparse(ast.parse(srcs[f_name]).body[0].body)
+                calls[f_name] = list(parse_function_calls(f_def_body).items())
+                for child_name, child_sig in calls[f_name]:
+                    if child_name not in scheduled and not var_exists(child_name, all_vars):
+                        scheduled.add(child_name)
+                        next_level.append((child_name, child_sig))
+            level = next_level
+
+        # define children before their parents so newly created child_fs are in scope
+        new_fs, visited = {}, set()
+
+        def define(f_name):
+            visited.add(f_name)
+            deps = [child_name for child_name, _ in calls[f_name]
+                    if child_name in fs and child_name != f_name]
+            for child_name in deps:
+                if child_name not in visited:
+                    define(child_name)
+            if len(deps) > 0:
+                gvars = LayeredVars([self._fixed_vars, self._variable_vars, new_fs, other_vars])
+                lvars = {}
+
+                exec_safe(srcs[f_name], gvars, lvars)
+
+                fs[f_name] = lvars[f_name]
+            new_fs[f_name] = fs[f_name]
+
+        for f_name in roots:
+            if f_name not in visited:
+                define(f_name)
+        srcs = {f_name: srcs[f_name] for f_name in new_fs}
 
         if return_src:
             return new_fs, srcs
         return new_fs
 
 
+def parse_function_calls(code_str):
+    """Map the name of every function called in `code_str` to its call signature."""
+    fs, f_assigns = {}, {}
+    f_parser = FunctionParser(fs, f_assigns)
+    f_parser.visit(ast.parse(code_str))
+    for f_name, f_assign in f_assigns.items():
+        if f_name in fs:
+            fs[f_name] = f_assign
+    return fs
+
+
 class FunctionParser(ast.NodeTransformer):
 
     def __init__(self, fs, f_assigns):
@@ -674,7 +742,81 @@ class FunctionParser(ast.NodeTransformer):
         return node
 
 
+class StatementStream:
+    """Splits code arriving in chunks into complete top-level statements.
+
+    The pending code is complete once a following line starts at column zero without
+    continuing it (`else`, `elif`, `except`, `finally`, closing brackets, comments) and
+    it parses. Markdown code fences are dropped, as is anything after the closing one.
+    """
+
+    _continuation = re.compile(r'(else|elif|except|finally)\b|[)\]}#]')
+
+    def __init__(self):
+        self._partial_line = ''
+        self._lines = []
+        self._in_fence = False
+        self._done = False
+
+    def feed(self, chunk):
+        """Add a chunk and return the statements it completed."""
+        *lines, self._partial_line = (self._partial_line + chunk).split('\n')
+        statements = []
+        for line in lines:
+            stmt = self._add_line(line)
+            if stmt is not None:
+                statements.append(stmt)
+        return statements
+
+    def close(self):
+        """Return the remaining statements, the last of which may not parse."""
+        statements = []
+        if self._partial_line:
+            stmt = self._add_line(self._partial_line)
+            if stmt is not None:
+                statements.append(stmt)
+            self._partial_line = ''
+        rest = '\n'.join(self._lines)
+        if rest.strip() != '':
+            statements.append(rest)
+        self._lines = []
+        return statements
+
+    def _add_line(self, line):
+        if self._done:
+            return None
+        if line.lstrip().startswith('```'):
+            if self._in_fence:
+                self._done = True
+            else:
+                # text in front of the opening fence is not code
+                self._lines = []
+            self._in_fence = not self._in_fence
+            return None
+
+        stmt = None
+        if (self._lines and line[:1].strip() != ''
+                and not self._continuation.match(line)):
+            # trailing comments and blank lines stay with the next statement
+            n = len(self._lines)
+            while n > 0 and (self._lines[n - 1].strip() == '' or self._lines[n - 1][:1] == '#'):
+                n -= 1
+            pending = '\n'.join(self._lines[:n])
+            try:
+                if ast.parse(pending).body:
+                    stmt, self._lines = pending, self._lines[n:]
+            except SyntaxError:
+                pass
+        self._lines.append(line)
+        return stmt
+
+
 def var_exists(name, all_vars):
+    if name in all_vars or hasattr(builtins, name):
+        return True
+    if name.isidentifier():
+        return False
+    # dotted names and other expressions
     try:
         eval(name, all_vars)
     except:
@@ -692,7 +834,56 @@ def merge_dicts(dicts):
     }
 
 
-def exec_safe(code_str, gvars=None, lvars=None):
+class LayeredVars(dict):
+    """Read-through view of `dicts` that can be passed to `exec` as globals.
+
+    Like `merge_dicts`, later dicts shadow earlier ones, but nothing is copied: lookups
+    go through the layers, so they see later changes to them. Items written by the
+    executed code are stored on the view itself and shadow all layers.
+    """
+
+    def __init__(self, dicts):
+        super().__init__()
+        self.layers = list(dicts)
+
+    def __missing__(self, key):
+        for d in reversed(self.layers):
+            if key in d:
+                return d[key]
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return super().__contains__(key) or any(key in d for d in self.layers)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def merged(self):
+        """Flat copy of all visible items."""
+        return merge_dicts([merge_dicts(self.layers), dict(super().items())])
+
+    def keys(self):
+        return self.merged().keys()
+
+    def items(self):
+        return self.merged().items()
+
+    def values(self):
+        return self.merged().values()
+
+    def __iter__(self):
+        return iter(self.merged())
+
+    def __len__(self):
+        return len(self.merged())
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_code(code_str):
+    """Clean up and compile LLM code; compiled code objects are cached by source."""
     if '```' in code_str:
         code_str = extract_code(code_str)
 
@@ -701,17 +892,30 @@ def exec_safe(code_str, gvars=None, lvars=None):
         code_str = import_pattern.sub('', code_str).strip()
     assert '__' not in code_str
 
+    # every loop iteration checks the running watchdogs, so generated code can't spin
+    # forever without calling an API
+    tree = ast.parse(code_str)
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.For, ast.While, ast.AsyncFor)):
+            node.body.insert(0, ast.Expr(ast.Call(ast.Name('_watchdog_tick', ast.Load()), [], [])))
+    ast.fix_missing_locations(tree)
+    return compile(tree, '<string>', 'exec')
+
+
+_empty_fn = lambda *args, **kwargs: None
+_exec_overrides = {'exec': _empty_fn, 'eval': _empty_fn, '_watchdog_tick': watchdog.tick}
+
+
+def exec_safe(code_str, gvars=None, lvars=None):
+    code = compile_code(code_str)
+
     if gvars is None:
         gvars = {}
     if lvars is None:
         lvars = {}
-    empty_fn = lambda *args, **kwargs: None
-    custom_gvars = merge_dicts([
-        gvars,
-        {'exec': empty_fn, 'eval': empty_fn}
-    ])
-    # print(f'THE CODE STRING IS\n{code_str}\nEND')
-    exec(code_str, custom_gvars, lvars)
+    custom_gvars = LayeredVars([gvars, _exec_overrides])
+    # top-level code looks names up in the locals, functions defined by it in the globals
+    exec(code, custom_gvars, collections.ChainMap(lvars, custom_gvars))
 
 
 def extract_code(res):
@@ -741,6 +945,9 @@ def extract_code(res):
     return code_string
 
 
+EXECUTION_MODES = ('pickplace', 'teleport')
+
+
 class LMP_wrapper():
 
     def __init__(self, env, cfg, render=False):
@@ -754,6 +961,103 @@ class LMP_wrapper():
 
         self._table_z = self._cfg['env']['coords']['table_z']
         self.render = render
+        self._execution = self._cfg.get('execution', {'mode': 'pickplace'})
+        self._free_space = None  # (key, FreeSpaceRaster) of the last free position query
+        self._world_step = 0  # bumped whenever the wrapper steps or resets the simulation
+        self._world = None
+        self._spatial_index = SpatialIndex()
+        self._index_step = None  # world step the spatial index was last updated at
+        self.n_index_updates = 0  # bounding boxes read to maintain the spatial index
+        self._name_index = ObjectNameIndex()
+        self.action_timings = []  # per-action records of the action queues run
+
+    def set_env(self, env):
+        """Bind the wrapper to `env` after its reset, for a new episode."""
+        self.env = env
+        self.object_names = env.object_list
+        self._cfg['env']['init_objs'] = env.object_list
+        self._spatial_index = SpatialIndex()
+        self.n_index_updates = 0
+        self.action_timings = []
+        self.invalidate_world()
+
+    @property
+    def world(self):
+        """`WorldSnapshot` of the current simulation step, serving the object queries."""
+        if self._world is None or self._world.step != self._world_step:
+            self._world = WorldSnapshot(self.env, self._world_step)
+        return self._world
+
+    def invalidate_world(self):
+        """Mark the world as changed, e.g. after stepping `env` outside the wrapper."""
+        self._world_step += 1
+
+    @property
+    def spatial_index(self):
+        """`SpatialIndex` of the object footprints. After every simulation step the
+        bounding box of each object is read again, so objects pushed or knocked anywhere
+        on the table are followed; only the footprints that changed update the R-tree."""
+        if self._index_step != self._world_step:
+            names = self.get_obj_names()
+            for obj in names:
+                bbox = self.get_two_bbox(obj)
+                self._spatial_index.update(obj, (bbox[0], bbox[1], bbox[3], bbox[4]))
+            self.n_index_updates += len(names)
+            for obj in set(self._spatial_index) - set(names):
+                self._spatial_index.remove(obj)
+            self._index_step = self._world_step
+        return self._spatial_index
+
+    def step(self, action):
+        watchdog.tick(actions=1)
+        try:
+            if self._execution['mode'] == 'teleport':
+                return self._teleport(action)
+            return self.env.step(action=action)
+        finally:
+            self.invalidate_world()
+
+    def _body_under(self, xy, exclude=None, obj_types=('rigid',)):
+        # (body id, top z) of the highest body whose AABB contains the xy position
+        top = (None, self._table_z)
+        for obj_type in obj_types:
+            for body in self.env.obj_ids[obj_type]:
+                if body == exclude:
+                    continue
+                aabb_min, aabb_max = p.getAABB(body)
+                if (aabb_min[0] - 0.005 <= xy[0] <= aabb_max[0] + 0.005 and
+                        aabb_min[1] - 0.005 <= xy[1] <= aabb_max[1] + 0.005 and
+                        aabb_max[2] > top[1]):
+                    top = (body, aabb_max[2])
+        return top
+
+    def _teleport(self, action):
+        # kinematic stand-in for the PickPlace primitive: move the body under the pick
+        # position onto whatever is under the place position and let it settle
+        (pick_pos, _), (place_pos, place_rot) = action['pose0'], action['pose1']
+        body, _ = self._body_under(pick_pos)
+        if body is not None:
+            _, support_z = self._body_under(place_pos, exclude=body, obj_types=('fixed', 'rigid'))
+            base_pos, _ = p.getBasePositionAndOrientation(body)
+            base_above_bottom = base_pos[2] - p.getAABB(body)[0][2]
+            p.resetBasePositionAndOrientation(
+                body, (place_pos[0], place_pos[1], support_z + base_above_bottom + 0.002),
+                place_rot)
+            p.resetBaseVelocity(body, (0, 0, 0), (0, 0, 0))
+            self.invalidate_world()
+            for _ in range(self._execution['settle_steps']):
+                self.step_simulation()
+        return self.env.task.reward()
+
+    def step_simulation(self):
+        watchdog.tick(sim_steps=1)
+        self.invalidate_world()
+        self.env.step_simulation()
+
+    @property
+    def name_index(self):
+        """`ObjectNameIndex` of the current object names, including newly added objects."""
+        return self._name_index.sync(self.object_names)
 
     def is_obj_visible(self, obj_name):
 
@@ -763,16 +1067,39 @@ class LMP_wrapper():
         np.random.seed(self.env._seed)
         random.seed(self.env._seed)
         self.env.reset()
+        self.invalidate_world()
+
+    def snapshot(self):
+        """Save the simulation and task state, see `sim_snapshot.snapshot`."""
+        return sim_snapshot.snapshot(self.env)
+
+    def restore(self, snap):
+        """Roll the episode back to a `snapshot`."""
+        sim_snapshot.restore(self.env, snap)
+        self.invalidate_world()
+
+    def discard(self, snap):
+        sim_snapshot.discard(snap)
+
+    def check_scene(self, margin=0.05):
+        """Cheap plausibility check of the scene: every object is still above the table
+        and within `margin` of the workspace."""
+        x_min, y_min = self._cfg['env']['coords']['top_left']
+        x_max, y_max = self._cfg['env']['coords']['bottom_right']
+        for obj in self.get_obj_names():
+            x, y, z = np.asarray(self.get_obj_pos(obj)[0], dtype=float)[:3]
+            if not (x_min - margin <= x <= x_max + margin and y_min - margin <= y <= y_max + margin
+                    and z >= self._table_z - margin):
+                return False
+        return True
 
     def get_obj_names(self, id=None):
         if not id:
             return self.object_names[::]
         elif isinstance(id, int):
-            for s in self.object_names[::]:
-                parts = s.split()  # Split the string by spaces
-                if parts and parts[-1].isdigit():  # Check if the last part is a number
-                    if int(parts[-1]) == id:
-                        return [s]  # Return the matching string        
+            # the first name ending with the id
+            if id in self.name_index.by_id:
+                return [self.name_index.by_id[id]]
             raise ValueError(f'no matching obj with id {id}')
         elif isinstance(id, (str, np.str_)):
             return [id]
@@ -815,11 +1142,11 @@ class LMP_wrapper():
 
     def get_obj_pos(self, obj_name, count=1):
         # return the xy position of the object in robot base frame. YHH: Why only xy position?
-        return self.env.get_obj_pos(obj_name, count)  # [:2]
+        return self.world.get_obj_pos(obj_name, count)  # [:2]
 
     def get_obj_rot(self, obj_name, count=1):
 
-        return self.env.get_obj_rot(obj_name, count)
+        return self.world.get_obj_rot(obj_name, count)
 
     def get_obj_positions_np(self, objects):
         if all(type(obj) == int for obj in objects) or all(
@@ -883,20 +1210,11 @@ class LMP_wrapper():
     def get_bbox(self, obj_name):
         # return the axis-aligned object bounding box in robot base frame (not in pixels)
         # the format is (min_x, min_y, max_x, max_y)
-        is_zone = False
-        is_pallet = False
-        scale = 1
         if isinstance(obj_name, (list, np.ndarray, tuple)):
             obj_name = obj_name[0]
-        if 'scaled' in self.get_obj_names(obj_name)[0]:
-            pattern = r'(\d+(\.\d+)?)x'
-            match = re.search(pattern, obj_name)
-            scale = float(match.group(1)) if match else 1
-        if 'zone' in self.get_obj_names(obj_name)[0]:
-            is_zone = True
-        if 'pallet' in self.get_obj_names(obj_name)[0]:
-            is_pallet = True
-        bbox = self.env.get_bounding_box(obj_name)
+        name = describe(self.get_obj_names(obj_name)[0])
+        scale, is_zone, is_pallet = name.scale, name.is_zone, name.is_pallet
+        bbox = self.world.get_bounding_box(obj_name)
         size_x = bbox[3] - bbox[0]
         size_y = bbox[4] - bbox[1]
         size_z = bbox[5] - bbox[2]
@@ -909,10 +1227,12 @@ class LMP_wrapper():
     def get_two_bbox(self, obj_name):
         if isinstance(obj_name, (list, np.ndarray, tuple)):
             obj_name = obj_name[0]
-        bbox = self.env.get_bounding_box(obj_name)
+        bbox = self.world.get_bounding_box(obj_name)
         return bbox
 
     def get_color(self, obj_name):
+        if isinstance(obj_name, (str, np.str_)):
+            return describe(obj_name).color
         for color, rgb in utils.COLORS.items():
             if color in obj_name:
                 return rgb
@@ -920,7 +1240,20 @@ class LMP_wrapper():
     def pick_place(self, obj, place):
         pick_pos = self.get_obj_pos(obj)[0]
         pick_rot = self.get_obj_rot(obj)[0]
-        self.env.step(action={'pose0': (pick_pos, pick_rot), 'pose1': place})
+        self.step(action={'pose0': (pick_pos, pick_rot), 'pose1': place})
+
+    def to_pose(self, arg):
+        # pick or place pose of an object name or id, a 2D or 3D position or a pos_rot
+        if isinstance(arg, (str, int, np.str_)):
+            return (self.get_obj_pos(arg)[0], self.get_obj_rot(arg)[0])
+        pos = list(arg)
+        if isinstance(pos[0], (list, tuple, np.ndarray)):
+            return arg
+        if len(pos) == 2:
+            return ((pos[0], pos[1], 0), (0, 0, 0, 1))
+        if len(pos) == 3:
+            return ((pos[0], pos[1], pos[2]), (0, 0, 0, 1))
+        raise ValueError('position must be 2D or 3D')
 
     def put_first_on_second(self, arg1, arg2):
         # put the object with obj_name on top of target
@@ -928,49 +1261,23 @@ class LMP_wrapper():
         if not arg1 or not arg2:
             print('missing argument')
             return
-        if isinstance(arg1, (str, int, np.str_)):
-            pick_pos = (self.get_obj_pos(arg1)[0], self.get_obj_rot(arg1)[0])
-        else:
-            pick = list(arg1)
-            if not isinstance(pick[0], (list, tuple, np.ndarray)):
-                if len(pick) == 2:
-                    pick_pos = ((pick[0], pick[1], 0), (0, 0, 0, 1))
-                elif len(pick) == 3:
-                    pick_pos = ((pick[0], pick[1], pick[2]), (0, 0, 0, 1))
-            else:
-                pick_pos = arg1
-
-        if isinstance(arg2, (str, int, np.str_)):
-            place_pos = (self.get_obj_pos(arg2)[0], self.get_obj_rot(arg2)[0])
-        else:
-            place = list(arg2)
-            if not isinstance(place[0], (list, tuple, np.ndarray)):
-                if len(place) == 2:
-                    place_pos = ((place[0], place[1], 0), (0, 0, 0, 1))
-                elif len(place) == 3:
-                    place_pos = ((place[0], place[1], place[2]), (0, 0, 0, 1))
-            else:
-                place_pos = arg2
-        self.env.step(action={'pose0': pick_pos, 'pose1': place_pos})
+        self.step(action={'pose0': self.to_pose(arg1), 'pose1': self.to_pose(arg2)})
 
     def stack_objects_in_order(self, object_names, targ=None):
         if not object_names:
             return
-        if not targ:
-            if not isinstance(object_names, (list, tuple, np.ndarray)):
-                object_names = [object_names]
-            for i in range(len(object_names) - 1):
-                self.put_first_on_second(object_names[i + 1], object_names[i])
-        else:
-            if not isinstance(object_names, (list, tuple, np.ndarray)):
-                object_names = [object_names]
-            self.put_first_on_second(object_names[0], targ)
-            for i in range(len(object_names) - 1):
-                self.put_first_on_second(object_names[i + 1], object_names[i])
+        if not isinstance(object_names, (list, tuple, np.ndarray)):
+            object_names = [object_names]
+        queue = ActionQueue(self)
+        if targ:
+            queue.add(object_names[0], targ)
+        for i in range(len(object_names) - 1):
+            queue.add(object_names[i + 1], object_names[i])
+        self.action_timings.extend(queue.run())
 
     def is_target_occupied(self, targ, r=0.02):
 
-        search_range = self.get_obj_names()
+        targ_obj = None
         if isinstance(targ, (list, tuple, np.ndarray)):
             if isinstance(targ[0], (list, tuple, np.ndarray)):
                 targ = targ[0]
@@ -980,47 +1287,46 @@ class LMP_wrapper():
                 raise ValueError("Target position must be either 2D or 3D.")
         elif isinstance(targ, (int, str, np.str_)):
             targ_obj = self.get_obj_names(targ)[0]
-            if targ_obj in search_range:
-                search_range.remove(targ_obj)
             x, y, _ = self.get_bbox(targ)
             r = 0.5 * np.linalg.norm([x, y])
             targ = self.get_obj_pos(targ)[0]
             targ = np.array(targ)[:2]  # force to check in 2d
-            dim = len(targ)
         else:
             raise ValueError("Target must be only one position, id, or name.")
 
-        # Define the center of the circle/sphere
-        center = np.array(targ)
-        occupied_objects = []
-
-        for obj in search_range:
-            # Get the bounding box of the object
-            bbox = self.get_two_bbox(obj)
-
-            # Extract bounding box coordinates
-            if dim == 2:
-                x_min, y_min, _, x_max, y_max, _ = bbox
-                closest_point = np.array([
-                    np.clip(center[0], x_min, x_max),
-                    np.clip(center[1], y_min, y_max)
-                ])
-            elif dim == 3:
-                x_min, y_min, z_min, x_max, y_max, z_max = bbox
-                closest_point = np.array([
-                    np.clip(center[0], x_min, x_max),
-                    np.clip(center[1], y_min, y_max),
-                    np.clip(center[2], z_min, z_max)
-                ])
-
-            # Calculate the distance from the center to the closest point on the bounding box
-            distance_to_bbox = distance.euclidean(center, closest_point)
-
-            # Check if this distance is less than or equal to the radius
-            if distance_to_bbox <= r:
-                occupied_objects.append(obj)
-
-        return occupied_objects
+        # Objects whose bounding box is within r of the target, from the spatial index
+        occupied_objects = self.spatial_index.objects_near(targ, r)
+        return [obj for obj in occupied_objects if obj != targ_obj]
+
+    def _resolve_query_point(self, targ):
+        # xy position of a position, pos_rot or object, and the object itself if any
+        if isinstance(targ, (int, str, np.str_)):
+            obj = self.get_obj_names(targ)[0]
+            return np.array(self.get_obj_pos(targ)[0], dtype=float)[:2], obj
+        if isinstance(targ[0], (list, tuple, np.ndarray)):
+            targ = targ[0]
+        return np.array(targ, dtype=float)[:2], None
+
+    def objects_near(self, targ, r=0.05):
+        # names of the objects whose bounding box is within r of a position or another object
+        point, obj = self._resolve_query_point(targ)
+        return [name for name in self.spatial_index.objects_near(point, r) if name != obj]
+
+    def overlapping(self, bbox):
+        # names of the objects whose bounding box intersects (min_x, min_y, max_x, max_y),
+        # or the bounding box of another object
+        obj = None
+        if isinstance(bbox, (int, str, np.str_)):
+            obj = self.get_obj_names(bbox)[0]
+            x_min, y_min, _, x_max, y_max, _ = self.get_two_bbox(obj)
+            bbox = (x_min, y_min, x_max, y_max)
+        return [name for name in self.spatial_index.overlapping(bbox) if name != obj]
+
+    def nearest(self, targ, k=1):
+        # names of the k objects closest to a position or another object
+        point, obj = self._resolve_query_point(targ)
+        names = self.spatial_index.nearest(point, k + (obj is not None))
+        return [name for name in names if name != obj][:k]
 
     def get_random_free_pos(self, targ=None, r=0.02, search_area=None, grid_size=0.002):
         # local function to convert item of listed-targ 
@@ -1092,34 +1398,41 @@ class LMP_wrapper():
         # Generate a grid of potential positions
         x_coords = np.arange(x_min, x_max, grid_size)
         y_coords = np.arange(y_min, y_max, grid_size)
-        potential_positions = [(x, y, 0.001) for x in x_coords for y in y_coords]
+        grid_x, grid_y = np.meshgrid(x_coords, y_coords, indexing='ij')
+        free = np.ones(grid_x.shape, dtype=bool)
 
         # Remove positions that are too close to the target
         for sub_targ in targ:
             if isinstance(sub_targ, tuple):
-                potential_positions = [
-                    pos for pos in potential_positions
-                    if np.linalg.norm(np.array(pos) - np.array(sub_targ[0])) > sub_targ[1]
-                ]
+                center, radius = np.array(sub_targ[0], dtype=float), sub_targ[1]
             else:
-                potential_positions = [
-                    pos for pos in potential_positions
-                    if np.linalg.norm(np.array(pos) - np.array(sub_targ)) > r
-                ]
-
-        # Remove positions that are occupied by objects
-        free_positions = [
-            pos for pos in potential_positions
-            if not self.is_target_occupied(pos, r)
-        ]
+                center, radius = np.array(sub_targ, dtype=float), r
+            free &= np.sqrt((grid_x - center[0]) ** 2 + (grid_y - center[1]) ** 2
+                            + (0.001 - center[2]) ** 2) > radius
+
+        # Remove positions that are occupied by objects, same test as `is_target_occupied`
+        free &= self.get_free_space(x_coords, y_coords, grid_size, r).free_mask(r)
 
-        if not free_positions:
+        free_idx = np.flatnonzero(free)
+        if len(free_idx) == 0:
             print('no suitable position')
             return None  # No free position found
 
         # Randomly select a free position
-        pos = random.choice(free_positions)
-        return [list(pos), [0, 0, 0, 1]]
+        ix, iy = np.unravel_index(free_idx[random.randrange(len(free_idx))], free.shape)
+        return [[x_coords[ix], y_coords[iy], 0.001], [0, 0, 0, 1]]
+
+    def get_free_space(self, x_coords, y_coords, grid_size, r):
+        """Free-space raster of the current object footprints on the given grid, reused
+        while neither the footprints nor the grid change."""
+        footprints = np.array([np.asarray(self.get_two_bbox(obj), dtype=float)[[0, 1, 3, 4]]
+                               for obj in self.get_obj_names()]).reshape(-1, 4)
+        pad = int(np.ceil(r / grid_size)) + 2
+        key = (footprints.tobytes(), x_coords.tobytes(), y_coords.tobytes(), grid_size, pad)
+        if self._free_space is None or self._free_space[0] != key:
+            self._free_space = (key, FreeSpaceRaster(x_coords, y_coords, grid_size, footprints,
+                                                     pad=pad))
+        return self._free_space[1]
 
     def get_robot_pos(self):
         # return robot end-effector xy position in robot base frame
@@ -1137,7 +1450,7 @@ class LMP_wrapper():
             position_xyz = position
         while np.linalg.norm(position_xyz - ee_xyz) > 0.01:
             self.env.movep(position_xyz)
-            self.env.step_simulation()
+            self.step_simulation()
             ee_xyz = self.env.get_ee_pos()
 
     def follow_traj(self, traj):
@@ -1180,6 +1493,97 @@ class LMP_wrapper():
         return ['top side', 'right side', 'bottom side', 'left side'][side_idx]
 
 
+class ActionQueue:
+    """Pick-and-place intents of a multi-object primitive, executed in order.
+
+    The poses of all intents are resolved before the first action, predicting where
+    each placed object comes to rest: at the place xy, on top of the object it is placed
+    on (or on the table, or at the given height of a position), from the bounding boxes
+    observed up front. Later intents that move it or place on it thus need no new
+    observation. After an action whose object is used again, a settle check compares
+    the object's observed position with the predicted one. Only a drift beyond `tol` (m)
+    makes the queue resolve the remaining intents again from observations.
+    """
+
+    def __init__(self, lmp_env, tol=0.01):
+        self.lmp_env = lmp_env
+        self.tol = tol
+        self.intents = []  # (pick, place) as accepted by `put_first_on_second`
+
+    def add(self, pick, place):
+        self.intents.append((pick, place))
+
+    def _name(self, arg):
+        if isinstance(arg, (str, int, np.str_)):
+            return self.lmp_env.get_obj_names(arg)[0]
+        return None
+
+    def _extent(self, name):
+        # z extent of an object below and above its position, unchanged when it is moved
+        z = float(self.lmp_env.get_obj_pos(name)[0][2])
+        bbox = self.lmp_env.get_two_bbox(name)
+        return z - bbox[2], bbox[5] - z
+
+    def _resting_pose(self, pick_name, place_name, place_pose):
+        (x, y, z), rot = place_pose[0], place_pose[1]
+        below, _ = self._extent(pick_name)
+        if place_name is None:
+            z = max(z, self.lmp_env._table_z + below)
+        else:
+            z = z + self._extent(place_name)[1] + below
+        return ((x, y, z), rot)
+
+    def _resolve(self, intents):
+        placed = {}  # object name -> predicted resting pose after an earlier intent
+        poses = []
+        for pick, place in intents:
+            pick_name, place_name = self._name(pick), self._name(place)
+            pick_pose = placed[pick_name] if pick_name in placed else self.lmp_env.to_pose(pick)
+            place_pose = (placed[place_name] if place_name in placed
+                          else self.lmp_env.to_pose(place))
+            if pick_name is not None:
+                placed[pick_name] = self._resting_pose(pick_name, place_name, place_pose)
+            poses.append((pick_name, place_name, pick_pose, place_pose, placed.get(pick_name)))
+        return poses
+
+    def run(self):
+        """Execute and clear the queued intents.
+
+        Returns one record per action with its times in seconds: `resolve` for resolving
+        poses up front (first action only), `step` for the pick-and-place and `settle`
+        for the settle check, including any new resolution. `drift` is None when the
+        check was skipped.
+        """
+        intents, self.intents = self.intents, []
+        start = time.perf_counter()
+        plan = self._resolve(intents)
+        resolve_time = time.perf_counter() - start
+
+        records = []
+        for i, (pick_name, _, pick_pose, place_pose, rest_pose) in enumerate(plan):
+            start = time.perf_counter()
+            self.lmp_env.step(action={'pose0': pick_pose, 'pose1': place_pose})
+            settle_start = time.perf_counter()
+
+            drift, resolved = None, False
+            if pick_name is not None and any(pick_name in names[:2] for names in plan[i + 1:]):
+                pos = np.asarray(self.lmp_env.get_obj_pos(pick_name)[0], dtype=float)
+                drift = float(np.linalg.norm(pos - np.asarray(rest_pose[0], dtype=float)))
+                if drift > self.tol:
+                    plan[i + 1:] = self._resolve(intents[i + 1:])
+                    resolved = True
+            records.append({
+                'pick': intents[i][0],
+                'place': intents[i][1],
+                'resolve': resolve_time if i == 0 else 0.,
+                'step': settle_start - start,
+                'settle': time.perf_counter() - settle_start,
+                'drift': drift,
+                'resolved': resolved,
+            })
+        return records
+
+
 def set_llm_model(llm_model_name):
     """ globally set llm-model"""
     global model
@@ -1229,88 +1633,374 @@ def check_obj():
     return object_ids
 
 
-def setup_LMP(env, cfg_tabletop, llm='gpt4',
-              offline_model=None, offline_tokenizer=None, use_vllm=False):
-    """
-    Use the same LLM model for both LMP and LMPFGen.
-    If using different LLMs for them,
-    two offline loaded models should be passed to the function setup_LMP.
+class LMPSession:
+    """The LMP stack, built once and reused across episodes.
+
+    Construction creates the env wrapper, the API var dicts and every LMP, LMPFGen and
+    LMPV object. `reset(env)` only rebinds the environment and clears the per-episode
+    state: functions generated by LMPFGen, exec histories and per-episode counters.
+    Use the same LLM backend for both LMP and LMPFGen. If using different LLMs for them,
+    two backends should be passed to the LMPSession.
     """
-    # LMP env wrapper
-    cfg_tabletop = copy.deepcopy(cfg_tabletop)
-    cfg_tabletop['env'] = dict()
-    cfg_tabletop['env']['init_objs'] = env.object_list
-    cfg_tabletop['env']['coords'] = lmp_tabletop_coords
-    cfg_tabletop['llm'] = llm
-    LMP_env = LMP_wrapper(env, cfg_tabletop)
-    # creating APIs that the LMPs can interact with
-    fixed_vars = {
-        'np': np,
-        'utils': utils,
-        'itertools': itertools
-    }
-    fixed_vars.update({
-        name: getattr(shapely.geometry, name)
-        for name in shapely.geometry.__all__
-    })
-
-    fixed_vars.update({
-        name: getattr(shapely.affinity, name)
-        for name in shapely.affinity.__all__
-    })
-    variable_vars = {
-        k: getattr(LMP_env, k)
-        for k in [
-            'get_bbox', 'get_obj_pos', 'get_color', 'is_obj_visible', 'denormalize_xy',
-            'put_first_on_second', 'get_obj_names', 'get_obj_rot', 'get_obj_positions_np',
-            'get_corner_name', 'get_side_name', 'get_obj_rotations_np', 'goto_pos',
-            'is_target_occupied', 'get_random_free_pos', 'stack_objects_in_order',
-            'get_obj_pos_dict', 'denormalize_bbox', 'reset',
-        ]
-    }
-    variable_vars['say'] = say
-
-    # creating the function-generating LMP
-    lmp_fgen = LMPFGen(
-        (cfg_tabletop['lmps']['fgen'], cfg_tabletop['llm']),
-        fixed_vars,
-        variable_vars,
-        offline_model=offline_model,
-        offline_tokenizer=offline_tokenizer,
-        use_vllm=use_vllm,
-    )
 
-    # creating other low-level LMPs
-    variable_vars.update({
-        k: LMP(
-            k,
-            (cfg_tabletop['lmps'][k], cfg_tabletop['llm']),
-            lmp_fgen,
-            fixed_vars,
-            variable_vars,
-            offline_model=offline_model,
-            offline_tokenizer=offline_tokenizer,
-            use_vllm=use_vllm,
+    def __init__(self, cfg_tabletop, llm='gpt4', backend=None, vlm_backend=None,
+                 response_cache=None, function_library=None):
+        if backend is None:
+            backend = make_backend(llm)
+        # LMP env wrapper, bound to an environment by `reset`
+        cfg_tabletop = copy.deepcopy(cfg_tabletop)
+        cfg_tabletop['env'] = dict()
+        cfg_tabletop['env']['init_objs'] = []
+        cfg_tabletop['env']['coords'] = lmp_tabletop_coords
+        cfg_tabletop['llm'] = llm
+        self.lmp_env = LMP_wrapper(None, cfg_tabletop)
+        # creating APIs that the LMPs can interact with
+        self.fixed_vars = {
+            'np': np,
+            'utils': utils,
+            'itertools': itertools
+        }
+        self.fixed_vars.update({
+            name: getattr(shapely.geometry, name)
+            for name in shapely.geometry.__all__
+        })
+
+        self.fixed_vars.update({
+            name: getattr(shapely.affinity, name)
+            for name in shapely.affinity.__all__
+        })
+        self.variable_vars = {
+            k: watchdog.counted(getattr(self.lmp_env, k))
+            for k in [
+                'get_bbox', 'get_obj_pos', 'get_color', 'is_obj_visible', 'denormalize_xy',
+                'put_first_on_second', 'get_obj_names', 'get_obj_rot', 'get_obj_positions_np',
+                'get_corner_name', 'get_side_name', 'get_obj_rotations_np', 'goto_pos',
+                'is_target_occupied', 'get_random_free_pos', 'stack_objects_in_order',
+                'get_obj_pos_dict', 'denormalize_bbox', 'reset', 'objects_near', 'overlapping',
+                'nearest',
+            ]
+        }
+        self.variable_vars['say'] = say
+
+        # creating the function-generating LMP
+        self.lmp_fgen = LMPFGen(
+            (cfg_tabletop['lmps']['fgen'], cfg_tabletop['llm']),
+            self.fixed_vars,
+            self.variable_vars,
+            backend=backend,
+            response_cache=response_cache,
+            function_library=function_library,
         )
-        for k in [
-            'parse_obj_name', 'parse_position',
-            'parse_question', 'transform_shape_pts', 'parse_completion'
-        ]
-    })
-
-    # creating the LMP that deals w/ high-level language commands
-    lmp_tabletop_ui = LMP(
-        'tabletop_ui',
-        (cfg_tabletop['lmps']['tabletop_ui'], cfg_tabletop['llm']),
-        lmp_fgen,
-        fixed_vars,
-        variable_vars,
-        offline_model=offline_model,
-        offline_tokenizer=offline_tokenizer,
-        use_vllm=use_vllm,
+
+        # creating other low-level LMPs
+        self.lmps = {
+            k: LMP(
+                k,
+                (cfg_tabletop['lmps'][k], cfg_tabletop['llm']),
+                self.lmp_fgen,
+                self.fixed_vars,
+                self.variable_vars,
+                backend=backend,
+                response_cache=response_cache,
+            )
+            for k in [
+                'parse_obj_name', 'parse_position',
+                'parse_question', 'transform_shape_pts', 'parse_completion'
+            ]
+        }
+        self.variable_vars.update(self.lmps)
+
+        # creating the LMP that deals w/ high-level language commands
+        self.lmp_tabletop_ui = LMP(
+            'tabletop_ui',
+            (cfg_tabletop['lmps']['tabletop_ui'], cfg_tabletop['llm']),
+            self.lmp_fgen,
+            self.fixed_vars,
+            self.variable_vars,
+            backend=backend,
+            response_cache=response_cache,
+            sandbox=self.lmp_env,
+            watchdog=watchdog.Watchdog(**cfg_tabletop.get('watchdog', {})),
+        )
+
+        # the completion checker always runs on GPT-4 vision
+        self.lmp_check = None
+        if vlm_backend is not None:
+            self.lmp_check = LMPV(
+                'VLM_ui',
+                (cfg_tabletop['lmps']['VLM'], 'gpt4'),
+                vlm_backend,
+                response_cache=response_cache,
+            )
+
+        self._api_vars = dict(self.variable_vars)
+
+    def reset(self, env):
+        """Start an episode on `env`, which must already be reset, and return the
+        high-level LMP."""
+        self.lmp_env.set_env(env)
+        self.variable_vars.clear()
+        self.variable_vars.update(self._api_vars)
+        for lmp in [self.lmp_tabletop_ui, self.lmp_check, *self.lmps.values()]:
+            if lmp is not None:
+                lmp.clear_exec_hist()
+                lmp.prompt_tokens.clear()
+        self.lmp_fgen.n_generated = 0
+        return self.lmp_tabletop_ui
+
+
+def setup_LMP(env, cfg_tabletop, llm='gpt4', backend=None, response_cache=None,
+              function_library=None):
+    """Build a one-off `LMPSession` on `env` and return its high-level LMP."""
+    session = LMPSession(cfg_tabletop, llm, backend=backend, response_cache=response_cache,
+                         function_library=function_library)
+    return session.reset(env)
+
+
+def configure_lmps(cfg):
+    """Apply the LMP options of cfg/dahlia.yaml to `cfg_tabletop`."""
+    cfg_tabletop['lmps']['tabletop_ui']['stream'] = cfg['llm_stream']
+    cfg_tabletop['lmps']['tabletop_ui'].update(
+        n_candidates=cfg['candidates']['n'],
+        candidate_temperature=cfg['candidates']['temperature'],
+        candidate_max_steps=cfg['candidates']['max_steps'],
+        candidate_timeout=cfg['candidates']['timeout'],
     )
+    if cfg['execution']['mode'] not in EXECUTION_MODES:
+        raise ValueError(f'execution mode must be in {EXECUTION_MODES}, '
+                         f'got {cfg["execution"]["mode"]}')
+    cfg_tabletop['execution'] = dict(cfg['execution'])
+    cfg_tabletop['watchdog'] = dict(cfg['watchdog'])
+    cfg_tabletop['lmps']['VLM'].update(image_max_side=cfg['vlm_images']['max_side'],
+                                       image_workers=cfg['vlm_images']['workers'])
+    for lmp_cfg in cfg_tabletop['lmps'].values():
+        if lmp_cfg['maintain_session']:
+            lmp_cfg['history_max_tokens'] = cfg['session_history']['max_tokens']
+            lmp_cfg['history_policy'] = cfg['session_history']['policy']
+
+
+def test_answer_path(data_path, cfg, seed):
+    return os.path.join(
+        data_path,
+        'answers',
+        f'{seed:06d}_{cfg["gpt_model"]}_{cfg["llama_model_name"]}_test'
+        f'{"_check" if cfg["check"] else ""}.txt'
+    )
+
+
+def write_atomic(file_path, text):
+    """Write to a temporary file next to `file_path`, then rename it into place."""
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    tmp_path = f'{file_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        file.write(text)
+    os.replace(tmp_path, file_path)
+
+
+def run_test_episode(env, cfg, llm, seed, session):
+    """Roll out the LLM policy of the `LMPSession` on the test episode of `seed`.
+
+    Returns a dict with the seed, whether the task is done, the total reward, the number
+    of functions LMPFGen asked the model for and the episode log that is stored as the
+    answer file.
+    """
+    global answer
+    answer = ''
+    check = cfg['check']
+    use_VLM = cfg['check_using_VLM']
+    record = cfg['record']['save_video']
+    note = " Write code to complete the task"
+    check_note = (' Finally check the completion of task using API parse_completion()'
+                  if llm == 'llama'
+                  else ' Finally check the completion of task.')
+
+    np.random.seed(seed)
+    random.seed(seed)
+    task = tasks.names[cfg['task']]()
+
+    env.seed(seed)
+    env.set_task(task)
+    reward, done, fgen_calls, budget_exceeded = 0., False, 0, 0
+
+    def run_turn(lmp, query, context):
+        # a turn that runs out of its budget ends there and returns None, the episode is
+        # scored as it is
+        nonlocal budget_exceeded
+        global answer
+        try:
+            return lmp(query, context)
+        except watchdog.BudgetExceeded as e:
+            budget_exceeded += 1
+            answer += f'\n **Budget Exceeded**: {e}\n'
+            print(f'Budget exceeded: {e}')
+            return None
+
+    try:
+        env.reset()  # TODO: think whether it conflicts with the loaded scene.
+        assert env.object_list
+        # assert len(env.object_list) == len(check_obj()) - 5
+
+        imagec = (env._get_obs()['color'][0], 'c')
+        imaged = (env._get_obs()['depth'][0], 'd')
+
+        # Start video recording
+        if record:
+            env.start_rec(f'{seed:06d}_CAP_test') if not check else env.start_rec(
+                f'{seed:06d}_CAP_test_check')
 
-    return lmp_tabletop_ui
+        # Rollout LLM policy
+        if check and not use_VLM:
+            goal = task.goal + check_note
+        else:
+            goal = task.goal + note
+
+        lmp_tabletop_ui = session.reset(env)
+        # a failed VLM check rewinds to the scene the plan started from
+        initial_state = None
+        try:
+            if check and use_VLM:
+                initial_state = session.lmp_env.snapshot()
+                session.lmp_check.prefetch_images([imagec, imaged])
+            plan = run_turn(lmp_tabletop_ui, goal, f'objects = {env.object_list}')
+
+            # a plan stopped by its budget is neither checked nor retried
+            if check and use_VLM and plan is not None:
+                imagece = (env._get_obs()['color'][0], 'c')
+                imagede = (env._get_obs()['depth'][0], 'd')
+                complete = session.lmp_check(
+                    'Here are the inital and final observations in RGB and depth, '
+                    f'judge whether the robot has completed the task "{task.goal}"',
+                    [imagec, imaged, imagece, imagede])
+                if not complete:
+                    session.lmp_env.restore(initial_state)
+                    run_turn(lmp_tabletop_ui,
+                             'The code you have generated just now was judged to fail completing '
+                             'the task, please try again. You do not need to check completion '
+                             'this time',
+                             plan)
+        finally:
+            # the saved PyBullet state is freed even when the plan or the check fails
+            if initial_state is not None:
+                sim_snapshot.discard(initial_state)
+
+        if cfg['manual_eval']:
+            imagece = env._get_obs()['color'][0]
+            image = Image.fromarray(imagece)
+            if image.mode == 'F':
+                image = image.convert('RGB')
+            pic_path = os.path.join(
+                cfg['data_dir'],
+                "{}-{}".format(cfg['task'], 'test'),
+                'finalsnapshot',
+                f'{seed:06d}_{cfg["gpt_model"]}_{cfg["llama_model_name"]}_test'
+                f'{"_check" if check else ""}.jpg'
+            )
+            os.makedirs(os.path.dirname(pic_path), exist_ok=True)
+            image.save(pic_path, format='JPEG')
+
+        if record:
+            env.end_rec()
+
+        reward = task._rewards
+        done = task.done()
+        fgen_calls = session.lmp_fgen.n_generated
+        print(f'Total Reward: {reward:.3f} | Done: {done} | FGen model calls: {fgen_calls}\n')
+        answer += f'Total Reward: {reward:.3f} | Done: {done} | FGen model calls: {fgen_calls}\n'
+        answer += f'Planner prompt tokens per call: {lmp_tabletop_ui.prompt_tokens}\n'
+        if session.lmp_env.action_timings:
+            step_times = [f'{record["step"]:.2f}' for record in session.lmp_env.action_timings]
+            answer += f'Queued action step times (s): {", ".join(step_times)}\n'
+
+    except:
+        answer += f'\n **Task Failed** \n'
+        err = str(traceback.format_exc())
+        answer += (err + '\n')
+        to_print = highlight(f"{err}", PythonLexer(), TerminalFormatter())
+        print(to_print)
+        if record:
+            env.end_rec()
+    return {'seed': seed, 'done': done, 'reward': reward, 'fgen_calls': fgen_calls,
+            'budget_exceeded': budget_exceeded, 'answer': answer}
+
+
+# state of a parallel test worker process, set up once by `_init_test_worker`
+_test_worker = {}
+
+
+def _init_test_worker(cfg, llm, llm_model_name, token, n_workers, backend_cfg):
+    if 'gpt' in llm:
+        openai.api_key = cfg['openai_key']
+    elif 'gemini' in llm:
+        genai.configure(api_key=cfg['genai_key'])
+    set_llm_model(llm_model_name)
+    set_max_token(token)
+    configure_lmps(cfg)
+    # the request budget is split evenly between the workers
+    rate_limiter = TokenBucket.per_minute(cfg['llm_backend']['requests_per_minute'] / n_workers,
+                                          burst=cfg['llm_backend']['burst'])
+    backend = make_backend(llm, rate_limiter=rate_limiter, **backend_cfg)
+    vlm_backend = None
+    if cfg['check_using_VLM']:
+        vlm_backend = backend if llm == 'gpt4' else make_backend(
+            'gpt4', rate_limiter=rate_limiter, **backend_cfg)
+    response_cache = None
+    if cfg['llm_cache']['mode'] not in ('off', False, None):
+        response_cache = ResponseCache(cfg['llm_cache']['path'], mode=cfg['llm_cache']['mode'],
+                                       max_entries=cfg['llm_cache']['max_entries'])
+    function_library = None
+    if cfg['fgen_library']['enabled']:
+        function_library = FunctionLibrary(cfg['fgen_library']['path'],
+                                           max_age_days=cfg['fgen_library']['max_age_days'])
+    env = Environment(
+        cfg['assets_root'],
+        disp=False,
+        shared_memory=False,
+        hz=480,
+        record_cfg=cfg['record']
+    )
+    env.video_path = os.path.join(cfg['data_dir'], "{}-{}".format(cfg['task'], 'test'), 'videos')
+    session = LMPSession(cfg_tabletop, llm, backend=backend, vlm_backend=vlm_backend,
+                         response_cache=response_cache, function_library=function_library)
+    _test_worker.update(cfg=cfg, llm=llm, env=env, session=session,
+                        response_cache=response_cache, function_library=function_library)
+
+
+def _cache_counters(response_cache, function_library):
+    counters = {'cache_hits': 0, 'cache_misses': 0, 'library_hits': 0, 'library_misses': 0}
+    if response_cache is not None:
+        counters.update(cache_hits=response_cache.hits, cache_misses=response_cache.misses)
+    if function_library is not None:
+        counters.update(library_hits=function_library.hits,
+                        library_misses=function_library.misses)
+    return counters
+
+
+def _run_test_worker_episode(seed):
+    worker = _test_worker
+    print(f'[worker {os.getpid()}] Test on seed {seed}')
+    before = _cache_counters(worker['response_cache'], worker['function_library'])
+    res = run_test_episode(worker['env'], worker['cfg'], worker['llm'], seed, worker['session'])
+    after = _cache_counters(worker['response_cache'], worker['function_library'])
+    res.update({key: after[key] - before[key] for key in after})
+    return res
+
+
+def run_parallel_test(cfg, llm, seeds, n_workers, backend_cfg):
+    """Run test episodes on a pool of worker processes.
+
+    Every worker owns a DIRECT-mode PyBullet `Environment` and its own LLM backend and
+    pulls seeds from the pool's shared task queue. Results come back in seed order, so
+    the caller can write all answer files once every episode has finished.
+    """
+    if llm == 'llama':
+        raise ValueError('parallel testing needs an API backend, '
+                         'local models cannot be loaded once per worker')
+    ctx = multiprocessing.get_context('spawn')  # PyBullet clients must not be forked
+    with ctx.Pool(n_workers, initializer=_init_test_worker,
+                  initargs=(cfg, llm, model, max_token, n_workers, backend_cfg)) as pool:
+        results = list(pool.imap_unordered(_run_test_worker_episode, seeds))
+    order = {seed: i for i, seed in enumerate(seeds)}
+    return sorted(results, key=lambda res: order[res['seed']])
 
 
 @hydra.main(config_path='./cfg', config_name='dahlia')
@@ -1318,7 +2008,7 @@ def main(cfg):
     """
     Use the same LLM model for both LMP and LMPFGen.
     If using different LLMs for them,
-    two offline loaded models should be passed to the function setup_LMP.
+    two backends should be passed to the LMPSession.
     """
     llm_model, llm_tokenizer = None, None
     use_vllm = cfg["use_vllm"]
@@ -1341,6 +2031,11 @@ def main(cfg):
         llm = 'gemini'
         llm_model_name = "gemini-1.5-pro"
         set_llm_model(llm_model_name)
+    elif 'fake' in cfg['gpt_model']:
+        # offline stand-in for benchmarking the harness, see FakeBackend
+        llm = 'fake'
+        llm_model_name = 'fake'
+        set_llm_model(llm_model_name)
     elif 'llama' in cfg['gpt_model']:
         llm = 'llama'
         llm_model_name = cfg['llama_model_name']
@@ -1364,6 +2059,7 @@ def main(cfg):
                 model=llm_model_name,
                 gpu_memory_utilization=0.9,
                 tensor_parallel_size=n_gpus,
+                enable_prefix_caching=True,  # reuse KV blocks of the shared few-shot prompts
                 # pipeline_parallel_size=4
             )
         else:
@@ -1381,18 +2077,59 @@ def main(cfg):
         llm = cfg['gpt_model']
         raise ValueError(f'Unknown LLM {llm}')
     set_max_token(2048)
+    configure_lmps(cfg)
 
     print(f"Use the model: {llm_model_name}")
     print(f"If use offline model, whether use vLLM to load offline model: {use_vllm}")
 
-    # initialize environment and task.
-    env = Environment(
-        cfg['assets_root'],
-        disp=cfg['disp'],
-        shared_memory=cfg['shared_memory'],
-        hz=480,
-        record_cfg=cfg['record']
+    backend_cfg = dict(
+        max_retries=cfg['llm_backend']['max_retries'],
+        backoff_base=cfg['llm_backend']['backoff_base'],
+        backoff_max=cfg['llm_backend']['backoff_max'],
+        pool_size=cfg['llm_backend']['pool_size'],
     )
+    # the workers of a parallel test build their own backends, caches, sessions and
+    # environments, see `_init_test_worker`
+    parallel = cfg['mode'] == 'test' and cfg['n_workers'] > 1
+    response_cache, function_library, session, env = None, None, None, None
+    if not parallel:
+        # one backend and rate limiter shared by all LMPs, see `llm_backend` in cfg/dahlia.yaml
+        rate_limiter = TokenBucket.per_minute(cfg['llm_backend']['requests_per_minute'],
+                                              burst=cfg['llm_backend']['burst'])
+        backend = make_backend(llm, offline_model=llm_model, offline_tokenizer=llm_tokenizer,
+                               use_vllm=use_vllm, rate_limiter=rate_limiter, **backend_cfg)
+
+        # the completion checker always runs on GPT-4 vision
+        vlm_backend = None
+        if cfg['check_using_VLM']:
+            vlm_backend = backend if llm == 'gpt4' else make_backend(
+                'gpt4', rate_limiter=rate_limiter, **backend_cfg)
+
+        # on-disk cache of model responses, see `llm_cache` in cfg/dahlia.yaml
+        if cfg['llm_cache']['mode'] not in ('off', False, None):
+            response_cache = ResponseCache(
+                cfg['llm_cache']['path'],
+                mode=cfg['llm_cache']['mode'],
+                max_entries=cfg['llm_cache']['max_entries'],
+            )
+
+        # generated functions reused across episodes, see `fgen_library` in cfg/dahlia.yaml
+        if cfg['fgen_library']['enabled']:
+            function_library = FunctionLibrary(cfg['fgen_library']['path'],
+                                               max_age_days=cfg['fgen_library']['max_age_days'])
+
+        # the LMP stack is built once and reset for every episode
+        session = LMPSession(cfg_tabletop, llm, backend=backend, vlm_backend=vlm_backend,
+                             response_cache=response_cache, function_library=function_library)
+
+        # initialize environment and task.
+        env = Environment(
+            cfg['assets_root'],
+            disp=cfg['disp'],
+            shared_memory=cfg['shared_memory'],
+            hz=480,
+            record_cfg=cfg['record']
+        )
 
     global answer
 
@@ -1455,10 +2192,7 @@ def main(cfg):
                 goal = task.goal + ' Finally check the completion of task.' if check else task.goal
                 goal = goal + note
 
-                lmp_tabletop_ui = setup_LMP(env, cfg_tabletop, llm,
-                                            offline_model=llm_model,
-                                            offline_tokenizer=llm_tokenizer,
-                                            use_vllm=use_vllm)
+                lmp_tabletop_ui = session.reset(env)
                 lmp_tabletop_ui(goal, f'objects = {env.object_list}')
 
                 if record:
@@ -1526,323 +2260,65 @@ def main(cfg):
                     '{}/blender_demo_{}.pkl'.format(data_path, dataset.n_episodes))
 
     elif mode == 'test':
-        check_note = (' Finally check the completion of task using API parse_completion()'
-                      if llm == 'llama'
-                      else ' Finally check the completion of task.')
-        success = 0
         n_demos = cfg['n']
         data_path = os.path.join(cfg['data_dir'], "{}-{}".format(cfg['task'], mode))
-        env.video_path = os.path.join(data_path, 'videos')
-        if not cfg['random']:
-            dataset = RavensDataset(data_path, cfg, n_demos=n_demos, augment=False, random=False)
-            print(f"Testing on: {data_path}")
-            print(f"Mode: {mode} Random: False")
-            files = os.listdir(os.path.join(data_path, 'action'))
-            files.sort()
-            file_path = None
-            for i in range(0, n_demos):
-                answer = ''
-                print(f'Test: {i + 1}/{n_demos} on {files[i]}')
-                try:
-                    episode, seed = dataset.load(i)
-                except:
-                    print(f"skip bad example {files[i]}")
-                    continue
-                np.random.seed(seed)
-                random.seed(seed)
-                task = tasks.names[cfg['task']]()
-
-                env.seed(seed)
-                env.set_task(task)
-                try:
-                    env.reset()  # TODO: think whether it conflicts with the loaded scene.
-                    assert env.object_list
-                    # assert len(env.object_list) == len(check_obj()) - 5
-
-                    imagec = (env._get_obs()['color'][0], 'c')
-                    imaged = (env._get_obs()['depth'][0], 'd')
-
-                    # Start video recording
-                    if record:
-                        env.start_rec(f'{seed:06d}_CAP_test') if not check else env.start_rec(
-                            f'{seed:06d}_CAP_test_check')
-
-                    # Rollout LLM policy
-                    if check and not use_VLM:
-                        goal = task.goal + check_note 
-                    else:
-                        goal = task.goal + note
-
-                    lmp_tabletop_ui = setup_LMP(
-                        env,
-                        cfg_tabletop,
-                        llm,
-                        offline_model=llm_model,
-                        offline_tokenizer=llm_tokenizer,
-                        use_vllm=use_vllm,
-                    )
-                    plan = lmp_tabletop_ui(goal, f'objects = {env.object_list}')
-
-                    if check and use_VLM:
-                        imagece = (env._get_obs()['color'][0], 'c')
-                        imagede = (env._get_obs()['depth'][0], 'd')
-                        lmp_check = LMPV(
-                            'VLM_ui',
-                            (cfg_tabletop['lmps']['VLM'], 'gpt4')
-                            )
-                        complete = lmp_check('Here are the inital and final observations in RGB and depth, '
-                                             f'judge whether the robot has completed the task "{task.goal}"', 
-                                             [imagec,imaged,imagece,imagede])
-                        if not complete:
-                            np.random.seed(env._seed)
-                            random.seed(env._seed)
-                            env.reset()
-                            lmp_tabletop_ui(f'The code you have generated just now was judged to fail completing the task, please try again. '
-                                            'You do not need to check completion this time', plan)
-
-                    if manual_eval:
-                        imagece = env._get_obs()['color'][0]
-                        image = Image.fromarray(imagece)
-                        if image.mode == 'F':
-                            image = image.convert('RGB')
-                        pic_path = (os.path.join(
-                            data_path,
-                            'finalsnapshot',
-                            f'{seed:06d}_{cfg["gpt_model"]}_{cfg["llama_model_name"]}_test.jpg'
-                            )
-                        if not check
-                        else os.path.join(
-                            data_path,
-                            'finalsnapshot',
-                            f'{seed:06d}_{cfg["gpt_model"]}_{cfg["llama_model_name"]}_test_check.jpg'
-                            )
-                        )
-                        os.makedirs(os.path.dirname(pic_path), exist_ok=True)
-                        image.save(pic_path, format='JPEG')
-
-                    if record:
-                        env.end_rec()
-
-                    reward = task._rewards
-                    done = task.done()
-                    if done:
-                        success += 1
-                    print(f'Total Reward: {reward:.3f} | Done: {done}\n')
-                    answer += f'Total Reward: {reward:.3f} | Done: {done}\n'
-
-                    file_path = (
-                        os.path.join(
-                            data_path,
-                            'answers',
-                            f'{seed:06d}_{cfg["gpt_model"]}_{cfg["llama_model_name"]}_test.txt'
-                        )
-                        if not check
-                        else os.path.join(
-                            data_path,
-                            'answers',
-                            f'{seed:06d}_{cfg["gpt_model"]}_{cfg["llama_model_name"]}_test_check.txt'
-                        )
-                    )
-                    os.makedirs(os.path.dirname(file_path), exist_ok=True)
-                    with open(file_path, 'w', encoding='utf-8') as file:
-                        file.write(answer)
-                except:
-                    answer += f'\n **Task Failed** \n'
-                    err = str(traceback.format_exc())
-                    answer += (err + '\n')
-                    to_print = highlight(f"{err}", PythonLexer(), TerminalFormatter())
-                    print(to_print)
-                    if record:
-                        env.end_rec()
-                    file_path = (
-                        os.path.join(
-                            data_path,
-                            'answers',
-                            f'{seed:06d}_{cfg["gpt_model"]}_{cfg["llama_model_name"]}_test.txt'
-                        )
-                        if not check
-                        else os.path.join(
-                            data_path,
-                            'answers',
-                            f'{seed:06d}_{cfg["gpt_model"]}_{cfg["llama_model_name"]}_test_check.txt'
-                        )
-                    )
-                    os.makedirs(os.path.dirname(file_path), exist_ok=True)
-                    with open(file_path, 'w', encoding='utf-8') as file:
-                        file.write(answer)
-            file_path = (
-                        os.path.join(
-                            data_path,
-                            'answers',
-                            f'summary_{n_demos}_{cfg["gpt_model"]}_{cfg["llama_model_name"]}_test.txt'
-                        )
-                        if not check
-                        else os.path.join(
-                            data_path,
-                            'answers',
-                            f'summary_{n_demos}_{cfg["gpt_model"]}_{cfg["llama_model_name"]}_test_check.txt'
-                        )
-                    )
-            result = f'{success} successes in {n_demos} tests'
-            print(result)
-            with open(file_path, 'a', encoding='utf-8') as file:
-                file.write(result)
+        dataset = RavensDataset(data_path, cfg, n_demos=n_demos, augment=False,
+                                random=cfg['random'])
+        print(f"Testing on: {data_path}")
+        print(f"Mode: {mode} Random: {cfg['random']}")
+        files = os.listdir(os.path.join(data_path, 'action'))
+        files.sort()
+        episode_ids = dataset.sample_set if cfg['random'] else range(n_demos)
+        test_seeds = []
+        for idx in episode_ids:
+            try:
+                _, seed = dataset.load(idx)
+            except:
+                print(f"skip bad example {files[idx]}")
+                continue
+            test_seeds.append(seed)
 
+        if parallel:
+            results = run_parallel_test(cfg, llm, test_seeds, cfg['n_workers'], backend_cfg)
+            for res in results:
+                write_atomic(test_answer_path(data_path, cfg, res['seed']), res['answer'])
         else:
-            dataset = RavensDataset(data_path, cfg, n_demos=n_demos, augment=False, random=True)
-            print(f"Testing on: {data_path}")
-            print(f"Mode: {mode} Random: True")
-            files = os.listdir(os.path.join(data_path, 'action'))
-            files.sort()
-            file_path = None
-            for i, idx in enumerate(dataset.sample_set):
-                answer = ''
-                print(f'Test: {i + 1}/{n_demos} on {files[idx]}')
-                try:
-                    episode, seed = dataset.load(idx)
-                except:
-                    print(f"skip bad example {files[idx]}")
-                    continue
-                np.random.seed(seed)
-                random.seed(seed)
-                task = tasks.names[cfg['task']]()
-
-                env.seed(seed)
-                env.set_task(task)
-                try:
-                    env.reset()
-                    assert env.object_list
-                    # assert len(env.object_list) == len(check_obj()) - 5
-
-                    imagec = (env._get_obs()['color'][0], 'c')
-                    imaged = (env._get_obs()['depth'][0], 'd')
-
-                    # Start video recording
-                    if record:
-                        env.start_rec(f'{seed:06d}_CAP_test') if not check else env.start_rec(
-                            f'{seed:06d}_CAP_test_check')
-
-                    # Rollout LLM policy
-                    if check and not use_VLM:
-                        goal = task.goal + check_note 
-                    else:
-                        goal = task.goal + note
-
-                    lmp_tabletop_ui = setup_LMP(
-                        env,
-                        cfg_tabletop,
-                        llm,
-                        offline_model=llm_model,
-                        offline_tokenizer=llm_tokenizer,
-                        use_vllm=use_vllm,
-                    )
-                    plan = lmp_tabletop_ui(goal, f'objects = {env.object_list}')
-
-                    if check and use_VLM:
-                        imagece = (env._get_obs()['color'][0], 'c')
-                        imagede = (env._get_obs()['depth'][0], 'd')
-                        lmp_check = LMPV(
-                            'VLM_ui',
-                            (cfg_tabletop['lmps']['VLM'], 'gpt4')
-                            )
-                        complete = lmp_check('Here are the inital and final observations in RGB and depth, '
-                                             f'judge whether the robot has completed the task "{task.goal}"', 
-                                             [imagec,imaged,imagece,imagede])
-                        if not complete:
-                            np.random.seed(env._seed)
-                            random.seed(env._seed)
-                            env.reset()
-                            lmp_tabletop_ui(f'The code you have generated just now was judged to fail completing the task, please try again. '
-                                            'You do not need to check completion this time', plan) 
-
-                    if manual_eval:
-                        imagece = env._get_obs()['color'][0]
-                        image = Image.fromarray(imagece)
-                        if image.mode == 'F':
-                            image = image.convert('RGB')
-                        pic_path = (os.path.join(
-                            data_path,
-                            'finalsnapshot',
-                            f'{seed:06d}_{cfg["gpt_model"]}_{cfg["llama_model_name"]}_test.jpg'
-                            ) 
-                        if not check
-                        else os.path.join(
-                            data_path,
-                            'finalsnapshot',
-                            f'{seed:06d}_{cfg["gpt_model"]}_{cfg["llama_model_name"]}_test_check.jpg'
-                            )
-                        )
-                        os.makedirs(os.path.dirname(pic_path), exist_ok=True)
-                        image.save(pic_path, format='JPEG')    
-
-                    if record:
-                        env.end_rec()
-
-                    reward = task._rewards
-                    done = task.done()
-                    if done:
-                        success += 1
-                    print(f'Total Reward: {reward:.3f} | Done: {done}\n')
-                    answer += f'Total Reward: {reward:.3f} | Done: {done}\n'
-
-                    file_path = (
-                        os.path.join(
-                            data_path,
-                            'answers',
-                            f'{seed:06d}_{cfg["gpt_model"]}_{cfg["llama_model_name"]}_test.txt'
-                        )
-                        if not check
-                        else os.path.join(
-                            data_path,
-                            'answers',
-                            f'{seed:06d}_{cfg["gpt_model"]}_{cfg["llama_model_name"]}_test_check.txt'
-                        )
-                    )
-                    os.makedirs(os.path.dirname(file_path), exist_ok=True)
-                    with open(file_path, 'w', encoding='utf-8') as file:
-                        file.write(answer)
-
-                except:
-                    answer += f'\n **Task Failed** \n'
-                    err = str(traceback.format_exc())
-                    answer += (err + '\n')
-                    to_print = highlight(f"{err}", PythonLexer(), TerminalFormatter())
-                    print(to_print)
-                    if record:
-                        env.end_rec()
-                    file_path = (
-                        os.path.join(
-                            data_path,
-                            'answers',
-                            f'{seed:06d}_{cfg["gpt_model"]}_{cfg["llama_model_name"]}_test.txt'
-                        )
-                        if not check
-                        else os.path.join(
-                            data_path,
-                            'answers',
-                            f'{seed:06d}_{cfg["gpt_model"]}_{cfg["llama_model_name"]}_test_check.txt'
-                        )
-                    )
-                    os.makedirs(os.path.dirname(file_path), exist_ok=True)
-                    with open(file_path, 'w', encoding='utf-8') as file:
-                        file.write(answer)
-            file_path = (
-                        os.path.join(
-                            data_path,
-                            'answers',
-                            f'summary_{n_demos}_{cfg["gpt_model"]}_{cfg["llama_model_name"]}_test.txt'
-                        )
-                        if not check
-                        else os.path.join(
-                            data_path,
-                            'answers',
-                            f'summary_{n_demos}_{cfg["gpt_model"]}_{cfg["llama_model_name"]}_test_check.txt'
-                        )
-                    )
-            result = f'{success} successes in {n_demos} tests'
-            print(result)
-            with open(file_path, 'a', encoding='utf-8') as file:
-                file.write(result)
+            env.video_path = os.path.join(data_path, 'videos')
+            results = []
+            for i, seed in enumerate(test_seeds):
+                print(f'Test: {i + 1}/{n_demos} on seed {seed}')
+                res = run_test_episode(env, cfg, llm, seed, session)
+                write_atomic(test_answer_path(data_path, cfg, seed), res['answer'])
+                results.append(res)
+
+        success = sum(res['done'] for res in results)
+        file_path = os.path.join(
+            data_path,
+            'answers',
+            f'summary_{n_demos}_{cfg["gpt_model"]}_{cfg["llama_model_name"]}_test'
+            f'{"_check" if cfg["check"] else ""}.txt'
+        )
+        result = f'{success} successes in {n_demos} tests'
+        print(result)
+        if parallel:
+            # the caches live in the workers, which report their counters per episode
+            if cfg['llm_cache']['mode'] not in ('off', False, None):
+                hits = sum(res['cache_hits'] for res in results)
+                misses = sum(res['cache_misses'] for res in results)
+                print(f"LLM cache ({cfg['llm_cache']['mode']}): {hits} hits, {misses} misses, "
+                      f"hit rate {hits / max(hits + misses, 1):.2f}")
+            if cfg['fgen_library']['enabled']:
+                print(f"FGen library: {sum(res['library_hits'] for res in results)} reused, "
+                      f"{sum(res['library_misses'] for res in results)} generated")
+        if response_cache is not None:
+            print(response_cache.stats())
+        if function_library is not None:
+            print(function_library.stats())
+        print(f'FGen model calls per episode: {[res["fgen_calls"] for res in results]}')
+        print(f'Planner turns over budget: {sum(res["budget_exceeded"] for res in results)}')
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'a', encoding='utf-8') as file:
+            file.write(result)
 
     elif mode == 'debug':
         # ---------------------------------------------------------------------------
@@ -1925,6 +2401,13 @@ cfg_tabletop = {
             'include_context': True,
             'has_return': True,
             'return_val_name': 'whole_answer',
+            'stream': False,  # execute statements while the completion streams in
+            'history_max_tokens': None,  # token budget of the session history
+            'history_policy': 'evict',
+            'n_candidates': 1,  # completions sampled in parallel and dry-run, see LMP
+            'candidate_temperature': 0.7,
+            'candidate_max_steps': 20,  # actions per dry run
+            'candidate_timeout': 60.,  # seconds per dry run
         },
         'parse_obj_name': {
             'prompt_text': open(f"prompts/dahlia/prompt_parse_obj_name.txt").read(),
@@ -1990,6 +2473,7 @@ cfg_tabletop = {
             'query_prefix': '# define function: ',
             'query_suffix': '.',
             'stop': ['# define', '# example'],
+            'max_workers': 8,  # functions of one depth are generated concurrently
             'maintain_session': False,
             'debug_mode': False,
             'include_context': True,
@@ -2019,8 +2503,24 @@ cfg_tabletop = {
             'debug_mode': False,
             'has_return': True,
             'return_val_name': 'judge',
+            'history_max_tokens': None,
+            'history_policy': 'evict',
+            'image_max_side': None,
+            'image_workers': 4,
         },
-    }
+    },
+    # how LMP_wrapper executes pick-and-place actions, see `configure_lmps`
+    'execution': {
+        'mode': 'pickplace',
+        'settle_steps': 48,
+    },
+    # budget of every planner call, see `watchdog.Watchdog`
+    'watchdog': {
+        'max_actions': None,
+        'max_sim_steps': None,
+        'max_calls': None,
+        'max_seconds': 600,
+    },
 }
 
 lmp_tabletop_coords = {
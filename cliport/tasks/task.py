@@ -5,7 +5,6 @@ import os
 import random
 import re
 import string
-import tempfile
 from typing import Tuple, List
 
 import cv2
@@ -16,7 +15,9 @@ from cliport.tasks import cameras
 from cliport.tasks import primitives
 from cliport.tasks.grippers import Spatula
 from cliport.tasks.grippers import Suction
+from cliport.utils import template_cache
 from cliport.utils import utils
+from cliport.utils.occupancy import OccupancyMap
 
 
 class Task:
@@ -55,6 +56,9 @@ class Task:
         self.goals = []
         self.lang_goals = []
         self.obj_points_cache = {}
+        self.occupancy = None  # OccupancyMap of the episode, see `get_occupancy`
+        self.aabb_occupancy = False  # stamp new objects' AABBs instead of rendering
+        self._true_image = None  # (scene key, images) of the last `get_true_image`
 
         self.task_completed_desc = "task completed."
         self.progress = 0
@@ -149,6 +153,8 @@ class Task:
         self.progress = 0  # Task progression metric in range [0, 1].
         self._rewards = 0  # Cumulative returned rewards.
         self.obj_points_cache = {}
+        self.occupancy = None
+        self._true_image = None
 
     def additional_reset(self):
         # Additional changes to make the environment adaptable
@@ -189,6 +195,11 @@ class Task:
                             type(targs[j][0]) is float or type(targs[j][0]) is np.float32):
                         targs[j] = (targs[j], (0, 0, 0, 1))
 
+                for i in range(len(objs)):
+                    if type(objs[i]) is int:
+                        objs[i] = (objs[i], (False, None))
+                poses = [p.getBasePositionAndOrientation(object_id) for object_id, _ in objs]
+
                 # Match objects to targets without replacement.
                 if not replace:
 
@@ -196,46 +207,38 @@ class Task:
                     matches = matches.copy()
 
                     # Ignore already matched objects.
+                    is_match = self.match_poses(poses, targs, [sym for _, (sym, _) in objs],
+                                                consider_z=self.consider_z_in_match)
                     for i in range(len(objs)):
-                        if type(objs[i]) is int:
-                            objs[i] = (objs[i], (False, None))
-
-                        object_id, (symmetry, _) = objs[i]
-                        pose = p.getBasePositionAndOrientation(object_id)
                         targets_i = np.argwhere(matches[i, :]).reshape(-1)
-                        for j in targets_i:
-                            if self.is_match(
-                                    pose, targs[j], symmetry, consider_z=self.consider_z_in_match
-                            ):
-                                matches[i, :] = 0
-                                matches[:, j] = 0
-
-                # print("matches matrix")
-                # print(matches)
+                        matched = targets_i[is_match[i, targets_i]]
+                        if len(matched) > 0:
+                            matches[i, :] = 0
+                            matches[:, matched] = 0
+
                 # Get objects to be picked (prioritize farthest from nearest neighbor).
+                # Distances of every object to every target, nearest allowed target first.
+                obj_xyz, _ = self._pose_arrays(poses)
+                targets_xyz, _ = self._pose_arrays(targs)
+                dists = np.linalg.norm(targets_xyz[None] - obj_xyz[:, None], axis=-1)
+                dists[~self._allowed(matches, dists.shape)] = np.inf
                 nn_dists = []
                 nn_targets = []
                 for i in range(len(objs)):
-                    if type(objs[i]) is int:
-                        objs[i] = (objs[i], (False, None))
-
-                    object_id, (symmetry, _) = objs[i]
-                    xyz, rot = p.getBasePositionAndOrientation(object_id)
-                    rot = utils.quatXYZW_to_eulerXYZ(rot)
-                    rot = utils.eulerXYZ_to_quatXYZW((0,0,rot[2]))
-                    targets_i = np.argwhere(matches[i, :]).reshape(-1)
-                    if len(targets_i) > 0:  # pylint: disable=g-explicit-length-test
-                        targets_xyz = np.float32([targs[j][0] for j in targets_i])
-                        dists = np.linalg.norm(targets_xyz - np.float32(xyz).reshape(1, 3), axis=1)
-                        nn = np.argmin(dists)
+                    if np.isfinite(dists[i]).any():
+                        nn = np.argmin(dists[i])
                         # add the nearest target object for each source object
-                        nn_dists.append(dists[nn])
-                        nn_targets.append(targets_i[nn])
+                        nn_dists.append(dists[i, nn])
+                        nn_targets.append(nn)
 
                     # Handle ignored objects.
                     else:
                         nn_dists.append(0)
                         nn_targets.append(-1)
+                if poses:
+                    # picking keeps the yaw of the last object
+                    rot = utils.quatXYZW_to_eulerXYZ(poses[-1][1])
+                    rot = utils.eulerXYZ_to_quatXYZW((0, 0, rot[2]))
                 if self.input_manipulate_order:
                     # change order to the input order rather than distance-based order.
                     order = np.arange(len(nn_dists))
@@ -245,15 +248,12 @@ class Task:
                 # Filter out matched objects.
                 order = [i for i in order if nn_dists[i] > 0]
 
+                # Pick the first object in order that is still visible once its mask is
+                # eroded, to avoid picking on edges.
                 pick_mask = None
-                for pick_i in order:
-                    pick_mask = np.uint8(obj_mask == objs[pick_i][0])
-
-                    # Erode to avoid picking on edges.
-                    pick_mask = cv2.erode(pick_mask, np.ones((3, 3), np.uint8))
-
-                    if np.sum(pick_mask) > 0:
-                        break
+                if order:
+                    k, pick_mask = utils.first_visible(obj_mask, [objs[i][0] for i in order])
+                    pick_i = order[k]
 
                 # Trigger task reset if no object is visible.
                 if pick_mask is None or np.sum(pick_mask) == 0:
@@ -345,17 +345,13 @@ class Task:
             # Evaluate by matching object poses.
             if metric == 'pose':
                 step_reward = 0
-                for i in range(len(objs)):
-                    object_id, (symmetry, _) = objs[i]
-                    pose = p.getBasePositionAndOrientation(object_id)
-                    targets_i = np.argwhere(matches[i, :]).reshape(-1)
-                    for j in targets_i:
-                        target_pose = targs[j]
-                        if self.is_match(
-                                pose, target_pose, symmetry, consider_z=self.consider_z_in_match
-                        ):
-                            step_reward += max_reward / len(objs)
-                            break
+                poses = [p.getBasePositionAndOrientation(object_id) for object_id, _ in objs]
+                is_match = self.match_poses(poses, targs, [sym for _, (sym, _) in objs],
+                                            consider_z=self.consider_z_in_match)
+                # an object counts if it matches any of its targets
+                n_matched = np.sum((is_match & self._allowed(matches, is_match.shape)).any(axis=1))
+                for _ in range(n_matched):
+                    step_reward += max_reward / len(objs)
 
             # Evaluate by measuring object intersection with zone.
             elif metric == 'zone':
@@ -438,6 +434,51 @@ class Task:
     # Environment Helper Functions
     # -------------------------------------------------------------------------
 
+    @staticmethod
+    def _allowed(matches, shape):
+        # nonzero entries of the match matrix of a goal, as a boolean matrix of `shape`
+        matches = np.asarray(matches)[:shape[0], :shape[1]]
+        allowed = np.zeros(shape, dtype=bool)
+        allowed[:matches.shape[0], :matches.shape[1]] = matches != 0
+        return allowed
+
+    @staticmethod
+    def _pose_arrays(poses):
+        # float32 positions and float64 rotations of (translation, rotation) poses, or
+        # of bare translations
+        positions, rotations = [], []
+        for pose in poses:
+            if len(pose) == 3 and (not hasattr(pose[0], '__len__')):
+                pose = (pose, (0, 0, 0, 1))
+            positions.append(np.float32(pose[0][:3]))
+            rotations.append(pose[1])
+        return (np.float32(positions).reshape(-1, 3),
+                np.float64(rotations).reshape(-1, 4))
+
+    def match_poses(self, poses0, poses1, symmetries, consider_z=False):
+        """Batched `is_match` of every pose in `poses0`, with its symmetry, against every
+        pose in `poses1`. Returns a (len(poses0), len(poses1)) boolean matrix."""
+        pos0, rot0 = self._pose_arrays(poses0)
+        pos1, rot1 = self._pose_arrays(poses1)
+
+        # Translational error.
+        dist_pos = np.linalg.norm(pos0[:, None, :2] - pos1[None, :, :2], axis=-1)
+
+        # Rotational error around z-axis (account for symmetries).
+        symmetry = np.float64(symmetries).reshape(-1, 1)
+        diff_rot = np.zeros(dist_pos.shape)
+        rows = np.flatnonzero(symmetry > 0)
+        if len(rows) and len(pos1):
+            rot_z0 = utils.quatXYZW_to_eulerZ(rot0[rows])
+            rot_z1 = utils.quatXYZW_to_eulerZ(rot1)
+            diff = np.abs(rot_z0[:, None] - rot_z1[None]) % symmetry[rows]
+            diff_rot[rows] = np.where(diff > symmetry[rows] / 2, symmetry[rows] - diff, diff)
+
+        match = (dist_pos < self.pos_eps) & (diff_rot < self.rot_eps)
+        if consider_z:
+            match &= np.abs(pos0[:, None, 2] - pos1[None, :, 2]) < self.height_eps
+        return match
+
     def is_match(self, pose0, pose1, symmetry, consider_z=False):
         """Check if pose0 and pose1 match within a threshold.
         pose0 and pose1 should both be tuples of (translation, rotation).
@@ -471,9 +512,31 @@ class Task:
 
         return (dist_pos < self.pos_eps) and (diff_rot < self.rot_eps)
 
+    @staticmethod
+    def _scene_key(env):
+        # the simulation step, and the body ids, poses and joint positions, so that bodies
+        # reset by a task between two calls (e.g. palletizing) are noticed too
+        bodies = tuple(p.getBodyUniqueId(i) for i in range(p.getNumBodies()))
+        state = []
+        for body in bodies:
+            state.append(p.getBasePositionAndOrientation(body))
+            n_joints = p.getNumJoints(body)
+            if n_joints:
+                state.append(tuple(joint[0] for joint in p.getJointStates(body, range(n_joints))))
+        return getattr(env, 'step_counter', None), bodies, tuple(state)
+
     def get_true_image(self, env):
-        """Get RGB-D orthographic heightmaps and segmentation masks."""
+        """Get RGB-D orthographic heightmaps and segmentation masks.
+
+        The images are rendered once per scene state and shared by the calls until the
+        scene changes, so they are read-only.
+        """
+        key = self._scene_key(env)
+        if self._true_image is None or self._true_image[0] != key:
+            self._true_image = (key, self._render_true_image(env))
+        return self._true_image[1]
 
+    def _render_true_image(self, env):
         # Capture near-orthographic RGB-D images and segmentation masks.
         color, depth, segm = env.render_camera(self.oracle_cams[0])
 
@@ -488,8 +551,36 @@ class Task:
         cmap = np.uint8(cmaps)[0, Ellipsis, :3]
         hmap = np.float32(hmaps)[0, Ellipsis]
         mask = np.int32(cmaps)[0, Ellipsis, 3:].squeeze()
+        for image in (cmap, hmap, mask):
+            image.flags.writeable = False
         return cmap, hmap, mask
 
+    def get_occupancy(self, env):
+        """`OccupancyMap` of the objects of the episode, the pixels their projections cover
+        in the rendered segmentation mask. The mask is shared with `get_true_image`, so the
+        map is only rebuilt once the scene has changed.
+
+        With `aabb_occupancy`, objects added since the last call are stamped with the
+        footprint of their AABB instead, and the scene is only rendered again once physics
+        has moved objects. That is faster, but it reserves more space than rotated or round
+        objects cover, so the poses sampled for a seed differ.
+        """
+        bodies = [obj_id for obj_ids in env.obj_ids.values() for obj_id in obj_ids]
+        if self.occupancy is None:
+            self.occupancy = OccupancyMap(self.bounds, self.pix_size)
+        if not self.aabb_occupancy:
+            _, _, obj_mask = self.get_true_image(env)
+            if self.occupancy.mask is not obj_mask or self.occupancy.bodies != bodies:
+                self.occupancy.load_mask(obj_mask, bodies)
+            return self.occupancy
+        if self.occupancy.moved(bodies):
+            _, _, obj_mask = self.get_true_image(env)
+            self.occupancy.load_mask(obj_mask, bodies)
+        for body in bodies:
+            if body not in self.occupancy:
+                self.occupancy.stamp(body)
+        return self.occupancy
+
     def get_random_pose(self, env, obj_size=0.1, bound=np.zeros((3, 2)), **kwargs) -> tuple[
         List, List]:
         """
@@ -503,13 +594,8 @@ class Task:
         max_size = np.sqrt(obj_size[0] ** 2 + obj_size[1] ** 2)
         erode_size = int(np.round(max_size / self.pix_size))
 
-        _, hmap, obj_mask = self.get_true_image(env)
-
         # Randomly sample an object pose within free-space pixels.
-        free = np.ones(obj_mask.shape, dtype=np.uint8)
-        for obj_ids in env.obj_ids.values():
-            for obj_id in obj_ids:
-                free[obj_mask == obj_id] = 0
+        free = np.uint8(~self.get_occupancy(env).occupied)
         free[0, :], free[:, 0], free[-1, :], free[:, -1] = 0, 0, 0, 0
         free = cv2.erode(free, np.ones((erode_size, erode_size), np.uint8))
 
@@ -518,10 +604,11 @@ class Task:
 
         if np.sum(free) == 0:
             # avoid returning None
-            pix = (obj_mask.shape[0] // 2, obj_mask.shape[1] // 2)
+            pix = (free.shape[0] // 2, free.shape[1] // 2)
         else:
             pix = utils.sample_distribution(np.float32(free))
-        pos = utils.pix_to_xyz(pix, hmap, bound, self.pix_size)
+        # the height is replaced by the object size below
+        pos = utils.pix_to_xyz(pix, None, bound, self.pix_size, skip_height=True)
 
         if len(obj_size) == 2:
             print("Should have z dimension in obj_size as well.")
@@ -568,7 +655,8 @@ class Task:
         return os.path.exists(path.replace(".urdf", ".obj"))
 
     def fill_template(self, template, replace):
-        """Read a file and replace key strings.
+        """Read a file and replace key strings. The filled file is shared by every call
+        with the same template and values, see `template_cache.TemplateCache`.
         NOTE: This function must be called if a URDF has template in its name """
 
         full_template_path = os.path.join(self.assets_root, template)
@@ -576,8 +664,7 @@ class Task:
                 full_template_path) and 'template' not in full_template_path):
             return template
 
-        with open(full_template_path, 'r') as file:
-            fdata = file.read()
+        fdata = template_cache.cache.read(full_template_path)
 
         for field in replace:
             # if  not hasattr(replace[field], '__len__'):
@@ -596,14 +683,11 @@ class Task:
                     fdata = fdata.replace(f'{to_replace_color}',
                                           " ".join([str(x) for x in list(replace[field]) + [1]]))
 
+        # the files used to get random names; keep drawing them so that the scenes built
+        # from a seed, e.g. the stored test episodes, stay the same
         alphabet = string.ascii_lowercase + string.digits
-        rname = ''.join(random.choices(alphabet, k=16))
-        tmpdir = tempfile.gettempdir()
-        template_filename = os.path.split(template)[-1]
-        fname = os.path.join(tmpdir, f'{template_filename}.{rname}')
-        with open(fname, 'w') as file:
-            file.write(fdata)
-        return fname
+        random.choices(alphabet, k=16)
+        return template_cache.cache.write(full_template_path, fdata)
 
     def get_random_size(self, min_x, max_x, min_y, max_y, min_z, max_z) -> Tuple:
         """Get random box size."""
@@ -0,0 +1,122 @@
+"""Tests for executing multi-object primitives through the action queue."""
+
+import collections
+
+import numpy as np
+from absl.testing import absltest
+
+from cliport import dahlia_run
+
+BLOCKS = [f'block {i}' for i in range(6)]
+
+
+class StackEnv:
+    """Stand-in environment where a pick-and-place moves the top object under the pick
+    xy position onto the top of whatever is under the place xy position."""
+
+    def __init__(self, drift=(0., 0.)):
+        self.object_list = list(BLOCKS)
+        self.positions = {name: np.array([0.3 + 0.07 * i, 0.1 * (-1) ** i, 0.02])
+                          for i, name in enumerate(BLOCKS)}
+        self.drift = np.array([*drift, 0.])
+        self.calls = collections.Counter()
+        self.actions = []
+
+    def _top_at(self, xy, exclude=None):
+        under = [name for name, pos in self.positions.items()
+                 if name != exclude and np.linalg.norm(pos[:2] - xy) < 0.015]
+        return max(under, key=lambda name: self.positions[name][2]) if under else None
+
+    def get_obj_pos(self, obj_name, count=1):
+        self.calls['pose'] += 1
+        return [self.positions[obj_name].copy()]
+
+    def get_obj_rot(self, obj_name, count=1):
+        self.calls['pose'] += 1
+        return [np.array([0., 0., 0., 1.])]
+
+    def get_bounding_box(self, obj_name):
+        self.calls['aabb'] += 1
+        return (*self.positions[obj_name] - 0.02, *self.positions[obj_name] + 0.02)
+
+    def step(self, action):
+        self.calls['step'] += 1
+        self.actions.append(action)
+        picked = self._top_at(np.asarray(action['pose0'][0][:2]))
+        place_xy = np.asarray(action['pose1'][0][:2], dtype=float)
+        support = self._top_at(place_xy, exclude=picked)
+        z = self.positions[support][2] + 0.04 if support else 0.02
+        self.positions[picked] = np.array([*place_xy, z]) + self.drift
+
+
+def make_wrapper(env):
+    cfg = {'env': {'init_objs': env.object_list, 'coords': dahlia_run.lmp_tabletop_coords}}
+    return dahlia_run.LMP_wrapper(env, cfg)
+
+
+class ActionQueueTest(absltest.TestCase):
+
+    def stack_one_by_one(self, env):
+        lmp_env = make_wrapper(env)
+        for i in range(len(BLOCKS) - 1):
+            lmp_env.put_first_on_second(BLOCKS[i + 1], BLOCKS[i])
+
+    def test_stack_matches_one_by_one(self):
+        reference = StackEnv()
+        self.stack_one_by_one(reference)
+        env = StackEnv()
+        lmp_env = make_wrapper(env)
+        lmp_env.stack_objects_in_order(BLOCKS)
+
+        for name in BLOCKS:
+            np.testing.assert_allclose(env.positions[name], reference.positions[name])
+        # aimed at the same poses as when observing the stack after every action
+        for action, expected in zip(env.actions, reference.actions):
+            for key in ('pose0', 'pose1'):
+                np.testing.assert_allclose(action[key][0], expected[key][0], atol=1e-9)
+        self.assertEqual(env.calls['step'], reference.calls['step'])
+        self.assertLess(env.calls['pose'], reference.calls['pose'])
+
+        records = lmp_env.action_timings
+        self.assertLen(records, 5)
+        self.assertEqual([record['pick'] for record in records], BLOCKS[1:])
+        self.assertFalse(any(record['resolved'] for record in records))
+        self.assertIsNone(records[-1]['drift'])  # the top block is not used again
+        self.assertGreater(records[0]['resolve'], 0.)
+        self.assertEqual(records[1]['resolve'], 0.)
+
+    def test_drift_resolves_remaining_intents(self):
+        reference = StackEnv(drift=(0.005, 0.))
+        self.stack_one_by_one(reference)
+        env = StackEnv(drift=(0.005, 0.))
+        lmp_env = make_wrapper(env)
+        queue = dahlia_run.ActionQueue(lmp_env, tol=0.004)
+        for i in range(len(BLOCKS) - 1):
+            queue.add(BLOCKS[i + 1], BLOCKS[i])
+        records = queue.run()
+
+        self.assertTrue(all(record['resolved'] for record in records[:-1]))
+        for name in BLOCKS:
+            np.testing.assert_allclose(env.positions[name], reference.positions[name])
+
+    def test_positions_and_target(self):
+        env = StackEnv()
+        lmp_env = make_wrapper(env)
+        lmp_env.stack_objects_in_order(BLOCKS[:2], targ=[0.6, 0.3])
+        np.testing.assert_allclose(env.positions[BLOCKS[0]], [0.6, 0.3, 0.02])
+        np.testing.assert_allclose(env.positions[BLOCKS[1]], [0.6, 0.3, 0.06])
+
+    def test_place_poses_follow_the_stack_height(self):
+        lmp_env = make_wrapper(StackEnv())
+        queue = dahlia_run.ActionQueue(lmp_env)
+        intents = [(BLOCKS[0], [0.6, 0.3]), (BLOCKS[1], BLOCKS[0]), (BLOCKS[2], BLOCKS[1])]
+        plan = queue._resolve(intents)
+        # the target itself, then the centers of the blocks already stacked on it
+        np.testing.assert_allclose([place_pose[0][2] for _, _, _, place_pose, _ in plan],
+                                   [0., 0.02, 0.06])
+        np.testing.assert_allclose([rest_pose[0] for *_, rest_pose in plan],
+                                   [[0.6, 0.3, 0.02], [0.6, 0.3, 0.06], [0.6, 0.3, 0.10]])
+
+
+if __name__ == '__main__':
+    absltest.main()
@@ -0,0 +1,54 @@
+"""Tests for executing LLM code with exec_safe."""
+
+from absl.testing import absltest
+
+from cliport import dahlia_run
+
+
+class ExecSafeTest(absltest.TestCase):
+
+    def test_assignments_go_to_lvars(self):
+        fixed_vars, variable_vars = {'np_sum': sum}, {'offset': 2}
+        lvars = {}
+        dahlia_run.exec_safe('total = np_sum([1, 2]) + offset', dahlia_run.LayeredVars(
+            [fixed_vars, variable_vars]), lvars)
+        self.assertEqual(lvars, {'total': 5})
+        self.assertEqual(variable_vars, {'offset': 2})
+
+    def test_functions_see_later_layers_and_changes(self):
+        fixed_vars, variable_vars = {'scale': lambda x: x}, {'scale': lambda x: 10 * x}
+        lvars = {}
+        dahlia_run.exec_safe('def f(x):\n    return scale(x) + bonus()',
+                             dahlia_run.LayeredVars([fixed_vars, variable_vars]), lvars)
+        # functions created after `f` are visible to it
+        variable_vars['bonus'] = lambda: 1
+        self.assertEqual(lvars['f'](2), 21)
+
+    def test_exec_and_eval_are_disabled(self):
+        lvars = {}
+        dahlia_run.exec_safe('a = eval("1")\nb = exec("x = 1")', {}, lvars)
+        self.assertEqual(lvars, {'a': None, 'b': None})
+
+    def test_imports_are_stripped_and_dunders_rejected(self):
+        lvars = {}
+        dahlia_run.exec_safe('import os\nfrom utils import say\nx = 1', {}, lvars)
+        self.assertEqual(lvars, {'x': 1})
+        with self.assertRaises(AssertionError):
+            dahlia_run.exec_safe('x = ().__class__', {}, {})
+
+    def test_code_objects_are_cached(self):
+        dahlia_run.compile_code.cache_clear()
+        for i in range(3):
+            dahlia_run.exec_safe('y = 1 + 1', {}, {})
+        info = dahlia_run.compile_code.cache_info()
+        self.assertEqual((info.hits, info.misses), (2, 1))
+
+    def test_var_exists(self):
+        all_vars = dahlia_run.LayeredVars([{'get_obj_pos': None}, {'np': None}])
+        self.assertTrue(dahlia_run.var_exists('get_obj_pos', all_vars))
+        self.assertTrue(dahlia_run.var_exists('len', all_vars))
+        self.assertFalse(dahlia_run.var_exists('get_top_block', all_vars))
+
+
+if __name__ == '__main__':
+    absltest.main()
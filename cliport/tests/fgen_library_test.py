@@ -0,0 +1,60 @@
+"""Tests for the cross-episode library of generated functions."""
+
+import os
+import tempfile
+
+from absl.testing import absltest
+
+from cliport.utils.fgen_library import STATUS_FAILED
+from cliport.utils.fgen_library import STATUS_OK
+from cliport.utils.fgen_library import FunctionLibrary
+from cliport.utils.fgen_library import text_hash
+
+SOURCE = 'def get_top_block(blocks):\n    return blocks[-1]'
+
+
+class FunctionLibraryTest(absltest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(tempfile.mkdtemp(), 'fgen_library.sqlite')
+        self.key = FunctionLibrary.make_key(
+            'gpt4', 'gpt-4o-mini', 'get_top_block(blocks)',
+            text_hash('get_obj_pos,put_first_on_second'), text_hash('prompt'))
+
+    def test_reuse_across_instances(self):
+        library = FunctionLibrary(self.path)
+        self.assertIsNone(library.lookup(self.key))
+        library.store(self.key, 'get_top_block', 'get_top_block(blocks)', SOURCE, STATUS_OK)
+        library.close()
+
+        library = FunctionLibrary(self.path)
+        self.assertEqual(library.lookup(self.key), SOURCE)
+        self.assertEqual((library.hits, library.misses), (1, 0))
+
+    def test_key_depends_on_model_context_and_prompt(self):
+        api_hash = text_hash('get_obj_pos,put_first_on_second')
+        self.assertNotEqual(self.key, FunctionLibrary.make_key(
+            'gpt4', 'gpt-4o-mini', 'get_top_block(blocks)', text_hash('get_obj_pos'),
+            text_hash('prompt')))
+        self.assertNotEqual(self.key, FunctionLibrary.make_key(
+            'gpt4', 'gpt-4o-mini', 'get_top_block(blocks)', api_hash, text_hash('other prompt')))
+        self.assertNotEqual(self.key, FunctionLibrary.make_key(
+            'llama', 'gpt-4o-mini', 'get_top_block(blocks)', api_hash, text_hash('prompt')))
+        self.assertNotEqual(self.key, FunctionLibrary.make_key(
+            'gpt4', 'gpt-4o', 'get_top_block(blocks)', api_hash, text_hash('prompt')))
+
+    def test_failed_entries_are_not_served(self):
+        library = FunctionLibrary(self.path)
+        library.store(self.key, 'get_top_block', 'get_top_block(blocks)', SOURCE, STATUS_FAILED)
+        self.assertIsNone(library.lookup(self.key))
+        self.assertLen(library, 1)
+
+    def test_stale_entries_are_not_served(self):
+        library = FunctionLibrary(self.path, max_age_days=1e-9)
+        library.store(self.key, 'get_top_block', 'get_top_block(blocks)', SOURCE, STATUS_OK)
+        self.assertIsNone(library.lookup(self.key))
+
+
+if __name__ == '__main__':
+    absltest.main()
@@ -0,0 +1,88 @@
+"""Tests for the vectorized free-space raster."""
+
+import random
+
+import numpy as np
+from absl.testing import absltest
+
+from cliport import dahlia_run
+from cliport.utils.free_space import FreeSpaceRaster
+from cliport.utils.free_space import footprint_distances
+
+
+def random_footprints(rng, n, low=(0.2, -0.55), high=(0.8, 0.55)):
+    centers = rng.uniform(low, high, size=(n, 2))
+    sizes = rng.uniform(0.0005, 0.08, size=(n, 2))  # some smaller than a grid cell
+    return np.concatenate([centers - sizes / 2, centers + sizes / 2], axis=1)
+
+
+class BoxEnv:
+    """Stand-in environment that only knows the bounding boxes of its objects."""
+
+    def __init__(self, boxes):
+        self.boxes = boxes
+        self.object_list = list(boxes)
+
+    def get_bounding_box(self, obj_name):
+        return self.boxes[obj_name]
+
+
+class FreeSpaceRasterTest(absltest.TestCase):
+
+    def test_matches_point_by_point_check(self):
+        rng = np.random.default_rng(0)
+        grid_size = 0.004
+        x_coords = np.arange(0.25, 0.75, grid_size)
+        y_coords = np.arange(-0.5, 0.5, grid_size)
+        points = np.stack(np.meshgrid(x_coords, y_coords, indexing='ij'), axis=-1).reshape(-1, 2)
+        for n_objects in (0, 1, 10, 50):
+            footprints = random_footprints(rng, n_objects)
+            raster = FreeSpaceRaster(x_coords, y_coords, grid_size, footprints, pad=8)
+            for r in (0., 0.01, 0.02):
+                if n_objects:
+                    expected = footprint_distances(points, footprints).min(axis=1) > r
+                else:
+                    expected = np.ones(len(points), dtype=bool)
+                np.testing.assert_array_equal(raster.free_mask(r).ravel(), expected)
+
+
+class GetRandomFreePosTest(absltest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        boxes = {}
+        for i, (x0, y0, x1, y1) in enumerate(random_footprints(np.random.default_rng(1), 10)):
+            boxes[f'block {i}'] = (x0, y0, 0., x1, y1, 0.04)
+        cfg = {'env': {'init_objs': list(boxes), 'coords': dahlia_run.lmp_tabletop_coords}}
+        self.lmp_env = dahlia_run.LMP_wrapper(BoxEnv(boxes), cfg)
+
+    def reference_free_positions(self, targ, r, grid_size):
+        x_coords = np.arange(0.25, 0.75, grid_size)
+        y_coords = np.arange(-0.5, 0.5, grid_size)
+        return [(x, y, 0.001) for x in x_coords for y in y_coords
+                if np.linalg.norm(np.array([x, y, 0.001]) - np.array(targ)) > r
+                and not self.lmp_env.is_target_occupied((x, y, 0.001), r)]
+
+    def test_same_sample_as_point_by_point_search(self):
+        for seed in range(3):
+            free_positions = self.reference_free_positions([0.5, 0., 0], 0.03, 0.01)
+            random.seed(seed)
+            expected = list(random.choice(free_positions))
+            random.seed(seed)
+            pos, rot = self.lmp_env.get_random_free_pos([0.5, 0., 0.], r=0.03, grid_size=0.01)
+            self.assertEqual(pos, expected)
+            self.assertEqual(rot, [0, 0, 0, 1])
+
+    def test_raster_is_reused_until_objects_move(self):
+        self.lmp_env.get_random_free_pos(grid_size=0.01)
+        raster = self.lmp_env._free_space[1]
+        self.lmp_env.get_random_free_pos(grid_size=0.01)
+        self.assertIs(self.lmp_env._free_space[1], raster)
+        self.lmp_env.env.boxes['block 0'] = (0.3, 0.3, 0., 0.34, 0.34, 0.04)
+        self.lmp_env.invalidate_world()
+        self.lmp_env.get_random_free_pos(grid_size=0.01)
+        self.assertIsNot(self.lmp_env._free_space[1], raster)
+
+
+if __name__ == '__main__':
+    absltest.main()
@@ -0,0 +1,103 @@
+"""Tests for batched pose matching in Task.oracle and Task.reward."""
+
+import numpy as np
+import pybullet as p
+from absl.testing import absltest
+
+from cliport.tasks.task import Task
+from cliport.utils import utils
+
+
+def random_quats(rng, n):
+    quats = rng.normal(size=(n, 4))
+    quats[:n // 4, :2] = 0  # rotations around z only
+    quats[n // 4:n // 2] /= np.linalg.norm(quats[n // 4:n // 2], axis=1, keepdims=True)
+    quats[-3:] = [[0.5, 0.5, 0.5, 0.5], [np.sqrt(0.5), 0, 0, np.sqrt(0.5)], [0, 0, 0, 0]]
+    return quats
+
+
+class GoalMatchingTest(absltest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.client = p.connect(p.DIRECT)
+
+    @classmethod
+    def tearDownClass(cls):
+        p.disconnect(cls.client)
+        super().tearDownClass()
+
+    def test_yaw_matches_euler_conversion(self):
+        quats = random_quats(np.random.RandomState(0), 2000)
+        expected = [utils.quatXYZW_to_eulerXYZ(tuple(q))[2] for q in quats]
+        np.testing.assert_array_equal(utils.quatXYZW_to_eulerZ(quats), expected)
+
+    def test_matches_is_match(self):
+        rng = np.random.RandomState(0)
+        task = Task()
+        # poses spread around the thresholds of position, height and rotation
+        poses0 = [(tuple(0.5 + rng.normal(0, 0.04, 3)), tuple(q))
+                  for q in random_quats(rng, 40)]
+        poses1 = [(tuple(0.5 + rng.normal(0, 0.04, 3)), tuple(q))
+                  for q in random_quats(rng, 30)]
+        poses1 += [tuple(0.5 + rng.normal(0, 0.04, 3)) for _ in range(5)]  # no rotation
+        symmetries = rng.choice([0, np.pi / 2, np.pi, 2 * np.pi, False], len(poses0))
+        for consider_z in (False, True):
+            is_match = task.match_poses(poses0, poses1, symmetries, consider_z=consider_z)
+            expected = [[task.is_match(pose0, pose1, symmetry, consider_z=consider_z)
+                         for pose1 in poses1] for pose0, symmetry in zip(poses0, symmetries)]
+            np.testing.assert_array_equal(is_match, expected)
+            self.assertTrue(0 < is_match.sum() < is_match.size)
+
+    def make_goal(self, n_objects=6):
+        p.resetSimulation()
+        shape = p.createCollisionShape(p.GEOM_BOX, halfExtents=[0.02] * 3)
+        objs, targs = [], []
+        for i in range(n_objects):
+            pos = [0.3 + 0.05 * i, -0.2 + 0.02 * i, 0.02]
+            objs.append((p.createMultiBody(0.1, shape, basePosition=pos), (np.pi / 2, None)))
+            # every other object is already on its target
+            targs.append(((pos[0], pos[1] + (0.2 if i % 2 else 0.01), 0.02), (0, 0, 0, 1)))
+        return objs, targs
+
+    def test_reward_counts_matched_objects(self):
+        objs, targs = self.make_goal()
+        task = Task()
+        matches = np.eye(len(objs))
+        matches[1, 0] = 1  # matching another object's target counts too
+        p.resetBasePositionAndOrientation(objs[1][0], targs[0][0], [0, 0, 0, 1])
+        task.goals = [(objs, matches, targs, False, True, 'pose', None, 1)]
+        reward, _ = task.reward()
+
+        expected = 0
+        for i, (obj_id, (symmetry, _)) in enumerate(objs):
+            pose = p.getBasePositionAndOrientation(obj_id)
+            if any(task.is_match(pose, targs[j], symmetry, consider_z=True)
+                   for j in np.flatnonzero(matches[i])):
+                expected += 1 / len(objs)
+        self.assertEqual(reward, expected)
+        self.assertAlmostEqual(reward, 4 / 6)
+
+    def test_oracle_moves_farthest_unmatched_object(self):
+        objs, targs = self.make_goal()
+        task = Task()
+        task.goals = [(objs, np.ones((len(objs), len(objs))), targs, False, True, 'pose',
+                       None, 1)]
+        mask = np.zeros((320, 160), dtype=np.int32)
+        for obj_id, _ in objs:
+            u, v = utils.xyz_to_pix(p.getBasePositionAndOrientation(obj_id)[0], task.bounds,
+                                    task.pix_size)
+            mask[u - 5:u + 6, v - 5:v + 6] = obj_id
+        task.get_true_image = lambda env: (None, np.zeros(mask.shape, np.float32), mask)
+
+        act = task.oracle(None).act(None, None)
+        # objects 0, 2 and 4 and their targets are matched already, object 1 is the
+        # farthest from the remaining targets 1, 3 and 5
+        pick = p.getBasePositionAndOrientation(objs[1][0])[0]
+        np.testing.assert_allclose(act['pose0'][0][:2], pick[:2], atol=0.02)
+        np.testing.assert_allclose(act['pose1'][0][:2], targs[1][0][:2], atol=0.02)
+
+
+if __name__ == '__main__':
+    absltest.main()
@@ -0,0 +1,102 @@
+"""Tests for encoding VLM frames off-thread and reusing their payloads."""
+
+import base64
+import io
+import os
+import tempfile
+
+import numpy as np
+from absl.testing import absltest
+from PIL import Image
+
+from cliport import dahlia_run
+from cliport.utils.image_encoding import ImageEncoder, encode_frame
+from cliport.utils.llm_backends import FakeBackend
+from cliport.utils.llm_cache import CacheMissError, ResponseCache
+
+
+def decode(payload):
+    return Image.open(io.BytesIO(base64.b64decode(payload)))
+
+
+def frames():
+    rng = np.random.RandomState(0)
+    color = rng.randint(0, 255, (480, 640, 3), dtype=np.uint8)
+    depth = rng.uniform(0., 1., (480, 640)).astype(np.float32)
+    return (color, 'c'), (depth, 'd')
+
+
+class ImageEncodingTest(absltest.TestCase):
+
+    def test_downsamples_to_max_side(self):
+        color, depth = frames()
+        self.assertEqual(decode(encode_frame(*color)).size, (640, 480))
+        image = decode(encode_frame(*color, max_side=320))
+        self.assertEqual((image.size, image.mode), ((320, 240), 'RGB'))
+        image = decode(encode_frame(*depth, max_side=320))
+        self.assertEqual((image.size, image.mode), ((320, 240), 'L'))
+
+    def test_matches_synchronous_encoding(self):
+        encoder = ImageEncoder(max_side=256)
+        self.assertEqual(encoder.encode(frames()),
+                         [encode_frame(*source, max_side=256) for source in frames()])
+
+    def test_memoises_by_frame_identity(self):
+        color, depth = frames()
+        encoder = ImageEncoder()
+        encoder.submit([color, depth])
+        payloads = encoder.encode([color, depth, (color[0].copy(), 'c')])
+        self.assertEqual((encoder.n_encoded, encoder.n_reused), (3, 2))
+        self.assertEqual(payloads[0], payloads[2])  # equal content, encoded again
+
+        encoder.clear()
+        encoder.encode([color])
+        self.assertEqual(encoder.n_encoded, 4)
+
+    def test_check_reuses_prefetched_initial_frames(self):
+        sizes = []
+
+        def respond(messages):
+            sizes.append([len(part['image_url']['url']) for part in messages[-1]['content']
+                          if part['type'] == 'image_url'])
+            return 'judge = True'
+
+        cfg = dict(dahlia_run.cfg_tabletop['lmps']['VLM'], image_max_side=320)
+        lmp = dahlia_run.LMPV('VLM_ui', (cfg, 'gpt4'), FakeBackend(respond=respond))
+        initial, final = frames(), frames()
+        lmp.prefetch_images(initial)
+        dahlia_run.answer = ''
+        self.assertTrue(lmp('check', [*initial, *final]))
+        self.assertTrue(lmp('check again', [*initial, *final]))
+
+        self.assertEqual((lmp.images.n_encoded, lmp.images.n_reused), (4, 6))
+        self.assertLen(sizes, 2)
+        self.assertEqual(sizes[0], sizes[1])
+        self.assertLen(sizes[0], 4)
+
+    def test_check_goes_through_the_response_cache(self):
+        n_calls = []
+
+        def respond(messages):
+            n_calls.append(1)
+            return 'judge = True'
+
+        path = os.path.join(tempfile.mkdtemp(), 'responses.sqlite')
+        cfg = dahlia_run.cfg_tabletop['lmps']['VLM']
+        lmp = dahlia_run.LMPV('VLM_ui', (cfg, 'gpt4'), FakeBackend(respond=respond),
+                              response_cache=ResponseCache(path))
+        dahlia_run.answer = ''
+        self.assertTrue(lmp('check', [*frames()]))
+
+        lmp = dahlia_run.LMPV('VLM_ui', (cfg, 'gpt4'), FakeBackend(respond=respond),
+                              response_cache=ResponseCache(path, mode='replay'))
+        self.assertTrue(lmp('check', [*frames()]))
+        self.assertLen(n_calls, 1)
+        # other frames are another request
+        color, depth = frames()
+        with self.assertRaises(CacheMissError):
+            lmp('check', [(color[0][::-1].copy(), 'c'), depth])
+
+
+if __name__ == '__main__':
+    absltest.main()
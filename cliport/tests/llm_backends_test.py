@@ -0,0 +1,240 @@
+"""Tests for the shared LLM backend layer, run offline."""
+
+import asyncio
+import json
+import random
+import threading
+import time
+from unittest import mock
+
+import openai
+import requests
+from openai import api_requestor
+import torch
+from absl.testing import absltest
+from transformers import LlamaConfig
+from transformers import LlamaForCausalLM
+
+from cliport.utils.llm_backends import FakeBackend
+from cliport.utils.llm_backends import HFBackend
+from cliport.utils.llm_backends import OpenAIBackend
+from cliport.utils.llm_backends import RetryableError
+from cliport.utils.llm_backends import TokenBucket
+from cliport.utils.llm_backends import backoff_delay
+from cliport.utils.llm_backends import parse_retry_after
+
+MESSAGES = [{'role': 'user', 'content': '# stack the blocks.'}]
+
+
+class BackoffTest(absltest.TestCase):
+
+    def test_exponential_with_jitter(self):
+        rng = random.Random(0)
+        for attempt in range(6):
+            delays = [backoff_delay(attempt, base=1., max_delay=10., rng=rng) for _ in range(50)]
+            self.assertLessEqual(max(delays), min(10., 2 ** attempt))
+            self.assertGreater(len(set(delays)), 1)
+
+    def test_honours_retry_after(self):
+        self.assertGreaterEqual(backoff_delay(0, base=0.01, retry_after=3.), 3.)
+        self.assertEqual(parse_retry_after({'retry-after': '2'}), 2.)
+        self.assertIsNone(parse_retry_after({'retry-after': 'Wed, 21 Oct 2015 07:28:00 GMT'}))
+        self.assertIsNone(parse_retry_after(None))
+
+
+class TokenBucketTest(absltest.TestCase):
+
+    def test_rate_is_enforced(self):
+        bucket = TokenBucket(rate=50., capacity=1)
+        start = time.monotonic()
+        for _ in range(6):
+            bucket.acquire()
+        # the first token is free, the remaining five are paced at 50/s
+        self.assertGreaterEqual(time.monotonic() - start, 5 / 50. * 0.9)
+
+
+class FakeBackendTest(absltest.TestCase):
+
+    def test_retries_injected_errors(self):
+        backend = FakeBackend('say("hi")', error_rate=0.5, backoff_base=0.001, max_retries=50,
+                              seed=0)
+        for _ in range(10):
+            self.assertEqual(backend.complete(MESSAGES), 'say("hi")')
+        self.assertEqual(backend.calls, 10 + backend.errors)
+        self.assertGreater(backend.errors, 0)
+
+    def test_gives_up_after_max_retries(self):
+        backend = FakeBackend('', error_rate=1., backoff_base=0.001, max_retries=2)
+        with self.assertRaises(RetryableError):
+            backend.complete(MESSAGES)
+        self.assertEqual(backend.calls, 3)
+
+    def test_shared_rate_limiter(self):
+        bucket = TokenBucket(rate=100., capacity=1)
+        backends = [FakeBackend('', rate_limiter=bucket) for _ in range(3)]
+        start = time.monotonic()
+        for _ in range(3):
+            for backend in backends:
+                backend.complete(MESSAGES)
+        self.assertGreaterEqual(time.monotonic() - start, 8 / 100. * 0.9)
+
+    def test_async_calls_overlap(self):
+        backend = FakeBackend(lambda messages: messages[-1]['content'], latency=0.1,
+                              tail_latency=0.2, tail_prob=0.25, seed=1)
+
+        async def run():
+            return await asyncio.gather(*[
+                backend.acomplete([{'role': 'user', 'content': str(i)}]) for i in range(8)])
+
+        start = time.monotonic()
+        answers = asyncio.run(run())
+        elapsed = time.monotonic() - start
+        self.assertEqual(answers, [str(i) for i in range(8)])
+        # concurrent calls are bounded by the slowest one rather than the sum
+        self.assertLess(elapsed, 0.8)
+
+
+def chat_response(content):
+    response = requests.Response()
+    response.status_code = 200
+    response.headers['Content-Type'] = 'application/json'
+    response._content = json.dumps({'choices': [{'message': {'content': content}}]}).encode()
+    return response
+
+
+class OpenAIBackendTest(absltest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        for name, value in (('api_key', 'test-key'), ('requestssession', None)):
+            patcher = mock.patch.object(openai, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_sizes_the_sessions_openai_makes(self):
+        backends = [OpenAIBackend(pool_size=2), OpenAIBackend(pool_size=4)]
+        sessions = []
+
+        def request(session, *args, **kwargs):
+            sessions.append(session)
+            return chat_response('ok')
+
+        def complete():
+            # a new thread, for which openai makes a new session
+            self.assertEqual(backends[0].complete(MESSAGES, model='gpt-4'), 'ok')
+
+        with mock.patch.object(openai, 'proxy', 'http://proxy:3128'), \
+                mock.patch.object(requests.Session, 'request', autospec=True,
+                                  side_effect=request):
+            thread = threading.Thread(target=complete)
+            thread.start()
+            thread.join()
+        self.assertLen(sessions, 1)
+        adapter = sessions[0].get_adapter('https://api.openai.com')
+        self.assertEqual(adapter._pool_maxsize, 4)
+        self.assertEqual(adapter.max_retries.total, api_requestor.MAX_CONNECTION_RETRIES)
+        self.assertEqual(sessions[0].proxies,
+                         {'http': 'http://proxy:3128', 'https': 'http://proxy:3128'})
+
+        backends[1].close()
+        self.assertIsNotNone(openai.requestssession)
+        backends[0].close()
+        self.assertIsNone(openai.requestssession)
+
+    def test_keeps_a_session_hook_set_by_the_user(self):
+        session = requests.Session()
+        openai.requestssession = session
+        backend = OpenAIBackend()
+        backend.close()
+        self.assertIs(openai.requestssession, session)
+
+    def test_async_calls_use_the_backend_aiohttp_session(self):
+        backend = OpenAIBackend()
+        self.addCleanup(backend.close)
+        sessions = []
+
+        async def acreate(**kwargs):
+            sessions.append(openai.aiosession.get())
+            await asyncio.sleep(0.1)
+            return {'choices': [{'message': {'content': kwargs['messages'][-1]['content']}}]}
+
+        async def run():
+            answers = await asyncio.gather(*[
+                backend.acomplete([{'role': 'user', 'content': str(i)}]) for i in range(4)])
+            session = backend._aiosession()
+            await backend.aclose()
+            return answers, session
+
+        with mock.patch.object(openai.ChatCompletion, 'acreate', acreate):
+            start = time.monotonic()
+            answers, session = asyncio.run(run())
+        self.assertLess(time.monotonic() - start, 0.3)
+        self.assertEqual(answers, ['0', '1', '2', '3'])
+        self.assertEqual(sessions, [session] * 4)
+        self.assertTrue(session.closed)
+        self.assertIsNone(openai.aiosession.get())
+
+
+class CharTokenizer:
+    """Character-level tokenizer with a minimal chat template."""
+
+    eos_token_id = 1
+
+    def convert_tokens_to_ids(self, token):
+        return 2
+
+    def apply_chat_template(self, messages, add_generation_prompt=False):
+        text = ''.join(f'<{m["role"]}>{m["content"]}</s>' for m in messages)
+        if add_generation_prompt:
+            text += '<assistant>'
+        return [3 + ord(c) % 120 for c in text]
+
+    def decode(self, ids, skip_special_tokens=True):
+        return ''.join(chr(int(i)) for i in ids)
+
+
+class PrefixCacheTest(absltest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        torch.manual_seed(0)
+        config = LlamaConfig(vocab_size=128, hidden_size=32, intermediate_size=64,
+                             num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=4,
+                             max_position_embeddings=4096)
+        self.model = LlamaForCausalLM(config).eval()
+        self.tokenizer = CharTokenizer()
+        self.prefix = '# example: stack the blocks.\nstack_objects_in_order(blocks)\n' * 10
+
+    def _inputs(self, query):
+        messages = [{'role': 'system', 'content': 'You only answer with python code'},
+                    {'role': 'user', 'content': f'{self.prefix}\n{query}'}]
+        prefix_messages = messages[:-1] + [{'role': 'user', 'content': self.prefix}]
+        return self.tokenizer.apply_chat_template(messages, True), prefix_messages
+
+    def test_cached_prefix_matches_full_prefill(self):
+        cached = HFBackend(self.model, self.tokenizer)
+        uncached = HFBackend(self.model, self.tokenizer, prefix_caching=False)
+        prefill_lens = []
+
+        def record_input_len(module, args, kwargs):
+            input_ids = kwargs['input_ids'] if 'input_ids' in kwargs else args[0]
+            prefill_lens.append(input_ids.shape[-1])
+
+        self.model.register_forward_pre_hook(record_input_len, with_kwargs=True)
+
+        for query in ['# put the red block in the bowl.', '# stack all blocks.']:
+            input_ids, prefix_messages = self._inputs(query)
+            prefill_lens.clear()
+            expected = uncached.generate_ids(input_ids, max_new_tokens=12, do_sample=False)
+            self.assertEqual(prefill_lens[0], len(input_ids))
+
+            prefill_lens.clear()
+            actual = cached.generate_ids(input_ids, prefix_messages=prefix_messages,
+                                         max_new_tokens=12, do_sample=False)
+            self.assertEqual(actual.tolist(), expected.tolist())
+            # only the query suffix is prefilled once the prefix is cached
+            self.assertLess(prefill_lens[-12], len(self.prefix) // 2)
+
+
+if __name__ == '__main__':
+    absltest.main()
@@ -0,0 +1,98 @@
+"""Tests for the LLM response cache."""
+
+import os
+import sqlite3
+import tempfile
+
+from absl.testing import absltest
+
+from cliport.utils.llm_cache import CacheMissError
+from cliport.utils.llm_cache import ResponseCache
+
+
+class StubBackend:
+    """Deterministic stand-in for a model endpoint that counts its calls."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, prompt):
+        self.calls += 1
+        return f'say("{len(prompt)}")'
+
+
+class ResponseCacheTest(absltest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(tempfile.mkdtemp(), 'responses.sqlite')
+
+    def _key(self, prompt):
+        return ResponseCache.make_key('gpt4', 'gpt-4o-mini', 0, 2048, ['#'], prompt)
+
+    def test_rerun_makes_no_model_calls(self):
+        backend = StubBackend()
+        prompts = [f'# put the block {i} in the bowl.' for i in range(5)]
+
+        cache = ResponseCache(self.path, mode='record')
+        first = [cache.get_or_call(self._key(q), lambda q=q: backend(q)) for q in prompts]
+        self.assertEqual(backend.calls, 5)
+        self.assertEqual(cache.hit_rate, 0.)
+        cache.close()
+
+        cache = ResponseCache(self.path, mode='replay')
+        second = [cache.get_or_call(self._key(q), lambda q=q: backend(q)) for q in prompts]
+        self.assertEqual(backend.calls, 5)
+        self.assertEqual(cache.hit_rate, 1.)
+        self.assertEqual(first, second)
+
+    def test_key_depends_on_sampling_params(self):
+        key = self._key('prompt')
+        self.assertNotEqual(
+            key, ResponseCache.make_key('gpt4', 'gpt-4o-mini', 0.7, 2048, ['#'], 'prompt'))
+        self.assertNotEqual(
+            key, ResponseCache.make_key('gpt4', 'gpt-4o-mini', 0, 2048, [], 'prompt'))
+        self.assertNotEqual(
+            key, ResponseCache.make_key('llama', 'gpt-4o-mini', 0, 2048, ['#'], 'prompt'))
+
+    def test_replay_miss_raises(self):
+        cache = ResponseCache(self.path, mode='replay')
+        with self.assertRaises(CacheMissError):
+            cache.get_or_call(self._key('unseen'), lambda: 'code')
+
+    def test_off_mode_always_calls(self):
+        backend = StubBackend()
+        cache = ResponseCache(self.path, mode='off')
+        for _ in range(3):
+            cache.get_or_call(self._key('prompt'), lambda: backend('prompt'))
+        self.assertEqual(backend.calls, 3)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_lru_eviction(self):
+        cache = ResponseCache(self.path, mode='record', max_entries=2)
+        cache.put('a', '1')
+        cache.put('b', '2')
+        self.assertEqual(cache.get('a'), '1')  # 'b' is now least recently used
+        cache.put('c', '3')
+        self.assertLen(cache, 2)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), '1')
+        self.assertEqual(cache.get('c'), '3')
+
+    def test_hits_do_not_wait_for_other_writers(self):
+        cache = ResponseCache(self.path, mode='record')
+        cache.put('a', '1')
+        other = sqlite3.connect(self.path)
+        other.execute('BEGIN IMMEDIATE')  # another worker in the middle of a write
+        try:
+            self.assertEqual(cache.get('a'), '1')
+        finally:
+            other.rollback()
+            other.close()
+        cache.close()
+        cache = ResponseCache(self.path, mode='record')
+        self.assertEqual(cache.get('a'), '1')
+
+
+if __name__ == '__main__':
+    absltest.main()
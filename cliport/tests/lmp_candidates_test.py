@@ -0,0 +1,124 @@
+"""Tests for sampling planner candidates and keeping the first clean dry run."""
+
+import itertools
+import threading
+import time
+
+from absl.testing import absltest
+
+from cliport import dahlia_run
+from cliport.utils import watchdog
+from cliport.utils.llm_backends import FakeBackend
+
+
+class FakeSandbox:
+    """Scene of named positions with snapshots and a workspace check."""
+
+    def __init__(self):
+        self.positions = {'block': 0.5}
+        self.snapshots = []
+        self.n_restored = 0
+
+    def move(self, name, pos):
+        watchdog.tick(actions=1)
+        self.positions[name] = pos
+
+    def snapshot(self):
+        self.snapshots.append(dict(self.positions))
+        return len(self.snapshots) - 1
+
+    def restore(self, snap):
+        self.positions = dict(self.snapshots[snap])
+        self.n_restored += 1
+
+    def discard(self, snap):
+        self.snapshots[snap] = None
+
+    def check_scene(self):
+        return all(0. <= pos <= 1. for pos in self.positions.values())
+
+
+def make_lmp(responses, delays, sandbox, n_candidates=4):
+    counter = itertools.count()
+    lock = threading.Lock()
+
+    def respond(messages):
+        with lock:
+            i = next(counter)
+        time.sleep(delays[i])
+        return responses[i]
+
+    cfg = {
+        'prompt_text': '# move the block.\nmove("block", 0.2)',
+        'engine': lambda: 'fake-model',
+        'max_tokens': lambda: 256,
+        'temperature': 0,
+        'query_prefix': '# ',
+        'query_suffix': '.',
+        'stop': ['#'],
+        'maintain_session': False,
+        'debug_mode': False,
+        'include_context': True,
+        'has_return': False,
+        'n_candidates': n_candidates,
+        'candidate_temperature': 0.7,
+        'candidate_max_steps': 3,
+        'candidate_timeout': 10.,
+    }
+    backend = FakeBackend(respond=respond)
+    variable_vars = {'move': sandbox.move}
+    lmp_fgen = dahlia_run.LMPFGen((dict(cfg, stop=['# define']), 'fake'), {}, variable_vars,
+                                  backend=backend)
+    return dahlia_run.LMP('tabletop_ui', (cfg, 'fake'), lmp_fgen, {}, variable_vars,
+                          backend=backend, sandbox=sandbox), variable_vars
+
+
+class LMPCandidatesTest(absltest.TestCase):
+
+    def test_keeps_first_clean_dry_run(self):
+        sandbox = FakeSandbox()
+        responses = [
+            'move("block", 0.1)\nassert False',  # raises
+            'for _ in range(5):\n    move("block", 0.1)',  # over the step budget
+            'move("block", 1.5)',  # leaves the workspace
+            'moved = True\nmove("block", 0.3)',  # clean, arrives last
+        ]
+        lmp, variable_vars = make_lmp(responses, [0., 0.05, 0.1, 0.15], sandbox)
+        dahlia_run.answer = ''
+        lmp('move the block', context='')
+
+        self.assertEqual(sandbox.positions, {'block': 0.3})
+        self.assertEqual(sandbox.n_restored, 3)
+        self.assertEqual(dahlia_run.answer.count('rejected'), 3)
+        self.assertIn('moved = True', dahlia_run.answer)
+        self.assertNotIn('moved', variable_vars)  # no session, locals stay local
+
+    def test_rolls_back_mutated_data(self):
+        sandbox = FakeSandbox()
+        responses = ['placed.append("block")\nassert False', 'placed.append("bowl")']
+        lmp, variable_vars = make_lmp(responses, [0., 0.05], sandbox, n_candidates=2)
+        variable_vars['placed'] = []
+        lmp('move the block', context='')
+        self.assertEqual(variable_vars['placed'], ['bowl'])
+        self.assertEqual(variable_vars['move'], sandbox.move)  # functions are not copied
+
+    def test_does_not_wait_for_slower_candidates(self):
+        sandbox = FakeSandbox()
+        lmp, _ = make_lmp(['move("block", 0.3)'] * 4, [0., 1., 1., 1.], sandbox)
+        start = time.perf_counter()
+        lmp('move the block', context='')
+        self.assertLess(time.perf_counter() - start, 0.5)
+        self.assertEqual(sandbox.n_restored, 0)
+
+    def test_raises_first_error_when_all_fail(self):
+        sandbox = FakeSandbox()
+        responses = ['move("block", 0.1)\nassert False', 'move("block", 2.)']
+        lmp, _ = make_lmp(responses, [0., 0.05], sandbox, n_candidates=2)
+        with self.assertRaises(AssertionError):
+            lmp('move the block', context='')
+        self.assertEqual(sandbox.positions, {'block': 0.5})
+        self.assertEqual(sandbox.snapshots, [None, None])
+
+
+if __name__ == '__main__':
+    absltest.main()
@@ -0,0 +1,86 @@
+"""Tests for function generation in LMPFGen."""
+
+import re
+import time
+
+from absl.testing import absltest
+
+from cliport import dahlia_run
+from cliport.utils.llm_backends import FakeBackend
+
+LATENCY = 0.2
+
+# call graph a -> (c, d), b -> (d, e): two depths, five functions
+SOURCES = {
+    'a': 'def a(x):\n    return c(x) + d(x)',
+    'b': 'def b(x):\n    return d(x) * e(x)',
+    'c': 'def c(x):\n    return x + 1',
+    'd': 'def d(x):\n    return x * 2',
+    'e': 'def e(x):\n    return x - 3',
+}
+
+
+def make_fgen(backend, max_workers=8):
+    cfg = {
+        'prompt_text': '# define function: f(x).\ndef f(x):\n    return x',
+        'engine': lambda: 'fake-model',
+        'max_tokens': lambda: 256,
+        'temperature': 0,
+        'query_prefix': '# define function: ',
+        'query_suffix': '.',
+        'stop': ['# define', '# example'],
+        'max_workers': max_workers,
+    }
+    return dahlia_run.LMPFGen((cfg, 'fake'), {}, {}, backend=backend)
+
+
+def make_responder(delays):
+    """Answer with the source of the queried function after its own extra delay."""
+
+    def respond(messages):
+        f_name = re.findall(r'# define function: (\w+)\(', messages[-1]['content'])[-1]
+        time.sleep(delays[f_name])
+        return SOURCES[f_name]
+
+    return respond
+
+
+class CreateNewFsTest(absltest.TestCase):
+
+    def test_same_depth_is_generated_concurrently(self):
+        backend = FakeBackend(respond=make_responder(dict.fromkeys(SOURCES, 0.)), latency=LATENCY)
+        fgen = make_fgen(backend)
+
+        start = time.perf_counter()
+        new_fs = fgen.create_new_fs_from_code('y = a(1) + b(2)')
+        elapsed = time.perf_counter() - start
+
+        self.assertEqual(backend.calls, 5)
+        # two depths of concurrent calls instead of five serial ones
+        self.assertLess(elapsed, 3 * LATENCY)
+        self.assertEqual(new_fs['a'](1), 4)
+        self.assertEqual(new_fs['b'](5), 20)
+
+    def test_result_does_not_depend_on_completion_order(self):
+        results = []
+        for delays in ({'a': 0., 'b': .1, 'c': 0., 'd': .1, 'e': .05},
+                       {'a': .1, 'b': 0., 'c': .1, 'd': 0., 'e': .05}):
+            dahlia_run.answer = ''
+            fgen = make_fgen(FakeBackend(respond=make_responder(delays)))
+            new_fs, srcs = fgen.create_new_fs_from_code('y = a(1) + b(2)', return_src=True)
+            results.append((list(new_fs), srcs, dahlia_run.answer))
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0][0], ['c', 'd', 'a', 'e', 'b'])
+
+    def test_serial_matches_concurrent(self):
+        outputs = []
+        for max_workers in (1, 8):
+            fgen = make_fgen(FakeBackend(respond=make_responder(dict.fromkeys(SOURCES, 0.))),
+                             max_workers=max_workers)
+            new_fs, srcs = fgen.create_new_fs_from_code('y = a(1) + b(2)', return_src=True)
+            outputs.append((list(new_fs), srcs))
+        self.assertEqual(outputs[0], outputs[1])
+
+
+if __name__ == '__main__':
+    absltest.main()
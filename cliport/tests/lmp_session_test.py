@@ -0,0 +1,103 @@
+"""Tests for reusing the LMP stack across episodes."""
+
+import os
+import tempfile
+from unittest import mock
+
+from absl.testing import absltest
+
+from cliport import dahlia_run
+from cliport.utils.fgen_library import FunctionLibrary
+from cliport.utils.llm_backends import FakeBackend
+from cliport.utils.llm_cache import ResponseCache
+
+PLAN = "total = get_top_block(objects)\nsay(f'top: {total}')"
+TOP_BLOCK = 'def get_top_block(objects):\n    return objects[-1]'
+
+
+class FakeEnv:
+
+    def __init__(self, object_list):
+        self.object_list = object_list
+
+
+def respond(messages):
+    if messages[-1]['content'].endswith('get_top_block(objects).'):
+        return TOP_BLOCK
+    return PLAN
+
+
+class LMPSessionTest(absltest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.backend = FakeBackend(respond=respond)
+        self.session = dahlia_run.LMPSession(dahlia_run.cfg_tabletop, 'fake',
+                                             backend=self.backend)
+
+    def test_reset_rebinds_env_and_keeps_lmps(self):
+        lmp = self.session.reset(FakeEnv(['red block', 'blue bowl']))
+        self.assertEqual(self.session.variable_vars['get_obj_names'](), ['red block', 'blue bowl'])
+
+        self.assertIs(self.session.reset(FakeEnv(['green block'])), lmp)
+        self.assertEqual(self.session.variable_vars['get_obj_names'](), ['green block'])
+        self.assertTrue(self.session.variable_vars['is_obj_visible']('green block'))
+
+    def test_reset_clears_episode_state(self):
+        api_names = set(self.session.variable_vars)
+        lmp = self.session.reset(FakeEnv(['red block']))
+        lmp('stack the blocks', "objects = ['red block']")
+        self.assertIn('get_top_block', self.session.variable_vars)
+        self.assertNotEqual(lmp.exec_hist, '')
+        self.assertEqual(self.session.lmp_fgen.n_generated, 1)
+
+        lmp = self.session.reset(FakeEnv(['red block']))
+        self.assertEqual(set(self.session.variable_vars), api_names)
+        self.assertEqual(lmp.exec_hist, '')
+        self.assertEqual(lmp.prompt_tokens, [])
+        self.assertEqual(self.session.lmp_fgen.n_generated, 0)
+
+    def test_episodes_match_fresh_setup(self):
+        env = FakeEnv(['red block', 'blue block'])
+        for _ in range(2):
+            dahlia_run.answer = ''
+            self.session.reset(env)('stack the blocks', f'objects = {env.object_list}')
+            reused = dahlia_run.answer
+
+        dahlia_run.answer = ''
+        dahlia_run.setup_LMP(env, dahlia_run.cfg_tabletop, 'fake', backend=self.backend)(
+            'stack the blocks', f'objects = {env.object_list}')
+        self.assertEqual(reused, dahlia_run.answer)
+
+
+class TestWorkerTest(absltest.TestCase):
+
+    def test_episodes_report_cache_counters(self):
+        root = tempfile.mkdtemp()
+        response_cache = ResponseCache(os.path.join(root, 'responses.sqlite'))
+        function_library = FunctionLibrary(os.path.join(root, 'fgen_library.sqlite'))
+        session = dahlia_run.LMPSession(dahlia_run.cfg_tabletop, 'fake',
+                                        backend=FakeBackend(respond=respond),
+                                        response_cache=response_cache,
+                                        function_library=function_library)
+        env = FakeEnv(['red block'])
+
+        def run_test_episode(env, cfg, llm, seed, session):
+            session.reset(env)('stack the blocks', f'objects = {env.object_list}')
+            return {'seed': seed}
+
+        worker = dict(cfg=None, llm='fake', env=env, session=session,
+                      response_cache=response_cache, function_library=function_library)
+        with mock.patch.dict(dahlia_run._test_worker, worker), \
+                mock.patch.object(dahlia_run, 'run_test_episode', run_test_episode):
+            first = dahlia_run._run_test_worker_episode(0)
+            second = dahlia_run._run_test_worker_episode(2)
+        # the planner and FGen responses, FGen is then served from the library
+        self.assertEqual(first, {'seed': 0, 'cache_hits': 0, 'cache_misses': 2,
+                                 'library_hits': 0, 'library_misses': 1})
+        self.assertEqual(second, {'seed': 2, 'cache_hits': 1, 'cache_misses': 0,
+                                  'library_hits': 1, 'library_misses': 0})
+
+
+if __name__ == '__main__':
+    absltest.main()
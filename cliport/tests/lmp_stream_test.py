@@ -0,0 +1,121 @@
+"""Tests for streaming, statement-level execution of LMP completions."""
+
+import time
+
+from absl.testing import absltest
+
+from cliport import dahlia_run
+from cliport.utils.llm_backends import FakeBackend
+
+CODE = '''objects = ['red block', 'blue bowl']
+# comments stay with the next statement
+for obj in objects:
+    act(obj)
+if len(objects) > 3:
+    act('many')
+else:
+    act('few')
+total = sum([
+    1,
+    2,
+])
+act(total)'''
+
+
+def make_lmp(backend, variable_vars, stream=True):
+    cfg = {
+        'prompt_text': '# pick up the block.\nact("block")',
+        'engine': lambda: 'fake-model',
+        'max_tokens': lambda: 256,
+        'temperature': 0,
+        'query_prefix': '# ',
+        'query_suffix': '.',
+        'stop': ['#', 'objects = ['],
+        'maintain_session': False,
+        'debug_mode': False,
+        'include_context': True,
+        'has_return': True,
+        'return_val_name': 'whole_answer',
+        'stream': stream,
+    }
+    fgen_cfg = dict(cfg, query_prefix='# define function: ', stop=['# define'])
+    lmp_fgen = dahlia_run.LMPFGen((fgen_cfg, 'fake'), {}, variable_vars, backend=FakeBackend())
+    return dahlia_run.LMP('tabletop_ui', (cfg, 'fake'), lmp_fgen, {}, variable_vars,
+                          backend=backend)
+
+
+class StatementStreamTest(absltest.TestCase):
+
+    def test_split_char_by_char(self):
+        statements = dahlia_run.StatementStream()
+        out = []
+        for char in CODE:
+            out.extend(statements.feed(char))
+        out.extend(statements.close())
+        self.assertEqual(out, [
+            "objects = ['red block', 'blue bowl']",
+            '# comments stay with the next statement\nfor obj in objects:\n    act(obj)',
+            "if len(objects) > 3:\n    act('many')\nelse:\n    act('few')",
+            'total = sum([\n    1,\n    2,\n])',
+            'act(total)',
+        ])
+
+    def test_fences_are_dropped(self):
+        statements = dahlia_run.StatementStream()
+        out = statements.feed('Sure:\n```python\nact(1)\nact(2)\n```\nDone.\n')
+        out.extend(statements.close())
+        self.assertEqual(out, ['act(1)', 'act(2)'])
+
+
+class StreamingLMPTest(absltest.TestCase):
+
+    def test_statements_run_before_the_stream_ends(self):
+        calls = []
+
+        def act(x):
+            calls.append((x, time.perf_counter()))
+
+        token_rate = 100
+        code = '\n'.join(f'act({i})' for i in range(30))
+        lmp = make_lmp(FakeBackend(respond=code, token_rate=token_rate), {'act': act})
+        lmp('do it')
+        end = time.perf_counter()
+
+        self.assertEqual([x for x, _ in calls], list(range(30)))
+        # the first action runs while the remaining 28 tokens are still being decoded
+        self.assertLess(calls[0][1], end - 20 / token_rate)
+
+    def test_same_result_as_blocking_mode(self):
+        results = []
+        for stream in (False, True):
+            calls = []
+            lmp = make_lmp(FakeBackend(respond=CODE, token_rate=1000), {'act': calls.append},
+                           stream=stream)
+            results.append((lmp('do it', context="objects = ['red block']"), calls))
+        self.assertEqual(results[0], results[1])
+
+    def test_repeated_context_runs_once_in_both_modes(self):
+        results = []
+        for stream in (False, True):
+            calls = []
+            lmp = make_lmp(FakeBackend(respond="act('context')\nact(1)", token_rate=1000),
+                           {'act': calls.append}, stream=stream)
+            results.append((lmp('do it', context="act('context')"), calls))
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[1][1], ['context', 1])
+
+    def test_parse_failure_rolls_back(self):
+        calls = []
+        variable_vars = {'act': calls.append}
+        lmp = make_lmp(FakeBackend(respond='x = 1\nact(x)\ny = act(', token_rate=1000),
+                       variable_vars)
+        lvars = {'keep': True}
+        with self.assertRaises(SyntaxError):
+            lmp('do it', **lvars)
+        self.assertEqual(calls, [1])  # already executed, not undone
+        self.assertEqual(lmp.exec_hist, '')
+        self.assertEqual(list(variable_vars), ['act'])
+
+
+if __name__ == '__main__':
+    absltest.main()
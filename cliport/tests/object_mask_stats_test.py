@@ -0,0 +1,100 @@
+"""Tests for the one-pass per-object statistics of segmentation masks."""
+
+import cv2
+import numpy as np
+import pybullet as p
+from absl.testing import absltest
+
+from cliport.tasks.task import Task
+from cliport.utils import utils
+
+
+def random_scene(rng, n_objects=40, shape=(320, 160)):
+    mask = np.full(shape, -1, dtype=np.int32)
+    mask[:, :8] = 1  # the table, not one of the objects
+    for obj_id in range(5, 5 + n_objects):
+        u, v = rng.randint(0, shape[0] - 4), rng.randint(0, shape[1] - 4)
+        h, w = rng.randint(1, 30), rng.randint(1, 20)
+        mask[u:u + h, v:v + w] = obj_id  # later objects occlude earlier ones
+    return mask
+
+
+class ObjectMaskStatsTest(absltest.TestCase):
+
+    def test_matches_per_object_masks(self):
+        rng = np.random.RandomState(0)
+        for erode_size in (3, 5):
+            mask = random_scene(rng)
+            obj_ids = list(rng.permutation(np.arange(5, 45))) + [90]  # 90 is not in the mask
+            stats = utils.object_mask_stats(mask, obj_ids, erode_size=erode_size)
+            for i, obj_id in enumerate(obj_ids):
+                obj_mask = np.uint8(mask == obj_id)
+                eroded = cv2.erode(obj_mask, np.ones((erode_size, erode_size), np.uint8))
+                self.assertEqual(stats.counts[i], obj_mask.sum())
+                self.assertEqual(stats.eroded_counts[i], eroded.sum())
+                np.testing.assert_array_equal(stats.eroded == i + 1, eroded > 0)
+                if obj_mask.any():
+                    u, v = np.nonzero(obj_mask)
+                    bbox = [u.min(), v.min(), u.max(), v.max()]
+                else:
+                    bbox = [-1] * 4
+                np.testing.assert_array_equal(stats.bboxes[i], bbox)
+
+    def test_label_objects(self):
+        mask = np.array([[-1, 0, 3], [7, 3, 12]])
+        np.testing.assert_array_equal(utils.label_objects(mask, [3, 0]), [[0, 2, 1], [0, 1, 0]])
+        np.testing.assert_array_equal(utils.label_objects(mask, []), np.zeros((2, 3)))
+
+    def test_first_visible_matches_the_erosion_loop(self):
+        rng = np.random.RandomState(1)
+        mask = random_scene(rng)
+        mask[100, 40:60] = 50  # a sliver, gone after erosion
+        for obj_ids in ([7, 50, 8], [50, 90, 12, 6], [50], [50, 90]):
+            expected = len(obj_ids) - 1
+            for i, obj_id in enumerate(obj_ids):
+                eroded = cv2.erode(np.uint8(mask == obj_id), np.ones((3, 3), np.uint8))
+                if eroded.any():
+                    expected = i
+                    break
+            k, pick_mask = utils.first_visible(mask, obj_ids)
+            self.assertEqual(k, expected)
+            np.testing.assert_array_equal(pick_mask, eroded)
+
+
+class OraclePickTest(absltest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.client = p.connect(p.DIRECT)
+
+    @classmethod
+    def tearDownClass(cls):
+        p.disconnect(cls.client)
+        super().tearDownClass()
+
+    def test_picks_first_object_visible_after_erosion(self):
+        p.resetSimulation()
+        p.createMultiBody(0, p.createCollisionShape(p.GEOM_PLANE))  # 0 in the mask
+        shape = p.createCollisionShape(p.GEOM_BOX, halfExtents=[0.02] * 3)
+        far = p.createMultiBody(0.1, shape, basePosition=[0.4, 0.1, 0.02])
+        near = p.createMultiBody(0.1, shape, basePosition=[0.6, -0.1, 0.02])
+
+        task = Task()
+        mask = np.zeros((320, 160), dtype=np.int32)
+        mask[100, 40:60] = far  # a sliver, gone after erosion
+        mask[120:130, 100:110] = near
+        hmap = np.zeros(mask.shape, dtype=np.float32)
+        task.get_true_image = lambda env: (None, hmap, mask)
+        # the object farther from its target comes first
+        task.goals = [([(far, (0, None)), (near, (0, None))], np.eye(2),
+                       [((0.7, 0.4, 0.02), (0, 0, 0, 1)), ((0.6, -0.05, 0.02), (0, 0, 0, 1))],
+                       False, True, 'pose', None, 1)]
+
+        act = task.oracle(None).act(None, None)
+        u, v = utils.xyz_to_pix(act['pose0'][0], task.bounds, task.pix_size)
+        self.assertTrue(121 <= u <= 128 and 101 <= v <= 108)
+
+
+if __name__ == '__main__':
+    absltest.main()
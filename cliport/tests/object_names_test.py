@@ -0,0 +1,114 @@
+"""Tests for the object-name index of LMP_wrapper."""
+
+import re
+
+import numpy as np
+from absl.testing import absltest
+from absl.testing import parameterized
+
+from cliport import dahlia_run
+from cliport import tasks
+from cliport.environments import environment
+from cliport.utils import utils
+
+ASSETS_PATH = 'cliport/environments/assets/'
+
+
+def old_get_obj_names(object_names, id):
+    for s in object_names[::]:
+        parts = s.split()
+        if parts and parts[-1].isdigit():
+            if int(parts[-1]) == id:
+                return [s]
+    raise ValueError(f'no matching obj with id {id}')
+
+
+def old_get_bbox(lmp_env, obj_name):
+    is_zone = False
+    is_pallet = False
+    scale = 1
+    if 'scaled' in lmp_env.get_obj_names(obj_name)[0]:
+        match = re.search(r'(\d+(\.\d+)?)x', obj_name)
+        scale = float(match.group(1)) if match else 1
+    if 'zone' in lmp_env.get_obj_names(obj_name)[0]:
+        is_zone = True
+    if 'pallet' in lmp_env.get_obj_names(obj_name)[0]:
+        is_pallet = True
+    bbox = lmp_env.env.get_bounding_box(obj_name)
+    size_x = bbox[3] - bbox[0]
+    size_y = bbox[4] - bbox[1]
+    size_z = bbox[5] - bbox[2]
+    size = 50 * scale * np.array([size_x, size_y, size_z]) if is_zone else scale * np.array(
+        [size_x, size_y, size_z])
+    if is_pallet:
+        size *= 0.5
+    return tuple(size)
+
+
+def old_get_color(obj_name):
+    for color, rgb in utils.COLORS.items():
+        if color in obj_name:
+            return rgb
+
+
+class FakeEnv:
+
+    def __init__(self, object_list):
+        self.object_list = object_list
+
+    def get_bounding_box(self, obj_name):
+        return (0.1, -0.2, 0., 0.14, -0.17, 0.04)
+
+
+class ObjectNameIndexTest(parameterized.TestCase):
+
+    def make_wrapper(self, object_list):
+        cfg = {'env': {'init_objs': object_list, 'coords': dahlia_run.lmp_tabletop_coords}}
+        return dahlia_run.LMP_wrapper(FakeEnv(object_list), cfg)
+
+    def assert_same_as_linear_scan(self, lmp_env):
+        names = lmp_env.object_names
+        for obj_id in range(-1, 40):
+            try:
+                expected = old_get_obj_names(names, obj_id)
+            except ValueError:
+                if obj_id:
+                    with self.assertRaises(ValueError):
+                        lmp_env.get_obj_names(obj_id)
+            else:
+                self.assertEqual(lmp_env.get_obj_names(obj_id), expected)
+        for name in names:
+            self.assertEqual(lmp_env.get_color(name), old_get_color(name))
+            self.assertEqual(lmp_env.get_bbox(name), old_get_bbox(lmp_env, name))
+
+    def test_matches_linear_scan(self):
+        lmp_env = self.make_wrapper([
+            'red block', 'blue bowl 3', 'green block 12', 'yellow zone', 'pallet 4',
+            'purple block scaled 1.5x 7', 'brown block 3', 'block', 'gray letter R 21'])
+        self.assert_same_as_linear_scan(lmp_env)
+        self.assertEqual(lmp_env.name_index.by_category['block'],
+                         ['red block', 'green block 12', 'brown block 3', 'block'])
+
+    def test_follows_added_objects(self):
+        object_list = ['red block 1']
+        lmp_env = self.make_wrapper(object_list)
+        self.assertEqual(lmp_env.get_obj_names(1), ['red block 1'])
+        object_list.append('blue bowl 2')  # as `env.add_object` does
+        self.assertEqual(lmp_env.get_obj_names(2), ['blue bowl 2'])
+        lmp_env.set_env(FakeEnv(['green block 5']))
+        with self.assertRaises(ValueError):
+            lmp_env.get_obj_names(1)
+        self.assertEqual(lmp_env.get_obj_names(5), ['green block 5'])
+
+    @parameterized.named_parameters(*sorted(tasks.names.items()))
+    def test_registered_tasks(self, task_cls):
+        env = environment.Environment(ASSETS_PATH)
+        env.seed(0)
+        env.set_task(task_cls())
+        env.reset()
+        cfg = {'env': {'init_objs': env.object_list, 'coords': dahlia_run.lmp_tabletop_coords}}
+        self.assert_same_as_linear_scan(dahlia_run.LMP_wrapper(env, cfg))
+
+
+if __name__ == '__main__':
+    absltest.main()
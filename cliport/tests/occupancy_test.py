@@ -0,0 +1,124 @@
+"""Tests for the incrementally maintained occupancy map of Task.get_random_pose."""
+
+import numpy as np
+import pybullet as p
+from absl.testing import absltest
+
+from cliport.tasks.task import Task
+from cliport.utils.occupancy import OccupancyMap
+
+
+class BlocksEnv:
+    """Stand-in environment that adds 4 cm blocks and counts the camera renders."""
+
+    def __init__(self):
+        p.resetSimulation()
+        p.setGravity(0, 0, -9.8)
+        p.createMultiBody(0, p.createCollisionShape(p.GEOM_PLANE))
+        self.obj_ids = {'fixed': [], 'rigid': [], 'deformable': []}
+        self.n_renders = 0
+
+    def add_block(self, pos):
+        shape = p.createCollisionShape(p.GEOM_BOX, halfExtents=[0.02] * 3)
+        self.obj_ids['rigid'].append(p.createMultiBody(0.1, shape, basePosition=pos))
+        return self.obj_ids['rigid'][-1]
+
+    def render_camera(self, config):
+        # an empty scene; only whether the map is rebuilt matters here
+        self.n_renders += 1
+        height, width = config['image_size']
+        return (np.zeros((height, width, 3), dtype=np.uint8),
+                np.zeros((height, width), dtype=np.float32),
+                np.zeros((height, width), dtype=np.int32))
+
+
+class OccupancyTest(absltest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.client = p.connect(p.DIRECT)
+
+    @classmethod
+    def tearDownClass(cls):
+        p.disconnect(cls.client)
+        super().tearDownClass()
+
+    def test_stamps_aabb_footprint(self):
+        env = BlocksEnv()
+        block = env.add_block([0.5, 0.1, 0.02])
+        occupancy = OccupancyMap(Task().bounds, Task().pix_size)
+        occupancy.stamp(block)
+
+        rows, cols = np.nonzero(occupancy.occupied)
+        self.assertEqual(occupancy.occupied.shape, (320, 160))
+        x = occupancy.bounds[0, 0] + (cols + 0.5) * occupancy.pix_size
+        y = occupancy.bounds[1, 0] + (rows + 0.5) * occupancy.pix_size
+        # every pixel touching the 4 cm footprint, and no other
+        self.assertLessEqual(np.abs(x - 0.5).max(), 0.02 + occupancy.pix_size)
+        self.assertLessEqual(np.abs(y - 0.1).max(), 0.02 + occupancy.pix_size)
+        self.assertBetween(occupancy.occupied.sum(), 13 ** 2, 14 ** 2)
+        self.assertFalse(occupancy.moved(env.obj_ids['rigid']))
+        self.assertTrue(occupancy.moved([]))
+
+    def test_map_follows_the_rendered_mask(self):
+        env = BlocksEnv()
+        block = env.add_block([0.5, 0.1, 0.02])
+        task = Task()
+        mask = np.full((320, 160), -1, dtype=np.int32)
+        mask[10:20, 30:35] = block
+        mask[50:60, 70:80] = 0  # the plane, which is not an object of the episode
+        renders = []
+
+        def render_true_image(env):
+            renders.append(mask)
+            return None, None, mask
+
+        task._render_true_image = render_true_image
+        occupancy = task.get_occupancy(env)
+        np.testing.assert_array_equal(occupancy.occupied, mask == block)
+        task.get_occupancy(env)
+        self.assertLen(renders, 1)  # the scene has not changed
+
+        env.add_block([0.4, -0.2, 0.02])
+        task.get_occupancy(env)
+        self.assertLen(renders, 2)
+
+    def test_random_poses_without_rendering(self):
+        np.random.seed(0)
+        env = BlocksEnv()
+        task = Task()
+        task.aabb_occupancy = True
+        for _ in range(12):
+            pos, _ = task.get_random_pose(env, (0.04, 0.04, 0.04))
+            env.add_block(pos)
+        self.assertEqual(env.n_renders, 0)
+
+        # the blocks were placed apart, though an empty render would not have told
+        xy = np.array([p.getBasePositionAndOrientation(obj_id)[0][:2]
+                       for obj_id in env.obj_ids['rigid']])
+        dists = np.linalg.norm(xy[:, None] - xy[None], axis=-1) + np.eye(len(xy))
+        self.assertGreater(dists.min(), 0.04)
+
+        # physics moves the blocks, so the next pose is sampled from a fresh render
+        env.add_block([0.5, 0., 0.3])
+        task.get_random_pose(env, (0.04, 0.04, 0.04))
+        for _ in range(10):
+            p.stepSimulation()
+        task.get_random_pose(env, (0.04, 0.04, 0.04))
+        task.get_random_pose(env, (0.04, 0.04, 0.04))
+        self.assertEqual(env.n_renders, 1)
+
+    def test_new_episode_starts_a_new_map(self):
+        task = Task()
+        task.get_random_pose(BlocksEnv(), (0.04, 0.04, 0.04))
+        occupancy = task.occupancy
+        task.assets_root = 'assets'
+        task.reset(None)
+        self.assertIsNone(task.occupancy)
+        task.get_random_pose(BlocksEnv(), (0.04, 0.04, 0.04))
+        self.assertIsNot(task.occupancy, occupancy)
+
+
+if __name__ == '__main__':
+    absltest.main()
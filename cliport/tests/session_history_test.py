@@ -0,0 +1,92 @@
+"""Tests for the bounded LMP session history."""
+
+from absl.testing import absltest
+
+from cliport import dahlia_run
+from cliport.utils.llm_backends import FakeBackend
+from cliport.utils.session_history import SessionHistory
+from cliport.utils.session_history import approx_token_count
+
+
+def turn(i):
+    return f"# put block {i} in bowl {i}.\nput_first_on_second('block {i}', 'bowl {i}')"
+
+
+class SessionHistoryTest(absltest.TestCase):
+
+    def test_incremental_count_matches_text(self):
+        for policy in ('evict', 'summarize'):
+            history = SessionHistory(max_tokens=100, policy=policy)
+            for i in range(50):
+                history.append(turn(i))
+                self.assertEqual(history.tokens, approx_token_count(history.text))
+
+    def test_evict_keeps_newest_turns(self):
+        history = SessionHistory(max_tokens=60, policy='evict')
+        for i in range(20):
+            history.append(turn(i))
+        self.assertLessEqual(history.tokens, 60)
+        self.assertTrue(history.text.endswith(turn(19)))
+        self.assertNotIn('block 0', history.text)
+        self.assertEqual(history.n_evicted + len(history), 20)
+
+    def test_summarize_keeps_a_trace_of_old_turns(self):
+        history = SessionHistory(max_tokens=120, policy='summarize')
+        for i in range(20):
+            history.append(turn(i))
+        self.assertLessEqual(history.tokens, 120)
+        self.assertIn('# earlier: put block', history.text)
+        self.assertTrue(history.text.endswith(turn(19)))
+
+    def test_unbounded_by_default(self):
+        history = SessionHistory()
+        for i in range(20):
+            history.append(turn(i))
+        self.assertLen(history, 20)
+        self.assertEqual(history.text, ''.join(f'\n{turn(i)}' for i in range(20)))
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            SessionHistory(policy='truncate')
+
+
+class LMPSessionTest(absltest.TestCase):
+
+    def test_200_turn_session_has_bounded_prompts(self):
+        cfg = {
+            'prompt_text': '# pick up the block.\nact("block")',
+            'engine': lambda: 'fake-model',
+            'max_tokens': lambda: 256,
+            'temperature': 0,
+            'query_prefix': '# ',
+            'query_suffix': '.',
+            'stop': ['#'],
+            'maintain_session': True,
+            'debug_mode': False,
+            'include_context': True,
+            'has_return': True,
+            'return_val_name': 'whole_answer',
+            'history_max_tokens': 500,
+            'history_policy': 'summarize',
+        }
+        backend = FakeBackend(respond=lambda messages: f'act({len(messages[-1]["content"])})')
+        variable_vars = {'act': lambda x: None}
+        lmp_fgen = dahlia_run.LMPFGen((dict(cfg, stop=['# define']), 'fake'), {}, variable_vars,
+                                      backend=backend)
+        lmp = dahlia_run.LMP('tabletop_ui', (cfg, 'fake'), lmp_fgen, {}, variable_vars,
+                             backend=backend)
+        for i in range(200):
+            lmp(f'put block {i} in bowl {i}', context=f"objects = ['block {i}', 'bowl {i}']")
+
+        self.assertLen(lmp.prompt_tokens, 200)
+        # bounded by the prefix, the history budget and one context and query
+        self.assertLessEqual(max(lmp.prompt_tokens), lmp.prompt_tokens[0] + 500)
+        self.assertEqual(max(lmp.prompt_tokens[100:]), max(lmp.prompt_tokens[150:]))
+        # the reported size is the size of the prompt that was sent
+        prompt, _ = lmp.build_prompt('next query', context="objects = ['block']")
+        self.assertEqual(lmp.count_prompt_tokens("objects = ['block']", '# next query.'),
+                         approx_token_count(prompt))
+
+
+if __name__ == '__main__':
+    absltest.main()
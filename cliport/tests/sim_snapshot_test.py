@@ -0,0 +1,137 @@
+"""Tests for snapshot and rollback of a running episode."""
+
+import random
+
+import numpy as np
+import pybullet as p
+from absl.testing import absltest
+
+from cliport import dahlia_run
+from cliport.utils import sim_snapshot
+
+
+class GoalTask:
+
+    def __init__(self):
+        self.goals = [([i], np.eye(1), [np.zeros(3)], False, True, 'pose', None, 0.5)
+                      for i in (2, 3)]
+        self.lang_goals = ['stack block 1 on block 0', 'stack block 2 on block 1']
+        self.progress = 0
+        self._rewards = 0
+        self.obj_points_cache = {}
+
+    def reward(self):
+        self.goals.pop(0)
+        self.lang_goals.pop(0)
+        self.progress += 1
+        self._rewards += 1.
+        return 1., {}
+
+
+class BlocksEnv:
+    """Stand-in environment with a table plane and 4 cm blocks."""
+
+    def __init__(self):
+        p.resetSimulation()
+        p.setGravity(0, 0, -9.8)
+        p.setTimeStep(1. / 480)
+        p.createMultiBody(0, p.createCollisionShape(p.GEOM_PLANE))
+        block_shape = p.createCollisionShape(p.GEOM_BOX, halfExtents=[0.02] * 3)
+        self.obj_ids = {'fixed': [], 'rigid': [], 'deformable': []}
+        self.object_list = []
+        for i in range(4):
+            self.obj_ids['rigid'].append(
+                p.createMultiBody(0.1, block_shape, basePosition=[0.4, -0.3 + 0.15 * i, 0.02]))
+            self.object_list.append(f'block {i}')
+        self.task = GoalTask()
+
+    def _body(self, obj_name):
+        return self.obj_ids['rigid'][self.object_list.index(obj_name)]
+
+    def get_obj_pos(self, obj_name, count=1):
+        return [np.array(p.getBasePositionAndOrientation(self._body(obj_name))[0])]
+
+    def get_obj_rot(self, obj_name, count=1):
+        return [np.array(p.getBasePositionAndOrientation(self._body(obj_name))[1])]
+
+    def get_bounding_box(self, obj_name):
+        aabb_min, aabb_max = p.getAABB(self._body(obj_name))
+        return (*aabb_min, *aabb_max)
+
+    def step_simulation(self):
+        p.stepSimulation()
+
+    def world_state(self):
+        return [(p.getBasePositionAndOrientation(body), p.getBaseVelocity(body))
+                for body in self.obj_ids['rigid']]
+
+
+class SimSnapshotTest(absltest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.client = p.connect(p.DIRECT)
+
+    @classmethod
+    def tearDownClass(cls):
+        p.disconnect(cls.client)
+        super().tearDownClass()
+
+    def setUp(self):
+        super().setUp()
+        self.env = BlocksEnv()
+        cfg = {'env': {'init_objs': self.env.object_list,
+                       'coords': dahlia_run.lmp_tabletop_coords},
+               'execution': {'mode': 'teleport', 'settle_steps': 48}}
+        self.lmp_env = dahlia_run.LMP_wrapper(self.env, cfg)
+        # a scene in motion, so velocities are part of the state
+        p.resetBaseVelocity(self.env.obj_ids['rigid'][3], (0.2, 0., 0.), (0., 0., 1.))
+        for _ in range(10):
+            p.stepSimulation()
+
+    def act(self):
+        random.random()
+        np.random.rand(3)
+        self.lmp_env.stack_objects_in_order(['block 0', 'block 1', 'block 2'])
+        for _ in range(50):
+            p.stepSimulation()
+        return self.env.world_state()
+
+    def test_round_trip_is_bit_identical(self):
+        before = self.env.world_state()
+        task_before = (repr(self.env.task.goals), list(self.env.task.lang_goals))
+        rng_before = (random.getstate(), np.random.get_state()[1].copy())
+
+        snap = self.lmp_env.snapshot()
+        first = self.act()
+        self.assertNotEqual(first, before)
+        self.assertEqual(self.env.task._rewards, 2.)
+
+        self.lmp_env.restore(snap)
+        self.assertEqual(self.env.world_state(), before)
+        self.assertEqual((repr(self.env.task.goals), self.env.task.lang_goals), task_before)
+        self.assertEqual((self.env.task.progress, self.env.task._rewards), (0, 0))
+        self.assertEqual(random.getstate(), rng_before[0])
+        np.testing.assert_array_equal(np.random.get_state()[1], rng_before[1])
+        # the same actions replay to the same world, so the handle can be reused
+        self.assertEqual(self.act(), first)
+        self.lmp_env.restore(snap)
+        self.assertEqual(self.env.world_state(), before)
+        sim_snapshot.discard(snap)
+
+    def test_restore_keeps_env_containers(self):
+        object_list, rigid_ids = self.env.object_list, self.env.obj_ids['rigid']
+        snap = self.lmp_env.snapshot()
+        self.env.object_list.pop()
+        self.env.obj_ids['rigid'].pop()
+        self.lmp_env.restore(snap)
+        self.assertIs(self.env.object_list, object_list)
+        self.assertIs(self.env.obj_ids['rigid'], rigid_ids)
+        self.assertLen(self.env.object_list, 4)
+        self.assertEqual(self.lmp_env.get_obj_names(), [f'block {i}' for i in range(4)])
+        sim_snapshot.discard(snap)
+
+
+if __name__ == '__main__':
+    absltest.main()
@@ -0,0 +1,145 @@
+"""Tests for the R-tree index of object footprints."""
+
+import numpy as np
+from absl.testing import absltest
+
+from cliport import dahlia_run
+from cliport.utils.free_space import footprint_distances
+from cliport.utils.spatial_index import SpatialIndex
+
+
+def random_footprints(rng, n):
+    centers = rng.uniform((0.25, -0.5), (0.75, 0.5), size=(n, 2))
+    sizes = rng.uniform(0.01, 0.08, size=(n, 2))
+    return np.concatenate([centers - sizes / 2, centers + sizes / 2], axis=1)
+
+
+class BoxEnv:
+    """Stand-in environment that only knows the bounding boxes of its objects, which
+    actions move by the offset between the pick and place positions."""
+
+    def __init__(self, boxes):
+        self.boxes = boxes
+        self.object_list = list(boxes)
+
+    def get_bounding_box(self, obj_name):
+        return self.boxes[obj_name]
+
+    def get_obj_pos(self, obj_name, count=1):
+        x_min, y_min, z_min, x_max, y_max, z_max = self.boxes[obj_name]
+        return [np.array([x_min + x_max, y_min + y_max, z_min + z_max]) / 2]
+
+    def get_obj_rot(self, obj_name, count=1):
+        return [np.array([0., 0., 0., 1.])]
+
+    def step(self, action):
+        (x, y, _), (u, v, _) = action['pose0'][0], action['pose1'][0]
+        for obj, (x_min, y_min, z_min, x_max, y_max, z_max) in self.boxes.items():
+            if x_min <= x <= x_max and y_min <= y <= y_max:
+                dx, dy = u - x, v - y
+                self.boxes[obj] = (x_min + dx, y_min + dy, z_min, x_max + dx, y_max + dy, z_max)
+                return
+
+
+class SpatialIndexTest(absltest.TestCase):
+
+    def test_matches_brute_force_under_updates(self):
+        rng = np.random.default_rng(0)
+        names = [f'block {i}' for i in range(100)]
+        footprints = random_footprints(rng, len(names))
+        index = SpatialIndex()
+        for name, footprint in zip(names, footprints):
+            index.update(name, footprint)
+
+        for _ in range(5):
+            moved = rng.choice(len(names), size=20, replace=False)
+            footprints[moved] = random_footprints(rng, len(moved))
+            for i in range(len(names)):
+                self.assertEqual(index.update(names[i], footprints[i]), i in moved)
+
+            for point in rng.uniform((0.25, -0.5), (0.75, 0.5), size=(20, 2)):
+                dists = footprint_distances(point, footprints)[0]
+                self.assertEqual(index.objects_near(point, 0.05),
+                                 [names[i] for i in np.flatnonzero(dists <= 0.05)])
+                self.assertEqual(index.nearest(point, 3),
+                                 [names[i] for i in np.argsort(dists, kind='stable')[:3]])
+                bbox = (*(point - 0.04), *(point + 0.04))
+                overlaps = ((footprints[:, 0] <= bbox[2]) & (footprints[:, 2] >= bbox[0])
+                            & (footprints[:, 1] <= bbox[3]) & (footprints[:, 3] >= bbox[1]))
+                self.assertEqual(index.overlapping(bbox),
+                                 [names[i] for i in np.flatnonzero(overlaps)])
+
+    def test_remove(self):
+        index = SpatialIndex()
+        index.update('red block', (0., 0., 0.1, 0.1))
+        index.update('blue bowl', (0.2, 0., 0.3, 0.1))
+        index.remove('red block')
+        self.assertNotIn('red block', index)
+        self.assertEqual(index.nearest((0., 0.), 2), ['blue bowl'])
+
+
+class WrapperQueriesTest(absltest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.boxes = {f'block {i}': (x0, y0, 0., x1, y1, 0.04) for i, (x0, y0, x1, y1)
+                      in enumerate(random_footprints(np.random.default_rng(1), 50))}
+        cfg = {'env': {'init_objs': list(self.boxes), 'coords': dahlia_run.lmp_tabletop_coords}}
+        self.lmp_env = dahlia_run.LMP_wrapper(BoxEnv(self.boxes), cfg)
+
+    def linear_scan(self, center, r, exclude=None):
+        occupied = []
+        for obj, (x_min, y_min, _, x_max, y_max, _) in self.boxes.items():
+            closest = np.clip(center, (x_min, y_min), (x_max, y_max))
+            if obj != exclude and np.linalg.norm(center - closest) <= r:
+                occupied.append(obj)
+        return occupied
+
+    def test_is_target_occupied_matches_linear_scan(self):
+        for point in np.random.default_rng(2).uniform((0.25, -0.5), (0.75, 0.5), size=(50, 2)):
+            self.assertEqual(self.lmp_env.is_target_occupied([*point, 0.02], 0.05),
+                             self.linear_scan(point, 0.05))
+        x, y, _ = self.lmp_env.get_bbox('block 3')
+        self.assertEqual(self.lmp_env.is_target_occupied('block 3'),
+                         self.linear_scan(self.lmp_env.get_obj_pos('block 3')[0][:2],
+                                          0.5 * np.linalg.norm([x, y]), exclude='block 3'))
+
+    def test_queries_exclude_the_object_itself(self):
+        self.assertNotIn('block 3', self.lmp_env.objects_near('block 3', 0.2))
+        self.assertNotIn('block 3', self.lmp_env.overlapping('block 3'))
+        nearest = self.lmp_env.nearest('block 3', k=2)
+        self.assertLen(nearest, 2)
+        self.assertNotIn('block 3', nearest)
+
+    def test_index_follows_moved_objects(self):
+        self.assertIn('block 0', self.lmp_env.objects_near((0.3, 0.3), 0.5))
+        self.boxes['block 0'] = (0.7, -0.45, 0., 0.72, -0.43, 0.04)
+        self.lmp_env.invalidate_world()
+        self.assertEqual(self.lmp_env.nearest((0.71, -0.44)), ['block 0'])
+
+    def test_index_follows_objects_knocked_by_actions(self):
+        env = self.lmp_env.env
+        step = env.step
+
+        def knocking_step(action):
+            # the arm also knocks a block far from the pick and place positions
+            x_min, y_min, z_min, x_max, y_max, z_max = self.boxes['block 40']
+            self.boxes['block 40'] = (x_min + 0.2, y_min, z_min, x_max + 0.2, y_max, z_max)
+            return step(action)
+
+        env.step = knocking_step
+        index = self.lmp_env.spatial_index
+        for i in range(5):
+            self.lmp_env.put_first_on_second(f'block {i}', [0.3 + 0.1 * i, 0.45 - 0.2 * i])
+            self.lmp_env.spatial_index
+
+        rebuilt = SpatialIndex()
+        for obj, (x_min, y_min, _, x_max, y_max, _) in self.boxes.items():
+            rebuilt.update(obj, (x_min, y_min, x_max, y_max))
+        for point in np.random.default_rng(3).uniform((0.25, -0.5), (0.75, 0.5), size=(50, 2)):
+            self.assertEqual(index.objects_near(point, 0.05), rebuilt.objects_near(point, 0.05))
+            self.assertEqual(index.nearest(point, 3), rebuilt.nearest(point, 3))
+
+
+if __name__ == '__main__':
+    absltest.main()
@@ -0,0 +1,110 @@
+"""Tests for the teleport execution mode of LMP_wrapper."""
+
+import numpy as np
+import pybullet as p
+from absl.testing import absltest
+
+from cliport import dahlia_run
+
+
+class CountingTask:
+
+    def __init__(self):
+        self.n_rewards = 0
+
+    def reward(self):
+        self.n_rewards += 1
+        return 0., {}
+
+
+class BoxesEnv:
+    """Stand-in environment with a table plane, a fixed zone and 4 cm blocks."""
+
+    def __init__(self):
+        p.resetSimulation()
+        p.setGravity(0, 0, -9.8)
+        p.setTimeStep(1. / 480)
+        p.createMultiBody(0, p.createCollisionShape(p.GEOM_PLANE))
+        zone_shape = p.createCollisionShape(p.GEOM_BOX, halfExtents=[0.06, 0.06, 0.005])
+        zone = p.createMultiBody(0, zone_shape, basePosition=[0.6, 0.3, 0.005])
+        block_shape = p.createCollisionShape(p.GEOM_BOX, halfExtents=[0.02] * 3)
+        self.obj_ids = {'fixed': [zone], 'rigid': [], 'deformable': []}
+        self.object_list = []
+        for i in range(3):
+            self.obj_ids['rigid'].append(
+                p.createMultiBody(0.1, block_shape, basePosition=[0.4, -0.2 + 0.15 * i, 0.02]))
+            self.object_list.append(f'block {i}')
+        self.task = CountingTask()
+
+    def _body(self, obj_name):
+        return self.obj_ids['rigid'][self.object_list.index(obj_name)]
+
+    def get_obj_pos(self, obj_name, count=1):
+        return [np.array(p.getBasePositionAndOrientation(self._body(obj_name))[0])]
+
+    def get_obj_rot(self, obj_name, count=1):
+        return [np.array(p.getBasePositionAndOrientation(self._body(obj_name))[1])]
+
+    def get_bounding_box(self, obj_name):
+        aabb_min, aabb_max = p.getAABB(self._body(obj_name))
+        return (*aabb_min, *aabb_max)
+
+    def step_simulation(self):
+        p.stepSimulation()
+
+    def step(self, action):
+        raise AssertionError('teleport mode must not run the PickPlace primitive')
+
+
+class TeleportTest(absltest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.client = p.connect(p.DIRECT)
+
+    @classmethod
+    def tearDownClass(cls):
+        p.disconnect(cls.client)
+        super().tearDownClass()
+
+    def setUp(self):
+        super().setUp()
+        self.env = BoxesEnv()
+        cfg = {'env': {'init_objs': self.env.object_list, 'coords': dahlia_run.lmp_tabletop_coords},
+               'execution': {'mode': 'teleport', 'settle_steps': 48}}
+        self.lmp_env = dahlia_run.LMP_wrapper(self.env, cfg)
+
+    def test_stack_blocks(self):
+        self.lmp_env.stack_objects_in_order(['block 0', 'block 1', 'block 2'])
+        positions = [self.lmp_env.get_obj_pos(f'block {i}')[0] for i in range(3)]
+        for i, pos in enumerate(positions):
+            np.testing.assert_allclose(pos, [0.4, -0.2, 0.02 + 0.04 * i], atol=2e-3)
+        self.assertEqual(self.env.task.n_rewards, 2)
+
+    def test_place_on_position_and_fixed_body(self):
+        self.lmp_env.put_first_on_second('block 0', [0.5, 0.])
+        np.testing.assert_allclose(self.lmp_env.get_obj_pos('block 0')[0], [0.5, 0., 0.02],
+                                   atol=2e-3)
+        self.lmp_env.put_first_on_second('block 1', [0.6, 0.3, 0.])  # onto the zone
+        np.testing.assert_allclose(self.lmp_env.get_obj_pos('block 1')[0], [0.6, 0.3, 0.03],
+                                   atol=2e-3)
+
+    def test_missed_pick_leaves_scene_unchanged(self):
+        before = [self.lmp_env.get_obj_pos(f'block {i}')[0] for i in range(3)]
+        self.lmp_env.put_first_on_second([0.7, 0.4], 'block 0')
+        for i in range(3):
+            np.testing.assert_allclose(self.lmp_env.get_obj_pos(f'block {i}')[0], before[i])
+        self.assertEqual(self.env.task.n_rewards, 1)
+
+    def test_teleport_refreshes_object_poses(self):
+        before = self.lmp_env.get_obj_pos('block 0')[0]
+        self.lmp_env._teleport({'pose0': (before, (0, 0, 0, 1)),
+                                'pose1': ((0.5, 0., 0.), (0, 0, 0, 1))})
+        after = self.lmp_env.get_obj_pos('block 0')[0]
+        self.assertGreater(np.linalg.norm(after[:2] - before[:2]), 0.1)
+        np.testing.assert_allclose(after, self.env.get_obj_pos('block 0')[0])
+
+
+if __name__ == '__main__':
+    absltest.main()
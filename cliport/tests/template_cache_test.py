@@ -0,0 +1,113 @@
+"""Tests for the content-addressed cache of filled URDF templates."""
+
+import os
+import random
+import string
+import tempfile
+
+import pybullet as p
+from absl.testing import absltest
+
+from cliport.tasks.task import Task
+from cliport.utils import template_cache
+
+BOX_TEMPLATE = """<?xml version="1.0"?>
+<robot name="box">
+  <link name="base_link">
+    <inertial>
+      <mass value="0.1"/>
+      <inertia ixx="1" ixy="0" ixz="0" iyy="1" iyz="0" izz="1"/>
+    </inertial>
+    <collision>
+      <geometry><box size="DIM0 DIM1 DIM2"/></geometry>
+    </collision>
+  </link>
+</robot>
+"""
+
+
+class TemplateCacheTest(absltest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.root = tempfile.mkdtemp()
+        self.cache = template_cache.TemplateCache(max_files=3, root=self.root)
+
+    def test_reuses_files_with_the_same_content(self):
+        path = self.cache.write('box-template.urdf', 'a')
+        self.assertEqual(self.cache.write('box-template.urdf', 'a'), path)
+        other = self.cache.write('box-template.urdf', 'b')
+        self.assertNotEqual(other, path)
+        self.assertNotEqual(self.cache.write('sphere-template.urdf', 'a'), path)
+        with open(path) as file:
+            self.assertEqual(file.read(), 'a')
+        self.assertTrue(os.path.basename(path).startswith('box-template.urdf.'))
+        self.assertEqual((self.cache.n_written, self.cache.n_reused), (3, 1))
+
+    def test_bounds_the_number_of_files(self):
+        paths = [self.cache.write('box-template.urdf', str(i)) for i in range(10)]
+        self.cache.write('box-template.urdf', '7')  # most recently used is kept
+        paths.append(self.cache.write('box-template.urdf', '10'))
+        self.assertCountEqual(os.listdir(self.cache.directory),
+                              [os.path.basename(paths[i]) for i in (7, 9, 10)])
+        # a removed file is written again
+        os.remove(paths[7])
+        self.assertEqual(self.cache.write('box-template.urdf', '7'), paths[7])
+        self.assertTrue(os.path.exists(paths[7]))
+
+    def test_rereads_changed_templates(self):
+        template = os.path.join(self.root, 'template.urdf')
+        with open(template, 'w') as file:
+            file.write('a')
+        self.assertEqual(self.cache.read(template), 'a')
+        with open(template, 'w') as file:
+            file.write('bb')
+        self.assertEqual(self.cache.read(template), 'bb')
+
+
+class FillTemplateTest(absltest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.client = p.connect(p.DIRECT)
+
+    @classmethod
+    def tearDownClass(cls):
+        p.disconnect(cls.client)
+        super().tearDownClass()
+
+    def test_fills_loadable_shared_urdfs(self):
+        task = Task()
+        task.assets_root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(task.assets_root, 'box'))
+        with open(os.path.join(task.assets_root, 'box', 'box-template.urdf'), 'w') as file:
+            file.write(BOX_TEMPLATE)
+
+        urdf = task.fill_template('box/box-template.urdf', {'DIM': (0.1, 0.2, 0.3)})
+        self.assertEqual(task.fill_template('box/box-template.urdf', {'DIM': (0.1, 0.2, 0.3)}),
+                         urdf)
+        self.assertNotEqual(task.fill_template('box/box-template.urdf', {'DIM': (0.1, 0.2, 0.4)}),
+                            urdf)
+        with open(urdf) as file:
+            self.assertIn('<box size="0.1 0.2 0.3"/>', file.read())
+        body = p.loadURDF(urdf)
+        self.assertEqual(p.getCollisionShapeData(body, -1)[0][3], (0.1, 0.2, 0.3))
+
+    def test_keeps_the_random_stream_of_seeded_scenes(self):
+        task = Task()
+        task.assets_root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(task.assets_root, 'box'))
+        with open(os.path.join(task.assets_root, 'box', 'box-template.urdf'), 'w') as file:
+            file.write(BOX_TEMPLATE)
+
+        random.seed(0)
+        random.choices(string.ascii_lowercase + string.digits, k=16)  # the old file name
+        expected = random.random()
+        random.seed(0)
+        task.fill_template('box/box-template.urdf', {'DIM': (0.1, 0.2, 0.3)})
+        self.assertEqual(random.random(), expected)
+
+
+if __name__ == '__main__':
+    absltest.main()
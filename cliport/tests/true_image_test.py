@@ -0,0 +1,87 @@
+"""Tests for rendering the oracle images once per scene state."""
+
+import numpy as np
+import pybullet as p
+from absl.testing import absltest
+
+from cliport.tasks.task import Task
+
+
+class RenderCountingEnv:
+    """Stand-in environment with a block and a two-joint arm that counts the renders."""
+
+    def __init__(self):
+        p.resetSimulation()
+        p.setGravity(0, 0, -9.8)
+        p.createMultiBody(0, p.createCollisionShape(p.GEOM_PLANE))
+        link_shape = p.createCollisionShape(p.GEOM_BOX, halfExtents=[0.01, 0.01, 0.05])
+        self.arm = p.createMultiBody(
+            0, -1, basePosition=[0., 0., 0.], linkMasses=[0.1, 0.1],
+            linkCollisionShapeIndices=[link_shape] * 2, linkVisualShapeIndices=[-1] * 2,
+            linkPositions=[[0, 0, 0.1]] * 2, linkOrientations=[[0, 0, 0, 1]] * 2,
+            linkInertialFramePositions=[[0, 0, 0]] * 2,
+            linkInertialFrameOrientations=[[0, 0, 0, 1]] * 2, linkParentIndices=[0, 1],
+            linkJointTypes=[p.JOINT_REVOLUTE] * 2, linkJointAxis=[[0, 1, 0]] * 2)
+        block_shape = p.createCollisionShape(p.GEOM_BOX, halfExtents=[0.02] * 3)
+        self.block = p.createMultiBody(0.1, block_shape, basePosition=[0.5, 0., 0.02])
+        self.obj_ids = {'fixed': [], 'rigid': [self.block], 'deformable': []}
+        self.step_counter = 0
+        self.n_renders = 0
+
+    def render_camera(self, config):
+        self.n_renders += 1
+        height, width = config['image_size']
+        return (np.zeros((height, width, 3), dtype=np.uint8),
+                np.zeros((height, width), dtype=np.float32),
+                np.zeros((height, width), dtype=np.int32))
+
+
+class TrueImageTest(absltest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.client = p.connect(p.DIRECT)
+
+    @classmethod
+    def tearDownClass(cls):
+        p.disconnect(cls.client)
+        super().tearDownClass()
+
+    def test_one_render_per_oracle_step(self):
+        env = RenderCountingEnv()
+        task = Task()
+        agent = task.oracle(env)
+        for step in range(3):
+            agent.act(None, None)
+            cmap, hmap, mask = task.get_true_image(env)
+            self.assertIs(task.get_true_image(env)[1], hmap)
+            self.assertEqual(env.n_renders, step + 1)
+            p.stepSimulation()
+            env.step_counter += 1
+        self.assertFalse(hmap.flags.writeable)
+
+    def test_renders_again_when_scene_changes(self):
+        env = RenderCountingEnv()
+        task = Task()
+        task.get_true_image(env)
+
+        # a task resetting a body, as palletizing does between its renders
+        p.resetBasePositionAndOrientation(env.block, [0.5, -10., 0.02], [0, 0, 0, 1])
+        task.get_true_image(env)
+        self.assertEqual(env.n_renders, 2)
+
+        # the arm moving, with the objects still
+        p.resetJointState(env.arm, 1, 0.5)
+        task.get_true_image(env)
+        self.assertEqual(env.n_renders, 3)
+
+        p.createMultiBody(0.1, p.createCollisionShape(p.GEOM_SPHERE, radius=0.02),
+                          basePosition=[0.6, 0.2, 0.02])
+        task.get_true_image(env)
+        task.get_true_image(env)
+        self.assertEqual(env.n_renders, 4)
+
+
+if __name__ == '__main__':
+    absltest.main()
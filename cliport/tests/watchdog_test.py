@@ -0,0 +1,118 @@
+"""Tests for the per-turn budget of generated code."""
+
+import copy
+import threading
+import time
+
+import numpy as np
+from absl.testing import absltest
+
+from cliport import dahlia_run
+from cliport.utils import watchdog
+from cliport.utils.llm_backends import FakeBackend
+
+
+class StackingEnv:
+    """Stand-in environment whose actions only count themselves."""
+
+    def __init__(self):
+        self.object_list = ['red block', 'blue bowl']
+        self.n_steps = 0
+
+    def get_obj_pos(self, obj_name, count=1):
+        return [np.array([0.5, 0., 0.02])]
+
+    def get_obj_rot(self, obj_name, count=1):
+        return [np.array([0., 0., 0., 1.])]
+
+    def get_bounding_box(self, obj_name):
+        return (0.48, -0.02, 0., 0.52, 0.02, 0.04)
+
+    def step(self, action):
+        self.n_steps += 1
+
+
+def make_session(plan, **limits):
+    cfg = copy.deepcopy(dahlia_run.cfg_tabletop)
+    cfg['watchdog'] = limits
+    session = dahlia_run.LMPSession(cfg, 'fake', backend=FakeBackend(respond=lambda m: plan))
+    env = StackingEnv()
+    return session, session.reset(env), env
+
+
+class WatchdogTest(absltest.TestCase):
+
+    def test_stops_busy_loop_at_deadline(self):
+        budget = watchdog.Watchdog(max_seconds=0.2)
+        start = time.perf_counter()
+        with self.assertRaises(watchdog.BudgetExceeded) as cm:
+            with budget.turn():
+                dahlia_run.exec_safe('while True:\n    pass')
+        self.assertIs(cm.exception.watchdog, budget)
+        self.assertLess(time.perf_counter() - start, 1.)
+
+    def test_counts_api_calls(self):
+        probe = watchdog.counted(lambda: None)
+        budget = watchdog.Watchdog(max_calls=100)
+        with self.assertRaises(watchdog.BudgetExceeded):
+            with budget.turn():
+                dahlia_run.exec_safe('while True:\n    probe()', {'probe': probe})
+        self.assertEqual(budget.used['calls'], 101)
+
+    def test_nested_turns_share_budget(self):
+        budget = watchdog.Watchdog(max_actions=3)
+        with budget.turn():
+            watchdog.tick(actions=2)
+            with budget.turn():
+                with self.assertRaises(watchdog.BudgetExceeded):
+                    watchdog.tick(actions=2)
+        self.assertEqual(budget.used['actions'], 4)
+
+        # a new turn starts from a fresh budget and nothing is charged outside of turns
+        with budget.turn():
+            watchdog.tick(actions=3)
+        watchdog.tick(actions=10)
+        self.assertEqual(budget.used['actions'], 3)
+
+    def test_other_threads_are_not_charged(self):
+        budget = watchdog.Watchdog(max_actions=3)
+        with budget.turn():
+            worker = threading.Thread(target=watchdog.tick, kwargs={'actions': 10})
+            worker.start()
+            worker.join()
+            watchdog.tick(actions=1)
+        self.assertEqual(budget.used['actions'], 1)
+
+    def test_stops_endless_actions_of_planner(self):
+        plan = 'while True:\n    put_first_on_second("red block", "blue bowl")'
+        _, lmp, env = make_session(plan, max_actions=5)
+        with self.assertRaises(watchdog.BudgetExceeded):
+            lmp('stack forever', f'objects = {env.object_list}')
+        self.assertEqual(env.n_steps, 5)
+
+        # the next turn has its full budget again
+        with self.assertRaises(watchdog.BudgetExceeded):
+            lmp('stack forever', f'objects = {env.object_list}')
+        self.assertEqual(env.n_steps, 10)
+
+    def test_generated_code_cannot_catch_the_budget(self):
+        plan = ('try:\n'
+                '    while True:\n'
+                '        put_first_on_second("red block", "blue bowl")\n'
+                'except Exception:\n'
+                '    pass')
+        _, lmp, env = make_session(plan, max_actions=5)
+        with self.assertRaises(watchdog.BudgetExceeded):
+            lmp('stack forever', f'objects = {env.object_list}')
+        self.assertEqual(env.n_steps, 5)
+
+    def test_stops_endless_loop_in_generated_function(self):
+        plan = 'def spin():\n    while True:\n        get_obj_names()\nspin()'
+        session, lmp, env = make_session(plan, max_calls=50)
+        with self.assertRaises(watchdog.BudgetExceeded):
+            lmp('spin', f'objects = {env.object_list}')
+        self.assertEqual(session.lmp_tabletop_ui._watchdog.used['calls'], 51)
+
+
+if __name__ == '__main__':
+    absltest.main()
@@ -0,0 +1,106 @@
+"""Tests for serving the LMP object queries from a per-step world snapshot."""
+
+import collections
+
+import numpy as np
+from absl.testing import absltest
+
+from cliport import dahlia_run
+from cliport.utils.llm_backends import FakeBackend
+from cliport.utils.world_snapshot import WorldSnapshot
+
+PLAN = '''
+for name in get_obj_names():
+    if is_target_occupied(get_obj_pos(name)[0], 0.05):
+        say(f'{name} has neighbours')
+block_sizes = [get_bbox(name) for name in get_obj_names() if 'block' in name]
+positions = get_obj_positions_np(get_obj_names())
+free_pos = get_random_free_pos('red block', grid_size=0.02)
+put_first_on_second('red block', 'blue bowl')
+moved = get_obj_pos('red block')[0]
+put_first_on_second('green block', 'red block')
+'''.strip()
+
+
+class CountingEnv:
+    """Stand-in environment that counts the queries reaching the simulator."""
+
+    def __init__(self):
+        self.object_list = ['red block', 'green block', 'blue bowl']
+        self.positions = {'red block': [0.4, -0.2, 0.02], 'green block': [0.5, 0.1, 0.02],
+                          'blue bowl': [0.6, 0.3, 0.0]}
+        self.calls = collections.Counter()
+
+    def get_obj_pos(self, obj_name, count=1):
+        self.calls['pose'] += 1
+        return [np.array(self.positions[obj_name])]
+
+    def get_obj_rot(self, obj_name, count=1):
+        self.calls['pose'] += 1
+        return [np.array([0., 0., 0., 1.])]
+
+    def get_bounding_box(self, obj_name):
+        self.calls['aabb'] += 1
+        x, y, z = self.positions[obj_name]
+        return (x - 0.02, y - 0.02, z - 0.02, x + 0.02, y + 0.02, z + 0.02)
+
+    def step(self, action):
+        pos, _ = action['pose1']
+        for name, obj_pos in self.positions.items():
+            if np.allclose(obj_pos, action['pose0'][0]):
+                self.positions[name] = [pos[0], pos[1], pos[2] + 0.04]
+                break
+
+
+class SnapshotPerQuery(dahlia_run.LMP_wrapper):
+    """Wrapper that goes to the environment for every query, as before the snapshot."""
+
+    @property
+    def world(self):
+        return WorldSnapshot(self.env, self._world_step)
+
+
+class WorldSnapshotTest(absltest.TestCase):
+
+    def run_turn(self, wrapper_cls):
+        session = dahlia_run.LMPSession(dahlia_run.cfg_tabletop, 'fake',
+                                        backend=FakeBackend(respond=lambda messages: PLAN))
+        session.lmp_env.__class__ = wrapper_cls
+        env = CountingEnv()
+        session.reset(env)('sort the blocks', f'objects = {env.object_list}')
+        return env, session.variable_vars
+
+    def test_fewer_simulator_queries_per_turn(self):
+        env_before, vars_before = self.run_turn(SnapshotPerQuery)
+        env_after, vars_after = self.run_turn(dahlia_run.LMP_wrapper)
+
+        # same plan outcome, including the positions read after each step
+        self.assertEqual(env_after.positions, env_before.positions)
+        np.testing.assert_array_equal(vars_after['moved'], vars_before['moved'])
+        np.testing.assert_array_equal(vars_after['moved'], [0.6, 0.3, 0.04])
+        self.assertEqual(vars_after['block_sizes'], vars_before['block_sizes'])
+
+        # each distinct query reaches the environment once per step: before the first
+        # step 3 poses, 3 poses of all instances, 2 rotations and 3 boxes, after it
+        # 2 poses and 2 rotations
+        self.assertEqual(env_after.calls, {'pose': 12, 'aabb': 3})
+        self.assertEqual(env_before.calls, {'pose': 16, 'aabb': 9})
+
+    def test_snapshot_returns_copies(self):
+        env = CountingEnv()
+        world = WorldSnapshot(env, 0)
+        world.get_obj_pos('red block')[0][2] = 1.
+        np.testing.assert_array_equal(world.get_obj_pos('red block')[0], [0.4, -0.2, 0.02])
+        self.assertEqual(world.n_queries, 1)
+
+    def test_unhashable_queries_are_not_cached(self):
+        env = CountingEnv()
+        env.get_obj_pos = lambda obj_name, count=1: [np.array(obj_name)]
+        world = WorldSnapshot(env, 0)
+        world.get_obj_pos([0.1, 0.2])
+        world.get_obj_pos([0.1, 0.2])
+        self.assertEqual(world.n_queries, 2)
+
+
+if __name__ == '__main__':
+    absltest.main()
@@ -0,0 +1,77 @@
+"""Persistent library of functions generated by LMPFGen, shared across episodes and runs."""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+STATUS_OK = 'ok'
+STATUS_FAILED = 'failed'
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class FunctionLibrary:
+    """SQLite table of generated function sources keyed by
+    (signature, calling context hash, fgen prompt hash).
+
+    Only sources that were validated (executed and defined the requested function) are
+    served. Entries older than `max_age_days` are considered stale and regenerated,
+    failed entries are always regenerated.
+    """
+
+    def __init__(self, path, max_age_days=30.):
+        self.path = path
+        self.max_age = max_age_days * 24 * 3600 if max_age_days else None
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS functions ('
+                           'key TEXT PRIMARY KEY, f_name TEXT NOT NULL, f_sig TEXT NOT NULL, '
+                           'source TEXT NOT NULL, status TEXT NOT NULL, '
+                           'created REAL NOT NULL, uses INTEGER NOT NULL DEFAULT 0)')
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(backend, model, f_sig, context_hash, prompt_hash):
+        """Functions are only shared between runs of the same backend and model."""
+        return text_hash(f'{backend}\n{model}\n{f_sig}\n{context_hash}\n{prompt_hash}')
+
+    def lookup(self, key):
+        """Return the validated, fresh source stored under `key` or None."""
+        with self._lock:
+            row = self._conn.execute('SELECT source, status, created FROM functions WHERE key = ?',
+                                     (key,)).fetchone()
+            if (row is None or row[1] != STATUS_OK
+                    or (self.max_age is not None and time.time() - row[2] > self.max_age)):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute('UPDATE functions SET uses = uses + 1 WHERE key = ?', (key,))
+            self._conn.commit()
+            return row[0]
+
+    def store(self, key, f_name, f_sig, source, status):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO functions '
+                               '(key, f_name, f_sig, source, status, created) '
+                               'VALUES (?, ?, ?, ?, ?, ?)',
+                               (key, f_name, f_sig, source, status, time.time()))
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM functions').fetchone()[0]
+
+    def stats(self):
+        return (f'FGen library: {self.hits} reused, {self.misses} generated, '
+                f'{len(self)} functions stored')
+
+    def close(self):
+        self._conn.close()
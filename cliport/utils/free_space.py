@@ -0,0 +1,66 @@
+"""Vectorized free-space queries on a regular xy grid around object footprints."""
+
+import numpy as np
+from scipy import ndimage
+
+
+def footprint_distances(points, footprints):
+    """Euclidean xy distance of each of the (n, 2) `points` to each of the (m, 4)
+    axis-aligned `footprints` [x_min, y_min, x_max, y_max], as an (n, m) array."""
+    points = np.asarray(points, dtype=float).reshape(-1, 1, 2)
+    footprints = np.asarray(footprints, dtype=float).reshape(1, -1, 4)
+    dx = np.maximum(np.maximum(footprints[..., 0] - points[..., 0], 0.),
+                    points[..., 0] - footprints[..., 2])
+    dy = np.maximum(np.maximum(footprints[..., 1] - points[..., 1], 0.),
+                    points[..., 1] - footprints[..., 3])
+    return np.sqrt(dx ** 2 + dy ** 2)
+
+
+class FreeSpaceRaster:
+    """Occupancy raster of object footprints on the grid `x_coords` x `y_coords` plus a
+    distance transform holding the clearance of every cell to the nearest footprint.
+
+    Footprints are rasterised onto cells within half a cell of them, on a grid padded
+    by `pad` cells so objects just outside still count, and the transform measures
+    distances between cell centres. Clearances are thus within half a cell diagonal of
+    the exact distance; `free_mask` resolves the cells in that band exactly, so it
+    matches a point-by-point check against the footprints.
+    """
+
+    def __init__(self, x_coords, y_coords, grid_size, footprints, pad=0):
+        self.x_coords = np.asarray(x_coords, dtype=float)
+        self.y_coords = np.asarray(y_coords, dtype=float)
+        self.grid_size = grid_size
+        self.footprints = np.asarray(footprints, dtype=float).reshape(-1, 4)
+
+        shape = (len(self.x_coords) + 2 * pad, len(self.y_coords) + 2 * pad)
+        occupied = np.zeros(shape, dtype=bool)
+        if len(self.x_coords) and len(self.y_coords):
+            origin = np.array([self.x_coords[0], self.y_coords[0]]) - pad * grid_size
+            half = 0.5 * grid_size
+            lo = np.ceil((self.footprints[:, :2] - half - origin) / grid_size - 1e-9)
+            hi = np.floor((self.footprints[:, 2:] + half - origin) / grid_size + 1e-9)
+            lo = np.maximum(lo, 0).astype(int)
+            hi = np.minimum(hi, np.array(shape) - 1).astype(int)
+            for (x_lo, y_lo), (x_hi, y_hi) in zip(lo, hi):
+                if x_lo <= x_hi and y_lo <= y_hi:
+                    occupied[x_lo:x_hi + 1, y_lo:y_hi + 1] = True
+
+        if occupied.any():
+            clearance = ndimage.distance_transform_edt(~occupied, sampling=grid_size)
+        else:
+            clearance = np.full(shape, np.inf)
+        self.clearance = clearance[pad:shape[0] - pad, pad:shape[1] - pad]
+
+    def free_mask(self, r):
+        """Boolean (x, y) mask of the cells farther than `r` from every footprint.
+
+        Only reliable for `r` below the padding the raster was built with.
+        """
+        tol = self.grid_size / np.sqrt(2) + 1e-9
+        free = self.clearance > r + tol
+        ix, iy = np.nonzero((self.clearance > r - tol) & ~free)
+        if len(ix):
+            points = np.stack([self.x_coords[ix], self.y_coords[iy]], axis=1)
+            free[ix, iy] = footprint_distances(points, self.footprints).min(axis=1) > r
+        return free
@@ -0,0 +1,75 @@
+"""Base64 JPEG payloads of observation frames for VLM requests."""
+
+import base64
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from PIL import Image
+
+
+def encode_frame(frame, kind, max_side=None, quality=75):
+    """Base64 JPEG of a color ('c') or depth ('d') frame, downsampled so that its longer
+    side is at most `max_side` pixels."""
+    image = Image.fromarray(frame)
+    if image.mode == 'F':
+        image = image.convert('L' if kind == 'd' else 'RGB')
+    if max_side is not None:
+        # area averaging, cheaper than bilinear for moderate shrinking
+        image.thumbnail((max_side, max_side), Image.BOX)
+    buffered = BytesIO()
+    image.save(buffered, format='JPEG', quality=quality)
+    return base64.b64encode(buffered.getvalue()).decode('utf-8')
+
+
+class ImageEncoder:
+    """Encodes (frame, kind) image sources on a thread pool and memoises the payloads by
+    frame identity, so a frame sent with several requests is encoded once.
+
+    Frames must not be modified in place after they are submitted. The memo keeps a
+    reference to each frame, which also keeps its id from being reused.
+
+    Args:
+      max_side: longer side of the encoded images in pixels, None for full resolution.
+      quality: JPEG quality.
+      n_workers: encoding threads; PIL releases the GIL while encoding.
+      max_entries: frames memoised, the least recently used are dropped beyond this.
+    """
+
+    def __init__(self, max_side=None, quality=75, n_workers=4, max_entries=16):
+        self.max_side = max_side
+        self.quality = quality
+        self.n_workers = n_workers
+        self.max_entries = max_entries
+        self.n_encoded = 0
+        self.n_reused = 0
+        self._pool = None
+        self._memo = collections.OrderedDict()  # (id(frame), kind) -> (frame, future)
+
+    def submit(self, image_sources):
+        """Start encoding the image sources that are not memoised yet and return a future
+        of the payload of each."""
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.n_workers,
+                                            thread_name_prefix='image-encoder')
+        futures = []
+        for frame, kind in image_sources:
+            key = (id(frame), kind)
+            if key in self._memo:
+                self._memo.move_to_end(key)
+                self.n_reused += 1
+            else:
+                self._memo[key] = (frame, self._pool.submit(
+                    encode_frame, frame, kind, self.max_side, self.quality))
+                self.n_encoded += 1
+                while len(self._memo) > self.max_entries:
+                    self._memo.popitem(last=False)
+            futures.append(self._memo[key][1])
+        return futures
+
+    def encode(self, image_sources):
+        """Base64 JPEG payloads of the image sources, in order."""
+        return [future.result() for future in self.submit(image_sources)]
+
+    def clear(self):
+        self._memo.clear()
@@ -0,0 +1,522 @@
+"""LLM backends shared by the DAHLIA LMPs.
+
+Every backend exposes a blocking `complete` and an `asyncio` `acomplete` entry point
+that take chat-style messages and return the completion text, and a `stream` generator
+yielding it in chunks. Requests of all
+backends built by `make_backend` go through one shared token-bucket rate limiter,
+and transient errors are retried with exponential backoff and jitter that honours
+server-provided `Retry-After` hints.
+"""
+
+import asyncio
+import collections
+import copy
+import json
+import random
+import re
+import threading
+import time
+import weakref
+
+from cliport.utils.session_history import approx_token_count
+
+
+class RetryableError(Exception):
+    """Transient backend error (rate limit, dropped connection, overloaded server)."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def parse_retry_after(headers):
+    """Read the `Retry-After` header (in seconds) from a response header mapping."""
+    if not headers:
+        return None
+    for key in ('retry-after', 'Retry-After'):
+        if key in headers:
+            try:
+                return max(0., float(headers[key]))
+            except (TypeError, ValueError):
+                return None
+    return None
+
+
+def backoff_delay(attempt, base=1., max_delay=60., retry_after=None, rng=random):
+    """Full-jitter exponential backoff, never shorter than the server's `Retry-After`."""
+    delay = rng.uniform(0, min(max_delay, base * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate` requests per second with bursts up to `capacity`."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def per_minute(cls, requests_per_minute, burst=1):
+        return cls(requests_per_minute / 60., burst)
+
+    def _reserve(self):
+        """Take one token and return how long the caller must wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.
+            return -self._tokens / self.rate
+
+    def acquire(self):
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class LLMBackend:
+    """Base class. Subclasses implement `_complete` and raise `RetryableError` on
+    transient failures; everything else propagates to the caller."""
+
+    name = 'llm'
+
+    def __init__(self, rate_limiter=None, max_retries=8, backoff_base=1., backoff_max=60.,
+                 seed=None):
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._rng = random.Random(seed)
+
+    def _complete(self, messages, model, temperature, max_tokens, stop, prefix=None):
+        raise NotImplementedError
+
+    async def _acomplete(self, messages, model, temperature, max_tokens, stop, prefix=None):
+        """Backends with an asynchronous client override this; by default the blocking
+        `_complete` runs in a worker thread."""
+        return await asyncio.to_thread(
+            self._complete, messages, model, temperature, max_tokens, stop, prefix)
+
+    def count_tokens(self, text):
+        """Number of tokens of `text` for this backend's model, approximate by default."""
+        return approx_token_count(text)
+
+    def _retry_delay(self, attempt, err):
+        if attempt >= self.max_retries:
+            raise err
+        delay = backoff_delay(attempt, self.backoff_base, self.backoff_max, err.retry_after,
+                              self._rng)
+        print(f'{self.name} got err {err}')
+        print(f'Retrying after {delay:.1f}s.')
+        return delay
+
+    def complete(self, messages, model=None, temperature=0., max_tokens=2048, stop=None,
+                 prefix=None):
+        """Return the completion text. `prefix` is an optional leading part of the last
+        message that stays constant across calls, which backends may cache."""
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            try:
+                return self._complete(messages, model, temperature, max_tokens, stop, prefix)
+            except RetryableError as err:
+                time.sleep(self._retry_delay(attempt, err))
+                attempt += 1
+
+    def _stream(self, messages, model, temperature, max_tokens, stop, prefix=None):
+        """Yield the completion in chunks; backends without streaming yield it at once."""
+        yield self._complete(messages, model, temperature, max_tokens, stop, prefix)
+
+    def stream(self, messages, model=None, temperature=0., max_tokens=2048, stop=None,
+               prefix=None):
+        """Yield the completion text in chunks as they arrive. Transient failures are only
+        retried before the first chunk, later ones propagate to the caller."""
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            started = False
+            try:
+                for chunk in self._stream(messages, model, temperature, max_tokens, stop,
+                                          prefix):
+                    started = True
+                    yield chunk
+                return
+            except RetryableError as err:
+                if started:
+                    raise
+                time.sleep(self._retry_delay(attempt, err))
+                attempt += 1
+
+    async def acomplete(self, messages, model=None, temperature=0., max_tokens=2048,
+                        stop=None, prefix=None):
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                await self.rate_limiter.acquire_async()
+            try:
+                return await self._acomplete(messages, model, temperature, max_tokens, stop,
+                                             prefix)
+            except RetryableError as err:
+                await asyncio.sleep(self._retry_delay(attempt, err))
+                attempt += 1
+
+
+_openai_pool_sizes = []  # pool sizes of the open OpenAIBackends, see `_make_openai_session`
+_openai_hook_lock = threading.Lock()
+
+
+def _make_openai_session():
+    """`openai.requestssession` factory: the session openai<1 makes for each thread (its
+    proxy and connection retries), with a connection pool as large as the largest
+    `pool_size` of the open backends. openai recycles it as usual."""
+    import openai
+    import requests
+    from openai import api_requestor
+
+    session = requests.Session()
+    if openai.proxy:
+        proxy = openai.proxy
+        session.proxies = {'http': proxy, 'https': proxy} if isinstance(proxy, str) else dict(proxy)
+    size = max(_openai_pool_sizes, default=requests.adapters.DEFAULT_POOLSIZE)
+    session.mount('https://', requests.adapters.HTTPAdapter(
+        pool_connections=size, pool_maxsize=size,
+        max_retries=api_requestor.MAX_CONNECTION_RETRIES))
+    return session
+
+
+class OpenAIBackend(LLMBackend):
+    """OpenAI chat completions, with `pool_size` connections per thread for blocking calls
+    and one `aiohttp` session per event loop for `acomplete`.
+
+    openai<1 keeps a `requests` session per thread and takes no session per request. The
+    backend sizes its pool through the `openai.requestssession` hook while it is open,
+    unless the hook is already set; `close` unsets it again. Asynchronous calls bind the
+    backend's `aiohttp` session to the `openai.aiosession` context variable.
+    """
+
+    name = 'openai'
+
+    def __init__(self, use_stop=True, pool_size=16, **kwargs):
+        super().__init__(**kwargs)
+        import openai
+        from openai import error
+
+        self.use_stop = use_stop
+        self._openai = openai
+        self._retryable = (error.RateLimitError, error.APIConnectionError,
+                           error.ServiceUnavailableError, error.Timeout)
+        self.pool_size = pool_size
+        with _openai_hook_lock:
+            self._hooked = openai.requestssession in (None, _make_openai_session)
+            if self._hooked:
+                openai.requestssession = _make_openai_session
+                _openai_pool_sizes.append(pool_size)
+        self._aiosessions = weakref.WeakKeyDictionary()  # event loop -> aiohttp session
+        self._encoding = None  # tiktoken encoding, loaded on first use
+
+    def close(self):
+        """Stop sizing openai's sessions; the last backend to close unsets the hook."""
+        with _openai_hook_lock:
+            if not self._hooked:
+                return
+            self._hooked = False
+            _openai_pool_sizes.remove(self.pool_size)
+            if not _openai_pool_sizes and self._openai.requestssession is _make_openai_session:
+                self._openai.requestssession = None
+
+    def count_tokens(self, text):
+        if self._encoding is None:
+            try:
+                import tiktoken
+                self._encoding = tiktoken.get_encoding('cl100k_base')
+            except Exception:
+                # tiktoken is optional and needs to download its vocabulary once
+                self._encoding = False
+        if self._encoding is False:
+            return approx_token_count(text)
+        return len(self._encoding.encode(text))
+
+    def _aiosession(self):
+        import aiohttp
+
+        loop = asyncio.get_running_loop()
+        if loop not in self._aiosessions:
+            self._aiosessions[loop] = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size))
+        return self._aiosessions[loop]
+
+    async def aclose(self):
+        """Close the `aiohttp` session of the running event loop."""
+        session = self._aiosessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+    def _create_kwargs(self, messages, model, temperature, max_tokens, stop):
+        kwargs = dict(messages=messages, temperature=temperature, model=model,
+                      max_tokens=max_tokens)
+        if self.use_stop and stop:
+            kwargs['stop'] = stop
+        return kwargs
+
+    def _complete(self, messages, model, temperature, max_tokens, stop, prefix=None):
+        try:
+            res = self._openai.ChatCompletion.create(
+                **self._create_kwargs(messages, model, temperature, max_tokens, stop))
+        except self._retryable as e:
+            raise RetryableError(str(e), parse_retry_after(getattr(e, 'headers', None))) from e
+        return res['choices'][0]['message']['content'].strip()
+
+    async def _acomplete(self, messages, model, temperature, max_tokens, stop, prefix=None):
+        # the context variable is local to the task awaiting this call
+        token = self._openai.aiosession.set(self._aiosession())
+        try:
+            res = await self._openai.ChatCompletion.acreate(
+                **self._create_kwargs(messages, model, temperature, max_tokens, stop))
+        except self._retryable as e:
+            raise RetryableError(str(e), parse_retry_after(getattr(e, 'headers', None))) from e
+        finally:
+            self._openai.aiosession.reset(token)
+        return res['choices'][0]['message']['content'].strip()
+
+    def _stream(self, messages, model, temperature, max_tokens, stop, prefix=None):
+        try:
+            parts = self._openai.ChatCompletion.create(
+                stream=True, **self._create_kwargs(messages, model, temperature, max_tokens, stop))
+            for part in parts:
+                content = part['choices'][0]['delta'].get('content')
+                if content:
+                    yield content
+        except self._retryable as e:
+            raise RetryableError(str(e), parse_retry_after(getattr(e, 'headers', None))) from e
+
+
+class GeminiBackend(LLMBackend):
+    """Google Gemini; only the text of the user messages is sent."""
+
+    name = 'gemini'
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        import google.generativeai as genai
+        from google.api_core import exceptions
+
+        self._genai = genai
+        self._models = {}
+        self._retryable = (exceptions.ResourceExhausted, exceptions.ServiceUnavailable,
+                           exceptions.DeadlineExceeded)
+
+    def _complete(self, messages, model, temperature, max_tokens, stop, prefix=None):
+        if model not in self._models:
+            self._models[model] = self._genai.GenerativeModel(model)
+        prompt = '\n'.join(m['content'] for m in messages if m['role'] == 'user')
+        try:
+            return self._models[model].generate_content(prompt).text
+        except self._retryable as e:
+            raise RetryableError(str(e)) from e
+
+
+class HFBackend(LLMBackend):
+    """Locally loaded HuggingFace (or vLLM) chat model. Generation is serialized since
+    a single model instance is shared by all LMPs.
+
+    With `prefix_caching`, the key/value cache of the constant few-shot prefix passed
+    as `prefix` is computed once and reused, so prefill only runs over the per-call
+    context and query. vLLM does the same internally via `enable_prefix_caching`.
+    """
+
+    name = 'huggingface'
+
+    def __init__(self, model, tokenizer, use_vllm=False, prefix_caching=True, max_prefixes=8,
+                 **kwargs):
+        super().__init__(**kwargs)
+        import torch
+        torch.backends.cuda.enable_mem_efficient_sdp(False)
+        torch.backends.cuda.enable_flash_sdp(False)
+
+        self.model = model
+        self.tokenizer = tokenizer
+        self.use_vllm = use_vllm
+        self.prefix_caching = prefix_caching and not use_vllm
+        self.max_prefixes = max_prefixes
+        self._prefix_kv = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.terminators = [
+            tokenizer.eos_token_id,
+            tokenizer.convert_tokens_to_ids("<|eot_id|>")
+        ]
+
+    def count_tokens(self, text):
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+    def _prefix_past_key_values(self, prefix_messages, input_ids):
+        """Return a fresh copy of the cached prefix KV for `input_ids`, or None."""
+        import torch
+
+        key = json.dumps(prefix_messages, sort_keys=True)
+        if key not in self._prefix_kv:
+            prefix_ids = self.tokenizer.apply_chat_template(prefix_messages)
+            # the template closes the user turn after the prefix and tokens may merge
+            # across the boundary, so only keep what the full prompt actually shares
+            n = 0
+            while (n < min(len(prefix_ids), len(input_ids) - 1)
+                   and prefix_ids[n] == input_ids[n]):
+                n += 1
+            if n == 0:
+                return None
+            with torch.no_grad():
+                out = self.model(torch.tensor([input_ids[:n]], device=self.model.device),
+                                 use_cache=True)
+            self._prefix_kv[key] = (list(input_ids[:n]), out.past_key_values)
+            while len(self._prefix_kv) > self.max_prefixes:
+                self._prefix_kv.popitem(last=False)
+        self._prefix_kv.move_to_end(key)
+        cached_ids, past_key_values = self._prefix_kv[key]
+        if len(cached_ids) >= len(input_ids) or list(input_ids[:len(cached_ids)]) != cached_ids:
+            return None
+        # generation extends the cache in place
+        return copy.deepcopy(past_key_values)
+
+    def generate_ids(self, input_ids, prefix_messages=None, **generate_kwargs):
+        """Generate from a list of prompt token ids and return the new token ids."""
+        import torch
+
+        past_key_values = None
+        if self.prefix_caching and prefix_messages is not None:
+            past_key_values = self._prefix_past_key_values(prefix_messages, input_ids)
+        inputs = torch.tensor([input_ids], device=self.model.device)
+        generated_ids = self.model.generate(
+            inputs,
+            attention_mask=torch.ones_like(inputs),
+            past_key_values=past_key_values,
+            **generate_kwargs,
+        )
+        return generated_ids[0][len(input_ids):]
+
+    def _complete(self, messages, model, temperature, max_tokens, stop, prefix=None):
+        llm_model_inputs = self.tokenizer.apply_chat_template(
+            messages,
+            add_generation_prompt=True,
+        )
+        with self._lock:
+            if not self.use_vllm:
+                prefix_messages = None
+                if prefix:
+                    prefix_messages = messages[:-1] + [{'role': messages[-1]['role'],
+                                                        'content': prefix}]
+                response = self.generate_ids(
+                    llm_model_inputs,
+                    prefix_messages=prefix_messages,
+                    max_new_tokens=max_tokens,
+                    top_p=1.0,
+                    top_k=50,
+                    temperature=0.7 + temperature,
+                    do_sample=True,
+                    eos_token_id=self.terminators,
+                )
+                return self.tokenizer.decode(response, skip_special_tokens=True)
+
+            from vllm import SamplingParams
+            sampling_params = SamplingParams(
+                temperature=0.8,
+                top_p=0.95,
+                top_k=50,
+                max_tokens=max_tokens,
+                stop_token_ids=self.terminators,
+            )
+            outputs = self.model.generate(
+                prompt_token_ids=llm_model_inputs,
+                sampling_params=sampling_params
+            )
+            assert len(outputs) == 1, "Size of outputs is not 1."
+            return outputs[0].outputs[0].text
+
+
+class FakeBackend(LLMBackend):
+    """In-process stand-in for offline tests and benchmarks.
+
+    Args:
+      respond: completion text, or a callable mapping the messages to it.
+      latency: base seconds spent per call (time to first token when streaming).
+      token_rate: if set, whitespace-delimited tokens decoded per second; `stream` emits
+        them one by one on a fixed schedule and `complete` waits for all of them.
+      tail_latency: extra seconds added to a `tail_prob` fraction of calls.
+      error_rate: probability of raising a `RetryableError` instead of answering.
+      retry_after: `Retry-After` hint attached to injected errors.
+    """
+
+    name = 'fake'
+
+    def __init__(self, respond='', latency=0., tail_latency=0., tail_prob=0.,
+                 error_rate=0., retry_after=None, token_rate=None, **kwargs):
+        kwargs.setdefault('backoff_base', 0.01)
+        super().__init__(**kwargs)
+        self.respond = respond
+        self.latency = latency
+        self.tail_latency = tail_latency
+        self.tail_prob = tail_prob
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.token_rate = token_rate
+        self.calls = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def _tokens(self, messages):
+        with self._lock:
+            self.calls += 1
+            fail = self._rng.random() < self.error_rate
+            slow = self._rng.random() < self.tail_prob
+        time.sleep(self.latency + (self.tail_latency if slow else 0.))
+        if fail:
+            with self._lock:
+                self.errors += 1
+            raise RetryableError('injected error', self.retry_after)
+        text = self.respond(messages) if callable(self.respond) else self.respond
+        if self.token_rate is None:
+            return [text]
+        return re.findall(r'\s*\S+|\s+', text)
+
+    def _complete(self, messages, model, temperature, max_tokens, stop, prefix=None):
+        tokens = self._tokens(messages)
+        if self.token_rate is not None:
+            time.sleep(len(tokens) / self.token_rate)
+        return ''.join(tokens)
+
+    def _stream(self, messages, model, temperature, max_tokens, stop, prefix=None):
+        tokens = self._tokens(messages)
+        # like a server, keep decoding on schedule while the caller is busy
+        start = time.perf_counter()
+        for i, token in enumerate(tokens):
+            if self.token_rate is not None:
+                time.sleep(max(0., start + (i + 1) / self.token_rate - time.perf_counter()))
+            yield token
+
+
+def make_backend(llm, offline_model=None, offline_tokenizer=None, use_vllm=False, pool_size=16,
+                 **kwargs):
+    """Build the backend for an LMP `llm` name ('gpt3', 'gpt4', 'gemini', 'llama' or 'fake')."""
+    if 'gpt3' in llm:
+        return OpenAIBackend(use_stop=True, pool_size=pool_size, **kwargs)
+    elif 'gpt4' in llm:
+        return OpenAIBackend(use_stop=False, pool_size=pool_size, **kwargs)
+    elif 'gemini' in llm:
+        return GeminiBackend(**kwargs)
+    elif 'llama' in llm:
+        return HFBackend(offline_model, offline_tokenizer, use_vllm=use_vllm, **kwargs)
+    elif 'fake' in llm:
+        return FakeBackend(**kwargs)
+    raise ValueError(f'Unknown LLM {llm}')
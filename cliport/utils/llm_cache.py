@@ -0,0 +1,144 @@
+"""Persistent, content-addressed cache for LLM completions."""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+CACHE_MODES = ('off', 'record', 'replay')
+
+
+class CacheMissError(KeyError):
+    """Raised in `replay` mode when a prompt has no recorded response."""
+
+
+class ResponseCache:
+    """SQLite-backed response cache with LRU eviction.
+
+    Modes:
+      off: never read or write, every call goes to the model.
+      record: serve hits from the cache, call the model on a miss and store the result.
+      replay: serve hits from the cache, raise `CacheMissError` on a miss.
+    """
+
+    def __init__(self, path, mode='record', max_entries=20000, touch_batch=64):
+        if mode is False or mode is None:
+            mode = 'off'  # unquoted `off` in a yaml file is parsed as False
+        if mode not in CACHE_MODES:
+            raise ValueError(f'cache mode must be in {CACHE_MODES}, got {mode}')
+        self.mode = mode
+        self.path = path
+        self.max_entries = max_entries
+        self.touch_batch = touch_batch
+        self._touched = {}  # key -> last access of hits not yet written
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        if self.mode != 'off':
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            # several test workers can share the file: wait for their locks, and let
+            # readers run next to a writer
+            self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS responses ('
+                               'key TEXT PRIMARY KEY, response TEXT NOT NULL, '
+                               'last_access INTEGER NOT NULL)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS responses_lru '
+                               'ON responses (last_access)')
+            self._conn.commit()
+            self._clock = self._conn.execute(
+                'SELECT COALESCE(MAX(last_access), 0) FROM responses').fetchone()[0]
+
+    @staticmethod
+    def make_key(backend, model, temperature, max_tokens, stop, prompt):
+        """Hash everything that determines the completion into a hex digest."""
+        payload = json.dumps({
+            'backend': backend,
+            'model': model,
+            'temperature': temperature,
+            'max_tokens': max_tokens,
+            'stop': list(stop) if stop else [],
+            'prompt': prompt,
+        }, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Return the cached response for `key` or None, updating hit/miss counters."""
+        if self.mode == 'off':
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT response FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._clock += 1
+            self._touched[key] = self._clock
+            if len(self._touched) >= self.touch_batch:
+                self._write_touches()
+                self._conn.commit()
+            return row[0]
+
+    def _write_touches(self):
+        # hits only update the LRU order, so they are written in batches instead of a
+        # write transaction per hit
+        self._conn.executemany('UPDATE responses SET last_access = ? WHERE key = ?',
+                               [(clock, key) for key, clock in self._touched.items()])
+        self._touched.clear()
+
+    def put(self, key, response):
+        """Store a response and evict least recently used entries beyond `max_entries`."""
+        if self.mode != 'record':
+            return
+        with self._lock:
+            self._write_touches()
+            self._clock += 1
+            self._conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?)',
+                               (key, response, self._clock))
+            n_entries = self._conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+            if n_entries > self.max_entries:
+                self._conn.execute(
+                    'DELETE FROM responses WHERE key IN ('
+                    'SELECT key FROM responses ORDER BY last_access ASC LIMIT ?)',
+                    (n_entries - self.max_entries,))
+            self._conn.commit()
+
+    def get_or_call(self, key, fn):
+        """Return the cached response for `key`, calling `fn()` on a miss."""
+        if self.mode == 'off':
+            return fn()
+        response = self.get(key)
+        if response is not None:
+            return response
+        if self.mode == 'replay':
+            raise CacheMissError(f'no recorded response for key {key}')
+        response = fn()
+        self.put(key, response)
+        return response
+
+    def __len__(self):
+        if self._conn is None:
+            return 0
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.
+
+    def stats(self):
+        return (f'LLM cache ({self.mode}): {self.hits} hits, {self.misses} misses, '
+                f'hit rate {self.hit_rate:.2f}, {len(self)} entries')
+
+    def close(self):
+        if self._conn is not None:
+            with self._lock:
+                self._write_touches()
+                self._conn.commit()
+            self._conn.close()
+            self._conn = None
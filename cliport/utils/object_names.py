@@ -0,0 +1,61 @@
+"""Index of the object names of an episode: ids, colors, categories and size hints."""
+
+import collections
+import functools
+import re
+
+from cliport.utils import utils
+
+ObjectName = collections.namedtuple(
+    'ObjectName', ['name', 'id', 'color', 'category', 'scale', 'is_zone', 'is_pallet'])
+
+_scale_pattern = re.compile(r'(\d+(\.\d+)?)x')
+
+
+@functools.lru_cache(maxsize=4096)
+def _describe(name, n_colors):
+    # n_colors keys the cache on utils.COLORS, a defaultdict that grows on lookups
+    parts = name.split()
+    obj_id = int(parts[-1]) if parts and parts[-1].isdigit() else None
+    color_name = next((color for color in utils.COLORS if color in name), None)
+    category = ' '.join(part for part in (parts[:-1] if obj_id is not None else parts)
+                        if part not in utils.COLORS)
+    scale = 1
+    if 'scaled' in name:
+        match = _scale_pattern.search(name)
+        scale = float(match.group(1)) if match else 1
+    return ObjectName(name, obj_id, utils.COLORS[color_name] if color_name else None,
+                      category, scale, 'zone' in name, 'pallet' in name)
+
+
+def describe(name):
+    """`ObjectName` with everything the LMP APIs parse out of an object name."""
+    return _describe(str(name), len(utils.COLORS))
+
+
+class ObjectNameIndex:
+    """Object names of an episode indexed by id and category.
+
+    `sync` indexes the names appended to the object list since the last call, and
+    re-indexes when the list is replaced, so it is cheap to call before every lookup.
+    """
+
+    def __init__(self):
+        self.by_id = {}  # id -> first name ending with that id
+        self.by_category = collections.defaultdict(list)
+        self._names = None
+        self._n_indexed = 0
+
+    def sync(self, object_names):
+        if object_names is not self._names or len(object_names) < self._n_indexed:
+            self.by_id.clear()
+            self.by_category.clear()
+            self._names = object_names
+            self._n_indexed = 0
+        for name in object_names[self._n_indexed:]:
+            obj = describe(name)
+            if obj.id is not None:
+                self.by_id.setdefault(obj.id, name)
+            self.by_category[obj.category].append(name)
+        self._n_indexed = len(object_names)
+        return self
@@ -0,0 +1,69 @@
+"""Incrementally maintained occupancy of the task heightmap by the bodies of an episode."""
+
+import numpy as np
+import pybullet as p
+
+from cliport.utils import utils
+
+
+class OccupancyMap:
+    """Pixels of the (height, width) heightmap over `bounds` covered by the bodies of an
+    episode, in the layout of `utils.get_heightmap`: rows along y, columns along x.
+
+    It is loaded from a rendered segmentation mask, which `mask` keeps. Bodies can also
+    be stamped with the xy footprint of their AABB as they are added, so the scene does
+    not have to be rendered for every new object; `moved` tells when physics has moved a
+    body since, and the map must then be rebuilt from a rendered mask.
+    """
+
+    def __init__(self, bounds, pix_size, pos_tol=1e-4):
+        self.bounds = np.asarray(bounds, dtype=float)
+        self.pix_size = pix_size
+        self.pos_tol = pos_tol
+        width = int(np.round((self.bounds[0, 1] - self.bounds[0, 0]) / pix_size))
+        height = int(np.round((self.bounds[1, 1] - self.bounds[1, 0]) / pix_size))
+        self.occupied = np.zeros((height, width), dtype=bool)
+        self.mask = None  # the mask and bodies the map was last loaded from
+        self.bodies = []
+        self._poses = {}  # body id -> (position, orientation) when it was mapped
+
+    def __contains__(self, body):
+        return body in self._poses
+
+    def _record(self, body):
+        pos, orn = p.getBasePositionAndOrientation(body)
+        self._poses[body] = (np.array(pos), np.array(orn))
+
+    def stamp(self, body):
+        """Mark the pixels under the AABB of `body`."""
+        aabb_min, aabb_max = p.getAABB(body)
+        lo = np.floor((np.array(aabb_min[:2]) - self.bounds[:2, 0]) / self.pix_size)
+        hi = np.floor((np.array(aabb_max[:2]) - self.bounds[:2, 0]) / self.pix_size)
+        # a pixel (u, v) covers [x0 + v * pix_size, x0 + (v + 1) * pix_size) and the same in y
+        v_lo, u_lo = np.maximum(lo, 0).astype(int)
+        v_hi = min(int(hi[0]), self.occupied.shape[1] - 1)
+        u_hi = min(int(hi[1]), self.occupied.shape[0] - 1)
+        if u_lo <= u_hi and v_lo <= v_hi:
+            self.occupied[u_lo:u_hi + 1, v_lo:v_hi + 1] = True
+        self._record(body)
+
+    def load_mask(self, mask, bodies):
+        """Replace the map by the pixels of `bodies` in a rendered segmentation mask."""
+        self.occupied = utils.label_objects(mask, bodies) > 0
+        self.mask, self.bodies = mask, list(bodies)
+        self._poses = {}
+        for body in bodies:
+            self._record(body)
+
+    def moved(self, bodies):
+        """Whether a mapped body has moved since it was mapped or is no longer one of the
+        `bodies` of the episode."""
+        for body, (pos, orn) in self._poses.items():
+            try:
+                cur_pos, cur_orn = p.getBasePositionAndOrientation(body)
+            except p.error:
+                return True
+            if (np.abs(np.subtract(cur_pos, pos)).max() > self.pos_tol
+                    or np.abs(np.subtract(cur_orn, orn)).max() > self.pos_tol):
+                return True
+        return not set(self._poses) <= set(bodies)
@@ -0,0 +1,99 @@
+"""Bounded history of an LMP session with incremental token accounting."""
+
+import collections
+import itertools
+import re
+
+HISTORY_POLICIES = ('evict', 'summarize')
+
+_token_pattern = re.compile(r'\w+|[^\w\s]')
+
+
+def approx_token_count(text):
+    """Rough BPE-like count: one token per word, number or punctuation character."""
+    return len(_token_pattern.findall(text))
+
+
+def summarize_turns(turns):
+    """Default summariser: the first non-empty line of every turn, as comments."""
+    lines = []
+    for turn in turns:
+        first_line = next((line.strip() for line in turn.splitlines() if line.strip()), '')
+        lines.append(f'# earlier: {first_line.lstrip("# ")}')
+    return '\n'.join(lines)
+
+
+class SessionHistory:
+    """Executed turns of an LMP session that are replayed in the next prompts.
+
+    Every turn and summary line is tokenized once with `count_tokens`, so the size of
+    the history is known without re-tokenizing the prompt. Beyond `max_tokens` the
+    oldest turns are dropped (`evict`) or folded into summary lines at the front of
+    the history (`summarize`), which get a quarter of the budget and lose their oldest
+    lines first. The newest turn is always kept.
+
+    Args:
+      max_tokens: token budget of the history, None for unbounded.
+      policy: 'evict' or 'summarize'.
+      count_tokens: callable mapping a text to its number of tokens.
+      summarize: callable mapping the list of evicted turns to summary text.
+    """
+
+    def __init__(self, max_tokens=None, policy='evict', count_tokens=approx_token_count,
+                 summarize=summarize_turns):
+        if policy not in HISTORY_POLICIES:
+            raise ValueError(f'history policy must be in {HISTORY_POLICIES}, got {policy}')
+        self.max_tokens = max_tokens
+        self.policy = policy
+        self.count_tokens = count_tokens
+        self.summarize = summarize
+        self.n_evicted = 0
+        self._turns = collections.deque()  # (text, n_tokens)
+        self._summary = collections.deque()  # (line, n_tokens)
+        self._turn_tokens = 0
+        self._summary_tokens = 0
+
+    @property
+    def tokens(self):
+        return self._turn_tokens + self._summary_tokens
+
+    @property
+    def text(self):
+        """The history as it goes into the prompt, every entry on a new line."""
+        return ''.join(f'\n{text}' for text, _ in itertools.chain(self._summary, self._turns))
+
+    def __len__(self):
+        return len(self._turns)
+
+    def append(self, text):
+        n_tokens = self.count_tokens(f'\n{text}')
+        self._turns.append((text, n_tokens))
+        self._turn_tokens += n_tokens
+        self._enforce_budget()
+
+    def clear(self):
+        self._turns.clear()
+        self._summary.clear()
+        self._turn_tokens = 0
+        self._summary_tokens = 0
+
+    def _enforce_budget(self):
+        if self.max_tokens is None:
+            return
+        summary_budget = self.max_tokens // 4 if self.policy == 'summarize' else 0
+        evicted = []
+        while self._turn_tokens > self.max_tokens - summary_budget and len(self._turns) > 1:
+            text, n_tokens = self._turns.popleft()
+            self._turn_tokens -= n_tokens
+            evicted.append(text)
+        self.n_evicted += len(evicted)
+
+        if evicted and self.policy == 'summarize':
+            for line in self.summarize(evicted).splitlines():
+                n_tokens = self.count_tokens(f'\n{line}')
+                self._summary.append((line, n_tokens))
+                self._summary_tokens += n_tokens
+            while self._summary_tokens > summary_budget and self._summary:
+                _, n_tokens = self._summary.popleft()
+                self._summary_tokens -= n_tokens
+
@@ -0,0 +1,52 @@
+"""Snapshot and rollback of a running episode: the PyBullet world and the Python-side
+state of the environment and its task."""
+
+import collections
+import copy
+import random
+
+import numpy as np
+import pybullet as p
+
+SimSnapshot = collections.namedtuple(
+    'SimSnapshot', ['state_id', 'obj_ids', 'object_list', 'task_state', 'rng_states'])
+
+# task attributes that are shared with the snapshot rather than copied: caches and
+# helpers that do not change during an episode
+_SHARED_TASK_ATTRS = ('obj_points_cache', 'primitive', 'oracle_cams', 'assets_root')
+
+
+def snapshot(env):
+    """Save the episode of `env` in memory and return a handle for `restore`.
+
+    Take snapshots between actions: bodies added and suction grasps made after the
+    snapshot cannot be rolled back by `p.restoreState`.
+    """
+    task_state = {k: v for k, v in vars(env.task).items() if k not in _SHARED_TASK_ATTRS}
+    return SimSnapshot(
+        state_id=p.saveState(),
+        obj_ids=copy.deepcopy(env.obj_ids),
+        object_list=list(env.object_list),
+        task_state=copy.deepcopy(task_state),
+        rng_states=(random.getstate(), np.random.get_state()),
+    )
+
+
+def restore(env, snap):
+    """Roll `env` back to `snap`. The handle stays valid until `discard`.
+
+    Containers of the environment are restored in place, so references to
+    `env.object_list` and `env.obj_ids` held elsewhere stay current.
+    """
+    p.restoreState(stateId=snap.state_id)
+    for obj_type, ids in snap.obj_ids.items():
+        env.obj_ids.setdefault(obj_type, [])[:] = ids
+    env.object_list[:] = snap.object_list
+    vars(env.task).update(copy.deepcopy(snap.task_state))
+    random.setstate(snap.rng_states[0])
+    np.random.set_state(snap.rng_states[1])
+
+
+def discard(snap):
+    """Free the PyBullet memory of `snap`."""
+    p.removeState(snap.state_id)
@@ -0,0 +1,77 @@
+"""R-tree over the xy footprints of named objects."""
+
+import numpy as np
+from rtree import index
+
+from cliport.utils.free_space import footprint_distances
+
+
+class SpatialIndex:
+    """Incrementally maintained R-tree of axis-aligned xy footprints
+    [x_min, y_min, x_max, y_max], keyed by object name.
+
+    Results list the object names in the order they were first added.
+    """
+
+    def __init__(self):
+        self._index = index.Index()
+        self._ids = {}  # name -> id
+        self._names = {}  # id -> name
+        self._bounds = {}  # id -> footprint tuple
+        self._next_id = 0
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, name):
+        return name in self._ids
+
+    def __iter__(self):
+        return iter(list(self._ids))
+
+    def update(self, name, footprint):
+        """Add `name` or move it to `footprint`. Returns whether the index changed."""
+        footprint = tuple(float(v) for v in footprint)
+        obj_id = self._ids.get(name)
+        if obj_id is None:
+            obj_id = self._ids[name] = self._next_id
+            self._names[obj_id] = name
+            self._next_id += 1
+        elif self._bounds[obj_id] == footprint:
+            return False
+        else:
+            self._index.delete(obj_id, self._bounds[obj_id])
+        self._index.insert(obj_id, footprint)
+        self._bounds[obj_id] = footprint
+        return True
+
+    def remove(self, name):
+        obj_id = self._ids.pop(name)
+        self._index.delete(obj_id, self._bounds.pop(obj_id))
+        del self._names[obj_id]
+
+    def _exact(self, ids, point):
+        ids = sorted(ids)
+        if not ids:
+            return ids, np.zeros(0)
+        footprints = np.array([self._bounds[obj_id] for obj_id in ids])
+        return ids, footprint_distances(np.asarray(point, dtype=float)[:2], footprints)[0]
+
+    def objects_near(self, point, r):
+        """Names of the objects whose footprint is within xy distance `r` of `point`."""
+        x, y = point[0], point[1]
+        ids, dists = self._exact(self._index.intersection((x - r, y - r, x + r, y + r)),
+                                 point)
+        return [self._names[obj_id] for obj_id, dist in zip(ids, dists) if dist <= r]
+
+    def overlapping(self, bbox):
+        """Names of the objects whose footprint intersects `bbox`, given as
+        [x_min, y_min, x_max, y_max]."""
+        return [self._names[obj_id] for obj_id in sorted(self._index.intersection(tuple(bbox)))]
+
+    def nearest(self, point, k=1):
+        """Names of the `k` objects whose footprints are closest to `point`."""
+        x, y = point[0], point[1]
+        ids, dists = self._exact(self._index.nearest((x, y, x, y), k), point)
+        order = sorted(range(len(ids)), key=lambda i: (dists[i], ids[i]))[:k]
+        return [self._names[ids[i]] for i in order]
@@ -0,0 +1,89 @@
+"""Content-addressed, per-process cache of the URDF files filled from templates."""
+
+import atexit
+import collections
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+
+class TemplateCache:
+    """Files holding the filled text of asset templates, named by a hash of the template
+    path and that text.
+
+    Filling the same template with the same values gives the same file, which is written
+    once (atomically, so concurrent writers never expose a partial file) and then reused;
+    PyBullet's file caching can reuse the parsed geometry of such repeated paths. At most
+    `max_files` files are kept: the least recently used ones are removed, which is safe
+    once PyBullet has loaded them. The directory is per process and removed at exit.
+    """
+
+    def __init__(self, max_files=1024, root=None):
+        self.max_files = max_files
+        self.root = root
+        self.n_written = 0
+        self.n_reused = 0
+        self._files = collections.OrderedDict()  # digest -> path, least recently used first
+        self._templates = {}  # template path -> ((mtime, size), text)
+        self._lock = threading.Lock()
+        self._dir = None
+        self._pid = None
+
+    @property
+    def directory(self):
+        if self._pid != os.getpid():  # first use, or a forked worker
+            self._dir = tempfile.mkdtemp(prefix=f'cliport-urdf-{os.getpid()}-', dir=self.root)
+            self._pid = os.getpid()
+            self._files.clear()
+            atexit.register(shutil.rmtree, self._dir, ignore_errors=True)
+        return self._dir
+
+    def read(self, template_path):
+        """The text of a template file, re-read only when the file has changed."""
+        stat = os.stat(template_path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        cached = self._templates.get(template_path)
+        if cached is None or cached[0] != version:
+            with open(template_path, 'r') as file:
+                cached = self._templates[template_path] = (version, file.read())
+        return cached[1]
+
+    def write(self, template_path, text):
+        """Path of a file holding `text`, filled from the template at `template_path`."""
+        digest = hashlib.sha1(f'{template_path}\0{text}'.encode()).hexdigest()[:20]
+        with self._lock:
+            directory = self.directory
+            path = self._files.get(digest)
+            if path is not None and os.path.exists(path):
+                self._files.move_to_end(digest)
+                self.n_reused += 1
+                return path
+
+            path = os.path.join(directory, f'{os.path.basename(template_path)}.{digest}')
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+            with os.fdopen(fd, 'w') as file:
+                file.write(text)
+            os.replace(tmp_path, path)
+            self._files[digest] = path
+            self.n_written += 1
+            while len(self._files) > self.max_files:
+                _, old_path = self._files.popitem(last=False)
+                try:
+                    os.remove(old_path)
+                except FileNotFoundError:
+                    pass
+        return path
+
+    def clear(self):
+        with self._lock:
+            for path in self._files.values():
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self._files.clear()
+
+
+cache = TemplateCache()
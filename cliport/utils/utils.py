@@ -1,8 +1,9 @@
 """Miscellaneous utilities."""
 
+import math
 import os
 import random
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 
 import cv2
 import kornia
@@ -16,6 +17,7 @@ import pybullet as p
 import torch
 import yaml
 from omegaconf import OmegaConf
+from scipy import ndimage
 from transforms3d import euler
 
 
@@ -199,6 +201,74 @@ def unproject_depth_vectorized(im_depth, depth_dist,
                                 camera_mtx, camera_dist)
 
 
+MaskStats = namedtuple('MaskStats', ['labels', 'eroded', 'counts', 'eroded_counts', 'bboxes'])
+
+
+def label_objects(mask, obj_ids):
+    """Relabel a segmentation mask in one pass: pixels of the i-th of the distinct,
+    non-negative `obj_ids` become i + 1, all others 0.
+
+    Returns:
+      labels: HxW uint16 array.
+    """
+    obj_ids = np.asarray(obj_ids, dtype=np.int64).reshape(-1)
+    top = int(obj_ids.max()) if len(obj_ids) else 0
+    # shifted by one so that -1 (no body) and ids above `top` map to 0
+    lookup = np.zeros(top + 3, dtype=np.uint16)
+    lookup[obj_ids + 1] = np.arange(1, len(obj_ids) + 1)
+    return lookup.take(np.add(mask, 1), mode='clip')
+
+
+def object_mask_stats(mask, obj_ids, erode_size=3, bboxes=True):
+    """Per-object pixel counts, bounding boxes and visibility after erosion, for all
+    `obj_ids` at once instead of one `mask == obj_id` comparison and erosion per object.
+
+    A pixel survives the erosion of its object's mask iff its whole neighbourhood has
+    the same label, so one erosion and one dilation of the label image erode the masks
+    of all objects.
+
+    Args:
+      mask: HxW segmentation mask of body ids.
+      obj_ids: distinct, non-negative body ids.
+      erode_size: size of the square erosion kernel.
+      bboxes: whether to compute the bounding boxes.
+
+    Returns:
+      MaskStats of `labels` (see `label_objects`), `eroded` labels, the pixel `counts`
+      and `eroded_counts` of each object, and its `bboxes` as [u_min, v_min, u_max,
+      v_max] rows, -1 if the object is not in the mask (None unless `bboxes`).
+    """
+    labels = label_objects(mask, obj_ids)
+    n = len(np.asarray(obj_ids).reshape(-1))
+    kernel = np.ones((erode_size, erode_size), np.uint8)
+    interior = (cv2.erode(labels, kernel) == labels) & (cv2.dilate(labels, kernel) == labels)
+    eroded = labels * interior
+    boxes = None
+    if bboxes:
+        boxes = np.full((n, 4), -1)
+        for i, box in enumerate(ndimage.find_objects(labels, max_label=n)):
+            if box is not None:
+                boxes[i] = box[0].start, box[1].start, box[0].stop - 1, box[1].stop - 1
+    return MaskStats(labels, eroded, np.bincount(labels.ravel(), minlength=n + 1)[1:],
+                     np.bincount(eroded.ravel(), minlength=n + 1)[1:], boxes)
+
+
+def first_visible(mask, obj_ids, erode_size=3):
+    """Index of the first of `obj_ids` whose mask is not empty once eroded, and that
+    eroded uint8 mask; the last index and an empty mask if there is none.
+
+    The first object, usually visible, is checked on its own with one comparison and
+    erosion. Only if it is hidden are the others checked in one `object_mask_stats` pass.
+    """
+    eroded = cv2.erode(np.uint8(mask == obj_ids[0]), np.ones((erode_size, erode_size), np.uint8))
+    if np.sum(eroded) > 0 or len(obj_ids) == 1:
+        return 0, eroded
+    stats = object_mask_stats(mask, obj_ids[1:], erode_size, bboxes=False)
+    visible = np.flatnonzero(stats.eroded_counts)
+    k = visible[0] if len(visible) else len(obj_ids) - 2
+    return k + 1, np.uint8(stats.eroded == k + 1)
+
+
 # -----------------------------------------------------------------------------
 # MATH UTILS
 # -----------------------------------------------------------------------------
@@ -274,6 +344,34 @@ def quatXYZW_to_eulerXYZ(quaternion_xyzw):  # pylint: disable=invalid-name
     return euler_xyz
 
 
+def quatXYZW_to_eulerZ(quaternions_xyzw):  # pylint: disable=invalid-name
+    """Batched `quatXYZW_to_eulerXYZ(q)[2]`, the rotation around the z-axis.
+
+    Follows transforms3d's quat2mat and mat2euler for the 'szxy' axes, including their
+    handling of degenerate quaternions and gimbal lock.
+
+    Args:
+      quaternions_xyzw: Nx4 array of quaternions in xyzw order.
+
+    Returns:
+      rotation: N float64 array.
+    """
+    x, y, z, w = np.asarray(quaternions_xyzw, dtype=np.float64).reshape(-1, 4).T
+    nq = w * w + x * x + y * y + z * z
+    with np.errstate(divide='ignore'):
+        s = np.where(nq < np.finfo(np.float64).eps, 0., 2.0 / nq)  # 0 gives the identity
+    X, Y, Z = x * s, y * s, z * s
+    m00 = 1.0 - (y * Y + z * Z)
+    m01, m10 = x * Y - w * Z, x * Y + w * Z
+    m11 = 1.0 - (x * X + z * Z)
+    m02, m22 = x * Z + w * Y, 1.0 - (x * X + y * Y)
+    cy = np.sqrt(m22 * m22 + m02 * m02)
+    gimbal_lock = cy <= np.finfo(np.float64).eps * 4
+    # math.atan2 rather than np.arctan2, whose results can differ in the last bit
+    return np.fromiter(map(math.atan2, np.where(gimbal_lock, -m01, m10),
+                           np.where(gimbal_lock, m00, m11)), dtype=np.float64, count=len(x))
+
+
 def apply_transform(transform_to_from, points_from):
     r"""Transforms points (3D) into new frame.
   
@@ -0,0 +1,95 @@
+"""Cooperative budget for executing generated code."""
+
+import contextlib
+import functools
+import threading
+import time
+
+
+class BudgetExceeded(BaseException):
+    """Generated code ran out of the budget of `watchdog`.
+
+    Like `KeyboardInterrupt`, it is not an `Exception`, so the `except Exception:` blocks
+    that generated code often wraps its calls in do not swallow it. A bare `except:`
+    still does, but the next tick raises again.
+    """
+
+    def __init__(self, message, watchdog):
+        super().__init__(message)
+        self.watchdog = watchdog
+
+
+_local = threading.local()
+
+
+def _active():
+    """Watchdogs whose turn is running in this thread, outermost first. Work done in
+    other threads, e.g. by a thread pool, is not charged to them."""
+    if not hasattr(_local, 'active'):
+        _local.active = []
+    return _local.active
+
+
+def tick(actions=0, sim_steps=0, calls=0):
+    """Charge the work to every watchdog running in this thread and raise `BudgetExceeded` if one of
+    them is exhausted. LMP_wrapper calls this for its API calls, actions and simulation
+    steps, and `exec_safe` at every loop iteration of generated code."""
+    for watchdog in _active():
+        watchdog.charge(actions, sim_steps, calls)
+
+
+def counted(fn):
+    """Wrap `fn` to charge one API call per call to the running watchdogs."""
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        tick(calls=1)
+        return fn(*args, **kwargs)
+
+    return wrapper
+
+
+class Watchdog:
+    """Per-turn budget of generated code, None for unlimited.
+
+    It is cooperative: the budget is only checked in `tick`, so a turn can overrun its
+    wall time by as long as the slowest single action or API call takes.
+
+    Args:
+      max_actions: pick-and-place actions.
+      max_sim_steps: physics steps run by LMP_wrapper outside of actions.
+      max_calls: LMP_wrapper API calls.
+      max_seconds: wall time of the turn.
+    """
+
+    def __init__(self, max_actions=None, max_sim_steps=None, max_calls=None,
+                 max_seconds=None):
+        self.limits = {'actions': max_actions, 'sim_steps': max_sim_steps, 'calls': max_calls}
+        self.max_seconds = max_seconds
+        self.used = dict.fromkeys(self.limits, 0)
+        self._deadline = None
+
+    @contextlib.contextmanager
+    def turn(self):
+        """Run a turn with a fresh budget. A turn nested in a running one of the same
+        watchdog, e.g. an LMP called by generated code, shares its budget."""
+        active = _active()
+        if self in active:
+            yield self
+            return
+        self.used = dict.fromkeys(self.limits, 0)
+        self._deadline = None if self.max_seconds is None else time.monotonic() + self.max_seconds
+        active.append(self)
+        try:
+            yield self
+        finally:
+            active.remove(self)
+
+    def charge(self, actions=0, sim_steps=0, calls=0):
+        for key, n in (('actions', actions), ('sim_steps', sim_steps), ('calls', calls)):
+            self.used[key] += n
+            if self.limits[key] is not None and self.used[key] > self.limits[key]:
+                raise BudgetExceeded(f'more than {self.limits[key]} {key.replace("_", " ")}',
+                                     self)
+        if self._deadline is not None and time.monotonic() > self._deadline:
+            raise BudgetExceeded(f'more than {self.max_seconds} s', self)
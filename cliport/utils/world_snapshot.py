@@ -0,0 +1,50 @@
+"""Per-step cache of the object state queried by the LMP APIs."""
+
+import numpy as np
+
+
+def _copy(value):
+    """Copy of nested lists, tuples and arrays, so callers can't alter the snapshot."""
+    if isinstance(value, np.ndarray):
+        return value.copy()
+    if isinstance(value, list):
+        return [_copy(item) for item in value]
+    if isinstance(value, tuple):
+        return tuple(_copy(item) for item in value)
+    return value
+
+
+class WorldSnapshot:
+    """Object poses and bounding boxes of `env` at simulation step `step`.
+
+    Every query goes to the environment (and thus PyBullet) the first time it is made
+    and is answered from the snapshot afterwards, until the owner replaces the snapshot
+    after the next step. Queries with unhashable arguments are not cached.
+    """
+
+    def __init__(self, env, step):
+        self.env = env
+        self.step = step
+        self.n_queries = 0  # queries that went to the environment
+        self._cache = {}
+
+    def _query(self, method, *args):
+        key = (method, *args)
+        try:
+            value = self._cache[key]
+        except KeyError:
+            value = self._cache[key] = getattr(self.env, method)(*args)
+            self.n_queries += 1
+        except TypeError:
+            self.n_queries += 1
+            return getattr(self.env, method)(*args)
+        return _copy(value)
+
+    def get_obj_pos(self, obj_name, count=1):
+        return self._query('get_obj_pos', obj_name, count)
+
+    def get_obj_rot(self, obj_name, count=1):
+        return self._query('get_obj_rot', obj_name, count)
+
+    def get_bounding_box(self, obj_name):
+        return self._query('get_bounding_box', obj_name)
@@ -0,0 +1,85 @@
+"""Wall-clock time for stacking blocks with and without the action queue.
+
+The environment is a stand-in whose calls cost what they roughly cost in the PyBullet
+scene: a pick-and-place motion with the observation rendered after it, and a pose query
+that looks the object up by name and reads it from the simulator.
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from cliport import dahlia_run
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--blocks", type=int, default=6)
+parser.add_argument("--step_s", type=float, default=0.5, help="motion and observation")
+parser.add_argument("--query_s", type=float, default=0.005, help="pose query")
+parser.add_argument("--repeats", type=int, default=3)
+args = parser.parse_args()
+
+BLOCKS = [f'block {i}' for i in range(args.blocks)]
+
+
+class TimedStackEnv:
+
+    def __init__(self):
+        self.object_list = list(BLOCKS)
+        self.positions = {name: np.array([0.3 + 0.05 * i, 0.1 * (-1) ** i, 0.02])
+                          for i, name in enumerate(BLOCKS)}
+
+    def _top_at(self, xy, exclude=None):
+        under = [name for name, pos in self.positions.items()
+                 if name != exclude and np.linalg.norm(pos[:2] - xy) < 0.015]
+        return max(under, key=lambda name: self.positions[name][2]) if under else None
+
+    def get_obj_pos(self, obj_name, count=1):
+        time.sleep(args.query_s)
+        return [self.positions[obj_name].copy()]
+
+    def get_obj_rot(self, obj_name, count=1):
+        time.sleep(args.query_s)
+        return [np.array([0., 0., 0., 1.])]
+
+    def get_bounding_box(self, obj_name):
+        time.sleep(args.query_s)
+        return (*self.positions[obj_name] - 0.02, *self.positions[obj_name] + 0.02)
+
+    def step(self, action):
+        time.sleep(args.step_s)
+        picked = self._top_at(np.asarray(action['pose0'][0][:2]))
+        place_xy = np.asarray(action['pose1'][0][:2], dtype=float)
+        support = self._top_at(place_xy, exclude=picked)
+        z = self.positions[support][2] + 0.04 if support else 0.02
+        self.positions[picked] = np.array([*place_xy, z])
+
+
+def make_wrapper():
+    env = TimedStackEnv()
+    cfg = {'env': {'init_objs': env.object_list, 'coords': dahlia_run.lmp_tabletop_coords}}
+    return dahlia_run.LMP_wrapper(env, cfg)
+
+
+def one_by_one(lmp_env):
+    for i in range(len(BLOCKS) - 1):
+        lmp_env.put_first_on_second(BLOCKS[i + 1], BLOCKS[i])
+
+
+def queued(lmp_env):
+    lmp_env.stack_objects_in_order(BLOCKS)
+
+
+for name, stack in [('one by one', one_by_one), ('queue', queued)]:
+    times = []
+    for _ in range(args.repeats):
+        lmp_env = make_wrapper()
+        start = time.perf_counter()
+        stack(lmp_env)
+        times.append(time.perf_counter() - start)
+    print(f'{name:>10}: {np.median(times):.3f} s for {args.blocks} blocks')
+    if lmp_env.action_timings:
+        for record in lmp_env.action_timings:
+            print(f'{"":>12}{record["pick"]} on {record["place"]}: resolve '
+                  f'{1e3 * record["resolve"]:.1f} ms, step {record["step"]:.3f} s, '
+                  f'settle {1e3 * record["settle"]:.1f} ms')
@@ -0,0 +1,103 @@
+"""Latency to a plan that executes cleanly: one completion at a time, re-asked after each
+failure, versus N candidates sampled in parallel with dry-run selection.
+
+`FakeBackend` answers after `--latency` seconds (plus a slow tail) with a plan that fails
+with probability `--fail_rate`; actions and rollbacks are free.
+"""
+
+import argparse
+import random
+import threading
+import time
+
+import numpy as np
+
+from cliport import dahlia_run
+from cliport.utils.llm_backends import FakeBackend
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--calls", type=int, default=20, help="planner calls per setting")
+parser.add_argument("--candidates", type=str, default="2,4,8")
+parser.add_argument("--latency", type=float, default=0.5)
+parser.add_argument("--tail_latency", type=float, default=1.0)
+parser.add_argument("--tail_prob", type=float, default=0.1)
+parser.add_argument("--fail_rate", type=float, default=0.3)
+args = parser.parse_args()
+
+GOOD = 'move("block", 0.3)'
+BAD = 'move("block", 0.1)\nassert False, "plan failed"'
+
+
+class Scene:
+
+    def __init__(self):
+        self.positions = {'block': 0.5}
+
+    def move(self, name, pos):
+        self.positions[name] = pos
+
+    def snapshot(self):
+        return dict(self.positions)
+
+    def restore(self, snap):
+        self.positions = dict(snap)
+
+    def discard(self, snap):
+        pass
+
+    def check_scene(self):
+        return True
+
+
+rng = random.Random(0)
+lock = threading.Lock()
+
+
+def respond(messages):
+    with lock:
+        return BAD if rng.random() < args.fail_rate else GOOD
+
+
+def make_lmp(n_candidates):
+    cfg = {
+        'prompt_text': '# move the block.\nmove("block", 0.2)',
+        'engine': lambda: 'fake-model',
+        'max_tokens': lambda: 256,
+        'temperature': 0,
+        'query_prefix': '# ',
+        'query_suffix': '.',
+        'stop': ['#'],
+        'maintain_session': False,
+        'debug_mode': False,
+        'include_context': True,
+        'has_return': False,
+        'n_candidates': n_candidates,
+        'candidate_temperature': 0.7,
+        'candidate_max_steps': 20,
+        'candidate_timeout': 60.,
+    }
+    backend = FakeBackend(respond=respond, latency=args.latency, tail_latency=args.tail_latency,
+                          tail_prob=args.tail_prob, seed=0)
+    scene = Scene()
+    variable_vars = {'move': scene.move}
+    lmp_fgen = dahlia_run.LMPFGen((dict(cfg, stop=['# define']), 'fake'), {}, variable_vars,
+                                  backend=backend)
+    return dahlia_run.LMP('tabletop_ui', (cfg, 'fake'), lmp_fgen, {}, variable_vars,
+                          backend=backend, sandbox=scene)
+
+
+def time_to_success(lmp):
+    start = time.perf_counter()
+    while True:
+        try:
+            lmp('move the block', context='')
+            return time.perf_counter() - start
+        except AssertionError:
+            pass  # ask again, as a re-plan after a failed execution would
+
+
+for n in [1] + [int(n) for n in args.candidates.split(',')]:
+    lmp = make_lmp(n)
+    times = [time_to_success(lmp) for _ in range(args.calls)]
+    print(f'{"single sample" if n == 1 else f"{n} candidates":>14}: '
+          f'mean {np.mean(times):.2f} s, p90 {np.percentile(times, 90):.2f} s')
@@ -0,0 +1,52 @@
+"""Oracle demos/minute of the `cliport/demos.py` rollout, rendering the oracle images on
+every `Task.get_true_image` call (previous behaviour) versus once per scene state.
+"""
+
+import argparse
+import random
+import time
+
+import numpy as np
+
+from cliport import tasks
+from cliport.environments.environment import Environment
+from cliport.tasks.task import Task
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--assets_root", type=str, default="cliport/environments/assets/")
+parser.add_argument("--tasks", type=str,
+                    default="palletizing-boxes,stack-block-pyramid,place-red-in-green")
+parser.add_argument("--demos", type=int, default=10, help="demos per task")
+args = parser.parse_args()
+
+
+def uncached_get_true_image(self, env):
+    return self._render_true_image(env)
+
+
+def demos_per_minute(env, task_name):
+    task = tasks.names[task_name]()
+    task.mode = 'train'
+    agent = task.oracle(env)
+    start = time.perf_counter()
+    for seed in range(0, 2 * args.demos, 2):
+        np.random.seed(seed)
+        random.seed(seed)
+        env.set_task(task)
+        obs = env.reset()
+        info = env.info
+        for _ in range(task.max_steps):
+            obs, _, done, info = env.step(agent.act(obs, info))
+            if done:
+                break
+    return args.demos / (time.perf_counter() - start) * 60
+
+
+env = Environment(args.assets_root, disp=False, hz=480)
+cached_get_true_image = Task.get_true_image
+for task_name in args.tasks.split(','):
+    Task.get_true_image = uncached_get_true_image
+    old = demos_per_minute(env, task_name)
+    Task.get_true_image = cached_get_true_image
+    new = demos_per_minute(env, task_name)
+    print(f'{task_name}: {old:.1f} -> {new:.1f} demos/min ({new / old:.2f}x)')
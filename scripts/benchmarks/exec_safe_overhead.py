@@ -0,0 +1,73 @@
+"""Per-call overhead of exec_safe on small generated snippets.
+
+Compares the previous implementation (merged copy of the globals, `exec` from source text
+and `eval`-based `var_exists`) with the compiled-code cache, layered globals and
+dict-lookup `var_exists`, using namespaces the size of the DAHLIA LMP APIs.
+"""
+
+import argparse
+import random
+import re
+import time
+
+import numpy as np
+import shapely
+
+from cliport import dahlia_run
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--snippets", type=int, default=10000)
+parser.add_argument("--distinct", type=int, default=200, help="distinct snippet sources")
+args = parser.parse_args()
+
+
+def old_exec_safe(code_str, gvars=None, lvars=None):
+    if 'import' in code_str:
+        import_pattern = re.compile(r'^\s*(import .*|from .* import .*)$', re.MULTILINE)
+        code_str = import_pattern.sub('', code_str).strip()
+    assert '__' not in code_str
+    empty_fn = lambda *args, **kwargs: None
+    custom_gvars = dahlia_run.merge_dicts([gvars, {'exec': empty_fn, 'eval': empty_fn}])
+    exec(code_str, custom_gvars, lvars)
+
+
+def old_var_exists(name, all_vars):
+    try:
+        eval(name, all_vars)
+    except:
+        return False
+    return True
+
+
+fixed_vars = {'np': np}
+fixed_vars.update({name: getattr(shapely.geometry, name) for name in shapely.geometry.__all__})
+fixed_vars.update({name: getattr(shapely.affinity, name) for name in shapely.affinity.__all__})
+variable_vars = {f'api_{i}': (lambda *a: 0.5) for i in range(60)}
+variable_vars.update({f'generated_{i}': (lambda *a: 1.0) for i in range(200)})
+
+rng = random.Random(0)
+sources = [f'pos_{i} = api_{rng.randrange(60)}("block {i}")\n'
+           f'target = np.array([pos_{i}, generated_{rng.randrange(200)}()]) + {i}'
+           for i in range(args.distinct)]
+snippets = [rng.choice(sources) for _ in range(args.snippets)]
+
+
+def run(exec_fn, var_exists_fn, layered):
+    start = time.perf_counter()
+    for code_str in snippets:
+        if layered:
+            gvars = dahlia_run.LayeredVars([fixed_vars, variable_vars])
+        else:
+            gvars = dahlia_run.merge_dicts([fixed_vars, variable_vars])
+        var_exists_fn('api_7', gvars)
+        var_exists_fn('undefined_fn', gvars)
+        exec_fn(code_str, gvars, {})
+    return (time.perf_counter() - start) / len(snippets)
+
+
+old = run(old_exec_safe, old_var_exists, layered=False)
+new = run(dahlia_run.exec_safe, dahlia_run.var_exists, layered=True)
+print(f'{len(snippets)} snippets ({args.distinct} distinct), '
+      f'{len(fixed_vars) + len(variable_vars)} names in scope')
+print(f'old: {1e6 * old:.1f} us/call')
+print(f'new: {1e6 * new:.1f} us/call ({old / new:.1f}x)')
@@ -0,0 +1,75 @@
+"""LMP_wrapper.get_random_free_pos: occupancy raster versus point-by-point search.
+
+The old implementation calls `is_target_occupied` for every grid point, which checks the
+bounding box of every object. Objects are random boxes served by a stand-in environment,
+so only the search itself is timed.
+"""
+
+import argparse
+import random
+import time
+
+import numpy as np
+
+from cliport import dahlia_run
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--objects", type=str, default="10,50")
+parser.add_argument("--grid_size", type=float, default=0.004,
+                    help="LMP default is 0.002, where the old search takes minutes")
+parser.add_argument("--r", type=float, default=0.02)
+parser.add_argument("--n", type=int, default=5, help="queries per implementation")
+args = parser.parse_args()
+
+
+class BoxEnv:
+
+    def __init__(self, boxes):
+        self.boxes = boxes
+        self.object_list = list(boxes)
+
+    def get_bounding_box(self, obj_name):
+        return self.boxes[obj_name]
+
+
+def old_get_random_free_pos(lmp_env, r, grid_size):
+    x_min, y_min = lmp_env._cfg['env']['coords']['top_left']
+    x_max, y_max = lmp_env._cfg['env']['coords']['bottom_right']
+    x_coords = np.arange(x_min, x_max, grid_size)
+    y_coords = np.arange(y_min, y_max, grid_size)
+    potential_positions = [(x, y, 0.001) for x in x_coords for y in y_coords]
+    free_positions = [pos for pos in potential_positions
+                      if not lmp_env.is_target_occupied(pos, r)]
+    if not free_positions:
+        return None
+    return [list(random.choice(free_positions)), [0, 0, 0, 1]]
+
+
+rng = np.random.default_rng(0)
+for n_objects in [int(n) for n in args.objects.split(',')]:
+    boxes = {}
+    for i in range(n_objects):
+        center = rng.uniform((0.25, -0.5), (0.75, 0.5))
+        size = rng.uniform(0.02, 0.08, size=2)
+        boxes[f'block {i}'] = (*(center - size / 2), 0., *(center + size / 2), 0.04)
+    cfg = {'env': {'init_objs': list(boxes), 'coords': dahlia_run.lmp_tabletop_coords}}
+    lmp_env = dahlia_run.LMP_wrapper(BoxEnv(boxes), cfg)
+
+    random.seed(0)
+    start = time.perf_counter()
+    old = [old_get_random_free_pos(lmp_env, args.r, args.grid_size) for _ in range(args.n)]
+    old_time = (time.perf_counter() - start) / args.n
+
+    random.seed(0)
+    start = time.perf_counter()
+    lmp_env._free_space = None
+    first = lmp_env.get_random_free_pos(r=args.r, grid_size=args.grid_size)
+    first_time = time.perf_counter() - start
+    start = time.perf_counter()
+    new = [first] + [lmp_env.get_random_free_pos(r=args.r, grid_size=args.grid_size)
+                     for _ in range(args.n - 1)]
+    new_time = (time.perf_counter() - start) / max(args.n - 1, 1)
+
+    print(f'{n_objects} objects, grid {args.grid_size}: old {1e3 * old_time:.1f} ms, '
+          f'new {1e3 * first_time:.2f} ms first / {1e3 * new_time:.2f} ms cached '
+          f'({old_time / first_time:.0f}x), same samples: {old == new}')
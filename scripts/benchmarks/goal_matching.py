@@ -0,0 +1,183 @@
+"""Goal matching in Task.reward and Task.oracle: pose by pose with `is_match` (previous
+implementation) versus batched with `match_poses`.
+
+Timing uses a goal of `--objects` blocks in PyBullet DIRECT, each with every block's
+target allowed. With `--parity`, it also replays the oracle demos of every registered
+task for `--seeds` with both matching kernels and checks that all rewards are identical;
+this needs the full Environment.
+"""
+
+import argparse
+import time
+
+import numpy as np
+import pybullet as p
+
+from cliport import tasks
+from cliport.tasks.task import Task
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--objects", type=int, default=20)
+parser.add_argument("--repeats", type=int, default=200)
+parser.add_argument("--parity", action="store_true")
+parser.add_argument("--seeds", type=str, default="1,3,5")
+parser.add_argument("--assets_root", type=str, default="cliport/environments/assets/")
+args = parser.parse_args()
+
+
+def pairwise_match_poses(self, poses0, poses1, symmetries, consider_z=False):
+    return np.array([[self.is_match(pose0, pose1, symmetry, consider_z=consider_z)
+                      for pose1 in poses1]
+                     for pose0, symmetry in zip(poses0, symmetries)]).reshape(len(poses0), -1)
+
+
+def old_reward(task, objs, matches, targs, max_reward):
+    step_reward = 0
+    for i in range(len(objs)):
+        object_id, (symmetry, _) = objs[i]
+        pose = p.getBasePositionAndOrientation(object_id)
+        targets_i = np.argwhere(matches[i, :]).reshape(-1)
+        for j in targets_i:
+            if task.is_match(pose, targs[j], symmetry, consider_z=task.consider_z_in_match):
+                step_reward += max_reward / len(objs)
+                break
+    return step_reward
+
+
+def old_oracle_matching(task, objs, matches, targs):
+    matches = matches.copy()
+    for i in range(len(objs)):
+        object_id, (symmetry, _) = objs[i]
+        pose = p.getBasePositionAndOrientation(object_id)
+        targets_i = np.argwhere(matches[i, :]).reshape(-1)
+        for j in targets_i:
+            if task.is_match(pose, targs[j], symmetry, consider_z=task.consider_z_in_match):
+                matches[i, :] = 0
+                matches[:, j] = 0
+    nn_dists, nn_targets = [], []
+    for i in range(len(objs)):
+        xyz, _ = p.getBasePositionAndOrientation(objs[i][0])
+        targets_i = np.argwhere(matches[i, :]).reshape(-1)
+        if len(targets_i) > 0:
+            targets_xyz = np.float32([targs[j][0] for j in targets_i])
+            dists = np.linalg.norm(targets_xyz - np.float32(xyz).reshape(1, 3), axis=1)
+            nn = np.argmin(dists)
+            nn_dists.append(dists[nn])
+            nn_targets.append(targets_i[nn])
+        else:
+            nn_dists.append(0)
+            nn_targets.append(-1)
+    return nn_dists, nn_targets
+
+
+def new_oracle_matching(task, objs, matches, targs):
+    # the matching part of `Task.oracle`
+    poses = [p.getBasePositionAndOrientation(object_id) for object_id, _ in objs]
+    matches = matches.copy()
+    is_match = task.match_poses(poses, targs, [sym for _, (sym, _) in objs],
+                                consider_z=task.consider_z_in_match)
+    for i in range(len(objs)):
+        targets_i = np.argwhere(matches[i, :]).reshape(-1)
+        matched = targets_i[is_match[i, targets_i]]
+        if len(matched) > 0:
+            matches[i, :] = 0
+            matches[:, matched] = 0
+    obj_xyz, _ = task._pose_arrays(poses)
+    targets_xyz, _ = task._pose_arrays(targs)
+    dists = np.linalg.norm(targets_xyz[None] - obj_xyz[:, None], axis=-1)
+    dists[~task._allowed(matches, dists.shape)] = np.inf
+    nn_dists, nn_targets = [], []
+    for i in range(len(objs)):
+        if np.isfinite(dists[i]).any():
+            nn = np.argmin(dists[i])
+            nn_dists.append(dists[i, nn])
+            nn_targets.append(nn)
+        else:
+            nn_dists.append(0)
+            nn_targets.append(-1)
+    return nn_dists, nn_targets
+
+
+def per_call(fn):
+    start = time.perf_counter()
+    for _ in range(args.repeats):
+        result = fn()
+    return (time.perf_counter() - start) / args.repeats, result
+
+
+def timing():
+    p.connect(p.DIRECT)
+    rng = np.random.RandomState(0)
+    shape = p.createCollisionShape(p.GEOM_BOX, halfExtents=[0.02] * 3)
+    objs, targs = [], []
+    for i in range(args.objects):
+        pos = [rng.uniform(0.3, 0.7), rng.uniform(-0.4, 0.4), 0.02]
+        objs.append((p.createMultiBody(0.1, shape, basePosition=pos), (np.pi / 2, None)))
+        targ = pos if i % 2 else [rng.uniform(0.3, 0.7), rng.uniform(-0.4, 0.4), 0.02]
+        targs.append((tuple(targ), (0, 0, 0, 1)))
+    matches = np.ones((args.objects, args.objects))
+    task = Task()
+
+    old_t, old = per_call(lambda: old_reward(task, objs, matches, targs, 1))
+    task.goals = [(objs, matches, targs, False, True, 'pose', None, 1)]
+
+    def new_reward():
+        task._rewards, task.progress = 0, 0
+        return task.reward()[0]
+
+    new_t, new = per_call(new_reward)
+    assert old == new
+    print(f'{args.objects}-object goal, {args.objects} targets each')
+    print(f'reward:          {1e3 * old_t:.2f} -> {1e3 * new_t:.2f} ms/call '
+          f'({old_t / new_t:.1f}x)')
+    old_t, old = per_call(lambda: old_oracle_matching(task, objs, matches, targs))
+    new_t, new = per_call(lambda: new_oracle_matching(task, objs, matches, targs))
+    assert old == new
+    print(f'oracle matching: {1e3 * old_t:.2f} -> {1e3 * new_t:.2f} ms/call '
+          f'({old_t / new_t:.1f}x)')
+    p.disconnect()
+
+
+def demo_rewards(env, task_name, seeds):
+    rewards = []
+    for seed in seeds:
+        task = tasks.names[task_name]()
+        task.mode = 'test'
+        env.seed(seed)
+        np.random.seed(seed)
+        env.set_task(task)
+        obs, info = env.reset(), None
+        agent = task.oracle(env)
+        for _ in range(task.max_steps):
+            obs, reward, done, info = env.step(agent.act(obs, info))
+            rewards.append(reward)
+            if done:
+                break
+    return rewards
+
+
+def parity():
+    from cliport.environments.environment import Environment
+    env = Environment(args.assets_root, disp=False, hz=480)
+    seeds = [int(seed) for seed in args.seeds.split(',')]
+    batched = Task.match_poses
+    mismatches = []
+    for task_name in sorted(tasks.names):
+        try:
+            Task.match_poses = pairwise_match_poses
+            old = demo_rewards(env, task_name, seeds)
+            Task.match_poses = batched
+            new = demo_rewards(env, task_name, seeds)
+        except Exception as e:  # tasks whose demos fail are reported, not compared
+            print(f'  {task_name}: demo failed ({e!r})')
+            continue
+        if old != new:
+            mismatches.append(task_name)
+    Task.match_poses = batched
+    print(f'reward parity on {len(tasks.names) - len(mismatches)}/{len(tasks.names)} tasks'
+          f'{": " + ", ".join(mismatches) if mismatches else ""}')
+
+
+timing()
+if args.parity:
+    parity()
@@ -0,0 +1,44 @@
+"""LMP stack startup cost per episode: `setup_LMP` every episode versus one `LMPSession`
+that is reset between episodes.
+
+Only construction is timed, so the environment is a stand-in that provides the object
+list the env wrapper reads.
+"""
+
+import argparse
+import time
+
+from cliport import dahlia_run
+from cliport.utils.llm_backends import FakeBackend
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--episodes", type=int, default=100)
+args = parser.parse_args()
+
+
+class StandInEnv:
+
+    def __init__(self, seed):
+        self.object_list = [f'block {seed}', f'bowl {seed}', 'zone']
+
+
+backend = FakeBackend()
+envs = [StandInEnv(seed) for seed in range(args.episodes)]
+
+start = time.perf_counter()
+for env in envs:
+    dahlia_run.setup_LMP(env, dahlia_run.cfg_tabletop, 'fake', backend=backend)
+per_episode = (time.perf_counter() - start) / args.episodes
+
+start = time.perf_counter()
+session = dahlia_run.LMPSession(dahlia_run.cfg_tabletop, 'fake', backend=backend)
+construction = time.perf_counter() - start
+start = time.perf_counter()
+for env in envs:
+    session.reset(env)
+reset = (time.perf_counter() - start) / args.episodes
+
+print(f'setup_LMP per episode: {1e3 * per_episode:.2f} ms')
+print(f'LMPSession: {1e3 * construction:.2f} ms once, {1e3 * reset:.3f} ms per reset, '
+      f'{1e3 * (construction / args.episodes + reset):.3f} ms per episode '
+      f'over {args.episodes} episodes')
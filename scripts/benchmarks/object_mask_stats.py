@@ -0,0 +1,84 @@
+"""Per-object masking of an oracle segmentation image with a `mask == obj_id` comparison
+(and erosion) per object, versus `utils.object_mask_stats` / `utils.label_objects` in
+one pass, on a 320x160 heightmap-sized scene of `--objects` objects.
+
+- free space: mask out every object, as `get_random_pose` did.
+- oracle pick: erode the mask of each candidate in order until one is visible, versus
+  `utils.first_visible`; the first `--hidden` candidates are occluded.
+- all stats: pixel count, eroded pixel count and bounding box of every object.
+"""
+
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from cliport.utils import utils
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--objects", type=int, default=40)
+parser.add_argument("--hidden", type=int, default=10, help="occluded candidates first")
+parser.add_argument("--repeats", type=int, default=200)
+args = parser.parse_args()
+
+rng = np.random.RandomState(0)
+mask = np.zeros((320, 160), dtype=np.int32)
+obj_ids = list(range(5, 5 + args.objects))
+for obj_id in obj_ids[args.hidden:]:
+    u, v = rng.randint(0, 300), rng.randint(0, 140)
+    mask[u:u + rng.randint(8, 20), v:v + rng.randint(8, 20)] = obj_id
+for obj_id in obj_ids[:args.hidden]:  # slivers that erode away
+    mask[rng.randint(0, 320), rng.randint(0, 140):][:10] = obj_id
+
+
+def old_free():
+    free = np.ones(mask.shape, dtype=np.uint8)
+    for obj_id in obj_ids:
+        free[mask == obj_id] = 0
+    return free
+
+
+def new_free():
+    return np.uint8(utils.label_objects(mask, obj_ids) == 0)
+
+
+def old_pick():
+    for obj_id in obj_ids:
+        pick_mask = cv2.erode(np.uint8(mask == obj_id), np.ones((3, 3), np.uint8))
+        if np.sum(pick_mask) > 0:
+            return pick_mask
+
+
+def new_pick():
+    return utils.first_visible(mask, obj_ids)[1]
+
+
+def old_stats():
+    stats = []
+    for obj_id in obj_ids:
+        obj_mask = np.uint8(mask == obj_id)
+        eroded = cv2.erode(obj_mask, np.ones((3, 3), np.uint8))
+        u, v = np.nonzero(obj_mask)
+        bbox = (u.min(), v.min(), u.max(), v.max()) if len(u) else (-1,) * 4
+        stats.append((obj_mask.sum(), eroded.sum(), bbox))
+    return stats
+
+
+def new_stats():
+    return utils.object_mask_stats(mask, obj_ids)
+
+
+def per_call(fn):
+    start = time.perf_counter()
+    for _ in range(args.repeats):
+        fn()
+    return (time.perf_counter() - start) / args.repeats
+
+
+assert np.array_equal(old_free(), new_free()) and np.array_equal(old_pick(), new_pick())
+print(f'{args.objects} objects, first {args.hidden} candidates occluded')
+for name, old, new in [('free space', old_free, new_free), ('oracle pick', old_pick, new_pick),
+                       ('all stats', old_stats, new_stats)]:
+    old_t, new_t = per_call(old), per_call(new)
+    print(f'{name:>12}: {1e3 * old_t:.2f} -> {1e3 * new_t:.2f} ms/call ({old_t / new_t:.1f}x)')
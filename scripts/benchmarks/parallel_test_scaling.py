@@ -0,0 +1,36 @@
+"""Episodes/minute of the DAHLIA test harness versus the number of worker processes.
+
+The LLM is replaced by `FakeBackend` with a fixed per-call latency, so the numbers show
+how simulation and (simulated) model latency overlap across workers.
+"""
+
+import argparse
+import time
+
+from omegaconf import OmegaConf
+
+from cliport import dahlia_run
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--task", type=str, default="stack-block-pyramid-seq-seen-colors")
+parser.add_argument("--episodes", type=int, default=16)
+parser.add_argument("--workers", type=str, default="1,2,4,8")
+parser.add_argument("--latency", type=float, default=2.0, help="seconds per fake LLM call")
+args = parser.parse_args()
+
+cfg = OmegaConf.merge(OmegaConf.load('cliport/cfg/config.yaml'),
+                      OmegaConf.load('cliport/cfg/dahlia.yaml'))
+cfg.root_dir = '.'
+cfg.task = args.task
+cfg.gpt_model = 'fake'
+dahlia_run.set_llm_model('fake')
+
+backend_cfg = {'latency': args.latency, 'respond': 'say("done")'}
+seeds = list(range(0, 2 * args.episodes, 2))
+for n_workers in [int(n) for n in args.workers.split(',')]:
+    start = time.perf_counter()
+    results = dahlia_run.run_parallel_test(cfg, 'fake', seeds, n_workers, backend_cfg)
+    elapsed = time.perf_counter() - start
+    assert len(results) == len(seeds)
+    print(f'{n_workers} workers: {len(seeds) / elapsed * 60:.1f} episodes/min '
+          f'({elapsed:.1f} s for {len(seeds)} episodes)')
@@ -0,0 +1,67 @@
+"""Time-to-first-token of HFBackend with and without prefix KV caching.
+
+By default a small randomly initialised Llama runs on CPU over the DAHLIA tabletop prompt
+with a character-level tokenizer. Pass --model to benchmark a real checkpoint instead.
+"""
+
+import argparse
+import time
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer, LlamaConfig, LlamaForCausalLM
+
+from cliport.utils.llm_backends import HFBackend
+
+
+class CharTokenizer:
+    eos_token_id = 1
+
+    def convert_tokens_to_ids(self, token):
+        return 2
+
+    def apply_chat_template(self, messages, add_generation_prompt=False):
+        text = ''.join(f'<{m["role"]}>{m["content"]}</s>' for m in messages)
+        if add_generation_prompt:
+            text += '<assistant>'
+        return [3 + ord(c) % 120 for c in text]
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--model", type=str, default="")
+parser.add_argument("--prompt", type=str, default="prompts/dahlia/prompt_tabletop_ui.txt")
+parser.add_argument("--prefix_chars", type=int, default=4000)
+parser.add_argument("--n", type=int, default=5)
+args = parser.parse_args()
+
+if args.model:
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    model = AutoModelForCausalLM.from_pretrained(args.model, torch_dtype=torch.bfloat16,
+                                                 device_map="auto").eval()
+    prefix = open(args.prompt).read()
+else:
+    torch.manual_seed(0)
+    tokenizer = CharTokenizer()
+    model = LlamaForCausalLM(LlamaConfig(
+        vocab_size=128, hidden_size=256, intermediate_size=512, num_hidden_layers=4,
+        num_attention_heads=4, num_key_value_heads=4, max_position_embeddings=8192)).eval()
+    prefix = open(args.prompt).read()[:args.prefix_chars]
+
+queries = [f'objects = ["block {i}", "bowl {i}"]\n# put the block {i} in the bowl {i}.'
+           for i in range(args.n)]
+
+for prefix_caching in [False, True]:
+    backend = HFBackend(model, tokenizer, prefix_caching=prefix_caching)
+    ttfts = []
+    for query in queries:
+        messages = [{'role': 'system', 'content': 'You are a task planning assistant '
+                                                  'who only answers with python code'},
+                    {'role': 'user', 'content': f'{prefix}\n{query}'}]
+        input_ids = tokenizer.apply_chat_template(messages, add_generation_prompt=True)
+        prefix_messages = messages[:-1] + [{'role': 'user', 'content': prefix}]
+        start = time.perf_counter()
+        backend.generate_ids(input_ids, prefix_messages=prefix_messages, max_new_tokens=1,
+                             do_sample=False)
+        ttfts.append(time.perf_counter() - start)
+    print(f'prefix_caching={prefix_caching}: prompt {len(input_ids)} tokens | '
+          f'first call {ttfts[0] * 1e3:.1f} ms | '
+          f'later calls {sum(ttfts[1:]) / max(1, len(ttfts) - 1) * 1e3:.1f} ms')
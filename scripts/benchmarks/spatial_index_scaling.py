@@ -0,0 +1,117 @@
+"""Query cost of the R-tree object index against a linear scan, from 10 to 500 objects,
+and the cost of keeping the index of an `LMP_wrapper` current across actions.
+
+The linear scan is the previous `is_target_occupied` loop: clip the query point to every
+bounding box and compare the distance with the radius. Index maintenance moves one
+PyBullet box per action and then queries the index, which re-reads the AABB of every
+object.
+"""
+
+import argparse
+import time
+
+import numpy as np
+import pybullet as p
+from scipy.spatial import distance
+
+from cliport import dahlia_run
+from cliport.utils.spatial_index import SpatialIndex
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--objects", type=str, default="10,50,100,200,500")
+parser.add_argument("--queries", type=int, default=2000)
+parser.add_argument("--r", type=float, default=0.05)
+parser.add_argument("--actions", type=int, default=200)
+args = parser.parse_args()
+
+
+class BoxesEnv:
+    """PyBullet boxes at `footprints`; an action teleports the box under its pick
+    position to its place position."""
+
+    def __init__(self, footprints):
+        p.resetSimulation()
+        self.object_list, self.bodies = [], {}
+        for i, (x_min, y_min, x_max, y_max) in enumerate(footprints):
+            shape = p.createCollisionShape(
+                p.GEOM_BOX, halfExtents=[(x_max - x_min) / 2, (y_max - y_min) / 2, 0.02])
+            self.bodies[f'block {i}'] = p.createMultiBody(
+                0, shape, basePosition=[(x_min + x_max) / 2, (y_min + y_max) / 2, 0.02])
+            self.object_list.append(f'block {i}')
+
+    def get_bounding_box(self, obj_name):
+        aabb_min, aabb_max = p.getAABB(self.bodies[obj_name])
+        return (*aabb_min, *aabb_max)
+
+    def step(self, action):
+        (x, y, _), (u, v, _) = action['pose0'][0], action['pose1'][0]
+        for body in self.bodies.values():
+            (x_min, y_min, _), (x_max, y_max, _) = p.getAABB(body)
+            if x_min <= x <= x_max and y_min <= y <= y_max:
+                p.resetBasePositionAndOrientation(body, (u, v, 0.02), (0, 0, 0, 1))
+                return
+
+
+def maintenance(footprints, actions):
+    """us per action spent keeping the index current, and bounding boxes read."""
+    env = BoxesEnv(footprints)
+    lmp_env = dahlia_run.LMP_wrapper(env, {'env': {'init_objs': env.object_list,
+                                                   'coords': dahlia_run.lmp_tabletop_coords}})
+    lmp_env.spatial_index
+    updates, elapsed = lmp_env.n_index_updates, 0.
+    for pick, place in actions:
+        action = {'pose0': ((*pick, 0.02), (0, 0, 0, 1)), 'pose1': ((*place, 0.02), (0, 0, 0, 1))}
+        env.step(action)
+        lmp_env.invalidate_world()
+        start = time.perf_counter()
+        lmp_env.spatial_index
+        elapsed += time.perf_counter() - start
+    return 1e6 * elapsed / len(actions), (lmp_env.n_index_updates - updates) / len(actions)
+
+
+def linear_scan(footprints, center, r):
+    occupied = []
+    for i, (x_min, y_min, x_max, y_max) in enumerate(footprints):
+        closest_point = np.array([np.clip(center[0], x_min, x_max),
+                                  np.clip(center[1], y_min, y_max)])
+        if distance.euclidean(center, closest_point) <= r:
+            occupied.append(i)
+    return occupied
+
+
+def per_query(fn, points):
+    start = time.perf_counter()
+    for point in points:
+        fn(point)
+    return 1e6 * (time.perf_counter() - start) / len(points)
+
+
+p.connect(p.DIRECT)
+rng = np.random.default_rng(0)
+points = rng.uniform((0.25, -0.5), (0.75, 0.5), size=(args.queries, 2))
+print(f'{"objects":>8} {"linear":>10} {"near":>10} {"nearest":>10} {"update":>10}  (us/call)'
+      f'  {"maintain":>10}  (us/action, AABBs read)')
+for n_objects in [int(n) for n in args.objects.split(',')]:
+    # a denser table as objects are added, 2-8 cm objects
+    centers = rng.uniform((0.25, -0.5), (0.75, 0.5), size=(n_objects, 2))
+    sizes = rng.uniform(0.02, 0.08, size=(n_objects, 2))
+    footprints = np.concatenate([centers - sizes / 2, centers + sizes / 2], axis=1)
+
+    spatial_index = SpatialIndex()
+    start = time.perf_counter()
+    for i, footprint in enumerate(footprints):
+        spatial_index.update(i, footprint)
+    update = 1e6 * (time.perf_counter() - start) / n_objects
+
+    linear = per_query(lambda point: linear_scan(footprints, point, args.r), points)
+    near = per_query(lambda point: spatial_index.objects_near(point, args.r), points)
+    nearest = per_query(lambda point: spatial_index.nearest(point, 3), points)
+
+    # move the object under a pick point to a free-ish place point, like a plan would
+    picks = (footprints[:, :2] + footprints[:, 2:]) / 2
+    actions = [(picks[i], rng.uniform((0.25, -0.5), (0.75, 0.5)))
+               for i in rng.integers(0, n_objects, size=args.actions)]
+    maintain, reads = maintenance(footprints, actions)
+    print(f'{n_objects:>8} {linear:>10.1f} {near:>10.1f} {nearest:>10.1f} {update:>10.1f}'
+          f'  {maintain:>6.0f} ({reads:>3.0f})')
+p.disconnect()
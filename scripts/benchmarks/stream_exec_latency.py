@@ -0,0 +1,50 @@
+"""End-to-end latency of a tabletop_ui planner call with and without streaming execution.
+
+The LLM is a `FakeBackend` that decodes tokens at a fixed rate and every action of the
+generated plan sleeps for a fixed simulation time, so the numbers show how much of the
+decoding time is hidden behind executing earlier statements.
+"""
+
+import argparse
+import copy
+import time
+
+from cliport import dahlia_run
+from cliport.utils.llm_backends import FakeBackend
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--actions", type=int, default=6, help="pick-and-place calls per plan")
+parser.add_argument("--token_rate", type=float, default=40., help="tokens decoded per second")
+parser.add_argument("--ttft", type=float, default=0.5, help="seconds to the first token")
+parser.add_argument("--sim", type=float, default=0.5, help="simulated seconds per action")
+parser.add_argument("--n", type=int, default=3)
+args = parser.parse_args()
+
+plan = '\n'.join(
+    f"put_first_on_second('block {i}', 'bowl {i}')  # move block {i} into its bowl"
+    for i in range(args.actions))
+
+
+def put_first_on_second(arg1, arg2):
+    time.sleep(args.sim)
+
+
+for stream in (False, True):
+    cfg = copy.deepcopy(dahlia_run.cfg_tabletop['lmps']['tabletop_ui'])
+    cfg['stream'] = stream
+    backend = FakeBackend(respond=plan, latency=args.ttft, token_rate=args.token_rate)
+    variable_vars = {'put_first_on_second': put_first_on_second}
+    lmp_fgen = dahlia_run.LMPFGen((dahlia_run.cfg_tabletop['lmps']['fgen'], 'fake'), {},
+                                  variable_vars, backend=backend)
+    lmp = dahlia_run.LMP('tabletop_ui', (cfg, 'fake'), lmp_fgen, {}, variable_vars,
+                         backend=backend)
+
+    latencies = []
+    for _ in range(args.n):
+        lmp.clear_exec_hist()
+        start = time.perf_counter()
+        lmp('put the blocks in the bowls of the same index')
+        latencies.append(time.perf_counter() - start)
+    print(f'stream={stream}: {sum(latencies) / len(latencies):.2f}s per planner call '
+          f'(decode {args.ttft + len(plan.split()) / args.token_rate:.2f}s, '
+          f'simulation {args.actions * args.sim:.2f}s)')
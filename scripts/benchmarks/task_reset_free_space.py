@@ -0,0 +1,86 @@
+"""`env.reset()` time of the generated tasks, sampling random poses from a rendered
+free-space mask per call (the previous `Task.get_random_pose`) versus the episode's
+`OccupancyMap`, loaded from the shared render (default) or stamped with the AABBs of new
+objects (`Task.aabb_occupancy`).
+"""
+
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from cliport import tasks
+from cliport.environments.environment import Environment
+from cliport.generated_tasks import new_names
+from cliport.tasks.task import Task
+from cliport.utils import utils
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--assets_root", type=str, default="cliport/environments/assets/")
+parser.add_argument("--episodes", type=int, default=3, help="resets per task")
+parser.add_argument("--tasks", type=str, default=",".join(sorted(new_names)))
+args = parser.parse_args()
+
+
+def old_get_random_pose(self, env, obj_size=0.1, bound=np.zeros((3, 2)), **kwargs):
+    if bound.any() == 0:
+        bound = self.bounds
+    max_size = np.sqrt(obj_size[0] ** 2 + obj_size[1] ** 2)
+    erode_size = int(np.round(max_size / self.pix_size))
+    _, hmap, obj_mask = self.get_true_image(env)
+    free = np.ones(obj_mask.shape, dtype=np.uint8)
+    for obj_ids in env.obj_ids.values():
+        for obj_id in obj_ids:
+            free[obj_mask == obj_id] = 0
+    free[0, :], free[:, 0], free[-1, :], free[:, -1] = 0, 0, 0, 0
+    free = cv2.erode(free, np.ones((erode_size, erode_size), np.uint8))
+    if np.sum(free) == 0:
+        pix = (obj_mask.shape[0] // 2, obj_mask.shape[1] // 2)
+    else:
+        pix = utils.sample_distribution(np.float32(free))
+    pos = utils.pix_to_xyz(pix, hmap, bound, self.pix_size)
+    pos = [pos[0], pos[1], obj_size[2] / 2 if len(obj_size) > 2 else 0.05]
+    theta = np.random.rand() * 2 * np.pi
+    return pos, utils.eulerXYZ_to_quatXYZW((0, 0, theta))
+
+
+def time_resets(env, task_names, aabb_occupancy=False):
+    elapsed, failed = {}, []
+    for name in task_names:
+        task = tasks.names[name]()
+        task.mode = 'test'
+        task.aabb_occupancy = aabb_occupancy
+        env.set_task(task)
+        start = time.perf_counter()
+        try:
+            for seed in range(args.episodes):
+                env.seed(2 * seed + 1)
+                env.reset()
+        except Exception:  # generated tasks that fail to reset are skipped in both runs
+            failed.append(name)
+            continue
+        elapsed[name] = (time.perf_counter() - start) / args.episodes
+    return elapsed, failed
+
+
+env = Environment(args.assets_root, disp=False, hz=480)
+task_names = args.tasks.split(',')
+
+new_get_random_pose = Task.get_random_pose
+Task.get_random_pose = old_get_random_pose
+old, old_failed = time_resets(env, task_names)
+Task.get_random_pose = new_get_random_pose
+new, new_failed = time_resets(env, task_names)
+aabb, aabb_failed = time_resets(env, task_names, aabb_occupancy=True)
+
+names = sorted(set(old) & set(new) & set(aabb))
+old_total, new_total = sum(old[name] for name in names), sum(new[name] for name in names)
+aabb_total = sum(aabb[name] for name in names)
+print(f'{len(names)} tasks, {args.episodes} resets each '
+      f'({len(set(old_failed) | set(new_failed) | set(aabb_failed))} failed to reset)')
+print(f'old: {old_total:.2f} s per reset of all tasks')
+print(f'new: {new_total:.2f} s per reset of all tasks ({old_total / new_total:.1f}x)')
+print(f'aabb: {aabb_total:.2f} s per reset of all tasks ({old_total / aabb_total:.1f}x)')
+for name in sorted(names, key=lambda name: new[name] / old[name])[:5]:
+    print(f'  {name}: {1e3 * old[name]:.0f} -> {1e3 * new[name]:.0f} ms')
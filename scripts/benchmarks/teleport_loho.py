@@ -0,0 +1,55 @@
+"""Episodes/minute of the LoHo-Ravens tasks with the PickPlace primitive and with
+teleport execution, and how often the final rewards agree.
+
+Both modes replay the same plans: the first mode records the LLM responses in the
+response cache and the second replays them, so the only difference is execution.
+"""
+
+import argparse
+import os
+import time
+
+from omegaconf import OmegaConf
+
+from cliport import dahlia_run
+from cliport.loho_tasks import new_names
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--tasks", type=str, default=",".join(sorted(new_names)))
+parser.add_argument("--episodes", type=int, default=5, help="test seeds per task")
+parser.add_argument("--gpt_model", type=str, default="gpt4")
+parser.add_argument("--workers", type=int, default=4)
+parser.add_argument("--cache", type=str, default="cache/teleport_loho.sqlite")
+args = parser.parse_args()
+
+cfg = OmegaConf.merge(OmegaConf.load('cliport/cfg/config.yaml'),
+                      OmegaConf.load('cliport/cfg/dahlia.yaml'))
+cfg.root_dir = '.'
+cfg.gpt_model = args.gpt_model
+cfg.openai_key = os.environ.get('OPENAI_API_KEY', cfg.get('openai_key'))
+cfg.llm_cache.path = args.cache
+dahlia_run.set_llm_model('gpt-4o-mini')
+backend_cfg = dict(max_retries=cfg.llm_backend.max_retries, pool_size=cfg.llm_backend.pool_size)
+
+seeds = list(range(1, 2 * args.episodes, 2))
+rewards = {}
+for mode, cache_mode in [('pickplace', 'record'), ('teleport', 'replay')]:
+    cfg.execution.mode = mode
+    cfg.llm_cache.mode = cache_mode
+    n_episodes, elapsed = 0, 0.
+    for task in args.tasks.split(','):
+        cfg.task = task
+        start = time.perf_counter()
+        results = dahlia_run.run_parallel_test(cfg, 'gpt4', seeds, args.workers, backend_cfg)
+        elapsed += time.perf_counter() - start
+        n_episodes += len(results)
+        for res in results:
+            rewards.setdefault((task, res['seed']), {})[mode] = res['reward']
+    print(f'{mode:>10}: {n_episodes / elapsed * 60:.1f} episodes/min '
+          f'({elapsed:.0f} s for {n_episodes} episodes)')
+
+agree = [abs(r['pickplace'] - r['teleport']) < 1e-6 for r in rewards.values()]
+print(f'final rewards agree on {sum(agree)}/{len(agree)} episodes ({sum(agree) / len(agree):.0%})')
+for (task, seed), r in sorted(rewards.items()):
+    if abs(r['pickplace'] - r['teleport']) >= 1e-6:
+        print(f'  {task} seed {seed}: pickplace {r["pickplace"]:.3f}, teleport {r["teleport"]:.3f}')
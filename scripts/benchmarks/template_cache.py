@@ -0,0 +1,134 @@
+"""Filling URDF templates into a new randomly named temp file per object (previous
+`Task.fill_template`) versus the content-addressed `template_cache`.
+
+By default, fills and loads a box template in PyBullet DIRECT for `--episodes` episodes
+shaped like the kitting and packing resets: 5 kit holes filled with identical values, and
+a container plus 10 boxes of random sizes. With `--resets`, it times `reset()` of the
+real tasks instead; this needs the full Environment and assets.
+"""
+
+import argparse
+import os
+import random
+import string
+import tempfile
+import time
+
+import numpy as np
+import pybullet as p
+
+from cliport import tasks
+from cliport.tasks.task import Task
+from cliport.utils import template_cache
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--episodes", type=int, default=100)
+parser.add_argument("--resets", action="store_true")
+parser.add_argument("--tasks", type=str, default="assembling-kits,packing-boxes")
+parser.add_argument("--assets_root", type=str, default="cliport/environments/assets/")
+args = parser.parse_args()
+
+BOX_TEMPLATE = """<?xml version="1.0"?>
+<robot name="box">
+  <link name="base_link">
+    <inertial>
+      <mass value="0.1"/>
+      <inertia ixx="1" ixy="0" ixz="0" iyy="1" iyz="0" izz="1"/>
+    </inertial>
+    <visual>
+      <geometry><box size="DIM0 DIM1 DIM2"/></geometry>
+      <material name="color"><color rgba="0.5 0.5 0.5 1"/></material>
+    </visual>
+    <collision>
+      <geometry><box size="DIM0 DIM1 DIM2"/></geometry>
+    </collision>
+  </link>
+</robot>
+"""
+
+
+def old_fill_template(self, template, replace):
+    full_template_path = os.path.join(self.assets_root, template)
+    with open(full_template_path, 'r') as file:
+        fdata = file.read()
+    for field in replace:
+        for i in range(len(replace[field])):
+            fdata = fdata.replace(f'{field}{i}', str(replace[field][i]))
+    alphabet = string.ascii_lowercase + string.digits
+    rname = ''.join(random.choices(alphabet, k=16))
+    fname = os.path.join(tempfile.gettempdir(), f'{os.path.split(template)[-1]}.{rname}')
+    with open(fname, 'w') as file:
+        file.write(fdata)
+    return fname
+
+
+def synthetic_episodes(task, fill_template):
+    """Seconds and distinct files for `--episodes` episodes of fills and loads."""
+    files = []
+    rng = np.random.RandomState(0)
+    start = time.perf_counter()
+    for _ in range(args.episodes):
+        p.resetSimulation()
+        for _ in range(5):  # kit holes
+            files.append(fill_template(task, 'box/box-template.urdf', {'DIM': (0.03, 0.03, 0.001)}))
+            p.loadURDF(files[-1])
+        for _ in range(11):  # container and boxes
+            files.append(fill_template(task, 'box/box-template.urdf',
+                                       {'DIM': tuple(rng.uniform(0.05, 0.3, 3))}))
+            p.loadURDF(files[-1])
+    return time.perf_counter() - start, set(files)
+
+
+def synthetic():
+    p.connect(p.DIRECT)
+    task = Task()
+    task.assets_root = tempfile.mkdtemp()
+    os.makedirs(os.path.join(task.assets_root, 'box'))
+    with open(os.path.join(task.assets_root, 'box', 'box-template.urdf'), 'w') as file:
+        file.write(BOX_TEMPLATE)
+    old_t, old_files = synthetic_episodes(task, old_fill_template)
+    new_t, new_files = synthetic_episodes(task, Task.fill_template)
+    kept = len(os.listdir(template_cache.cache.directory))
+    for fname in old_files:
+        os.remove(fname)
+    print(f'{args.episodes} synthetic episodes, 16 fills each')
+    print(f'fill + load: {1e3 * old_t / args.episodes:.2f} -> '
+          f'{1e3 * new_t / args.episodes:.2f} ms/episode ({old_t / new_t:.2f}x)')
+    print(f'files written: {len(old_files)} -> {len(new_files)} ({kept} kept on disk)')
+    p.disconnect()
+
+
+def resets(env, task_name, fill_template):
+    Task.fill_template = fill_template
+    template_cache.cache.n_written = 0
+    task = tasks.names[task_name]()
+    task.mode = 'train'
+    before = set(os.listdir(tempfile.gettempdir()))
+    start = time.perf_counter()
+    for seed in range(args.episodes):
+        np.random.seed(seed)
+        random.seed(seed)
+        env.set_task(task)
+        env.reset()
+    elapsed = (time.perf_counter() - start) / args.episodes
+    written = len(set(os.listdir(tempfile.gettempdir())) - before)
+    return elapsed, written + template_cache.cache.n_written
+
+
+def real_resets():
+    from cliport.environments.environment import Environment
+    env = Environment(args.assets_root, disp=False, hz=480)
+    cached_fill_template = Task.fill_template
+    for task_name in args.tasks.split(','):
+        old_t, old_files = resets(env, task_name, old_fill_template)
+        new_t, new_files = resets(env, task_name, cached_fill_template)
+        print(f'{task_name}: reset {1e3 * old_t:.1f} -> {1e3 * new_t:.1f} ms '
+              f'({old_t / new_t:.2f}x), files per {args.episodes} episodes: '
+              f'{old_files} -> {new_files}')
+    Task.fill_template = cached_fill_template
+
+
+if args.resets:
+    real_resets()
+else:
+    synthetic()
@@ -0,0 +1,95 @@
+"""Bytes sent and encode time per VLM completion check.
+
+Each check sends the initial and final color and depth frames (640x480) to a `FakeBackend`
+standing in for the VLM endpoint. The previous LMPV encoded all four frames at full
+resolution on the calling thread; now the initial frames are prefetched while the planner
+runs (`--plan_time`), and the frames are downsampled and encoded on a thread pool.
+"""
+
+import argparse
+import base64
+import time
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from cliport import dahlia_run
+from cliport.utils.llm_backends import FakeBackend
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--checks", type=int, default=20)
+parser.add_argument("--max_side", type=int, default=512, help="0 for full resolution")
+parser.add_argument("--workers", type=int, default=4)
+parser.add_argument("--plan_time", type=float, default=0.2,
+                    help="seconds between capturing the initial frames and the check")
+args = parser.parse_args()
+
+
+def old_encode_image(image_sources):
+    images = []
+    for image_source in image_sources:
+        image = Image.fromarray(image_source[0])
+        if image.mode == 'F':
+            if image_source[1] == 'd':
+                image = image.convert('L')
+            elif image_source[1] == 'c':
+                image = image.convert('RGB')
+        buffered = BytesIO()
+        image.save(buffered, format='JPEG')
+        images.append(base64.b64encode(buffered.getvalue()).decode('utf-8'))
+    return images
+
+
+def observation(rng):
+    # a table with a few blocks, plus sensor noise
+    color = np.full((480, 640, 3), (120, 100, 80), dtype=np.float32)
+    depth = np.full((480, 640), 0.8, dtype=np.float32)
+    for _ in range(8):
+        y, x = rng.randint(0, 440), rng.randint(0, 600)
+        color[y:y + 40, x:x + 40] = rng.randint(0, 255, 3)
+        depth[y:y + 40, x:x + 40] -= 0.04
+    color += rng.normal(0., 4., color.shape)
+    depth += rng.normal(0., 0.002, depth.shape).astype(np.float32)
+    return [(np.clip(color, 0, 255).astype(np.uint8), 'c'), (depth, 'd')]
+
+
+sent = []
+
+
+def respond(messages):
+    sent.append(sum(len(part['image_url']['url']) for part in messages[-1]['content']
+                    if part['type'] == 'image_url'))
+    return 'judge = True'
+
+
+def run(new):
+    cfg = dict(dahlia_run.cfg_tabletop['lmps']['VLM'], image_workers=args.workers,
+               image_max_side=args.max_side if new and args.max_side else None)
+    lmp = dahlia_run.LMPV('VLM_ui', (cfg, 'gpt4'), FakeBackend(respond=respond))
+    if not new:
+        lmp.encode_image = old_encode_image
+    rng = np.random.RandomState(0)
+    sent.clear()
+    encode_times = []
+    for _ in range(args.checks):
+        lmp.clear_exec_hist()  # a new episode
+        initial = observation(rng)
+        if new:
+            lmp.prefetch_images(initial)
+        time.sleep(args.plan_time)
+        image_sources = initial + observation(rng)
+        start = time.perf_counter()
+        lmp.encode_image(image_sources)
+        encode_times.append(time.perf_counter() - start)
+        dahlia_run.answer = ''
+        lmp('check', image_sources)
+    return np.mean(sent), np.mean(encode_times)
+
+
+old_bytes, old_time = run(new=False)
+new_bytes, new_time = run(new=True)
+print(f'{args.checks} checks, 4 frames each, max side {args.max_side}, {args.workers} workers')
+print(f'old: {old_bytes / 1e3:.0f} kB/check, encode {1e3 * old_time:.1f} ms/check')
+print(f'new: {new_bytes / 1e3:.0f} kB/check ({old_bytes / new_bytes:.1f}x less), '
+      f'encode {1e3 * new_time:.1f} ms/check ({old_time / new_time:.1f}x)')